@@ -0,0 +1,20 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+tools/ modules used by the ica modules
+
+Imported as part of the package the modules come from the tools package;
+imported as a top level module (scripts put ica/ on sys.path) tools/ is
+put on sys.path first.
+
+>>> from _tools_path import imgio, tracing
+"""
+import os, sys
+try:
+    from ..tools import imgio, tracing, executor, volstack
+except (ValueError, ImportError):
+    TOOLS = os.path.normpath(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, 'tools'))
+    if not TOOLS in sys.path:
+        sys.path.insert(0, TOOLS)
+    import imgio, tracing, executor, volstack
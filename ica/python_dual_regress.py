@@ -1,27 +1,23 @@
 import os, re
 from glob import glob
+from multiprocessing.pool import ThreadPool
 import nibabel as ni
 import numpy as np
-import nipype.interfaces.fsl as fsl
-from nipype.interfaces.base import CommandLine
-from nipype.utils.filemanip import split_filename
+from _tools_path import imgio, tracing, executor, volstack
 """
 infiles are
 <basedir>/<subid>.ica/reg_standard/filtered_func_data.nii.gz
 """
 def get_fsl_outputtype():
     
-    ftypes = {'NIFTI': '.nii',
-              'NIFTI_PAIR': '.img',
-              'NIFTI_GZ': '.nii.gz',
-              'NIFTI_PAIR_GZ': '.img.gz'}
     env = os.environ
     try:
         fsl_key = env['FSLOUTPUTTYPE']
-        return ftypes[fsl_key]
+        return imgio.FSL_EXTENSIONS[fsl_key]
     except:
         raise IOError('FSLOUTPUTTYPE not found in env')
     
+@tracing.traced()
 def create_common_mask(infiles, outdir):
     """
     for each file:
@@ -30,19 +26,22 @@ def create_common_mask(infiles, outdir):
 
     merge files into 4d brik
     calc voxelwise min across time
-    save as maskALL
+    save as maskALL (float32, extension from FSLOUTPUTTYPE)
     """
-    nsub = len(infiles)
-    dim = ni.load(infiles[0]).get_shape()
-    mask = np.zeros((dim[0], dim[1], dim[2],nsub))
-    for val, f in enumerate(infiles):
-        dat = ni.load(f).get_data()
-        dstd = dat.std(axis=3)
-        mask[:,:,:,val] = dstd
-    minmask = mask.min(axis=3)
-    newimg = ni.Nifti1Image(minmask, ni.load(infiles[0]).get_affine())
-    outfile = os.path.join(outdir, 'mask.nii.gz')
-    newimg.to_filename(outfile)
+    minstd = None
+    for f in infiles:
+        stack = volstack.MaskedVolumeStack.from_image(f)
+        dstd = np.concatenate([chunk.std(axis=1, dtype=np.float64)
+                               for _, chunk in stack.iter_chunks()])
+        if minstd is None:
+            minstd = dstd
+        elif not len(dstd) == len(minstd):
+            raise ValueError('dimension mismatch, %s: %s'%(f, stack.shape))
+        else:
+            minstd = np.minimum(minstd, dstd)
+    minmask = stack.to_volume(minstd)
+    outfile = imgio.output_filename(os.path.join(outdir, 'mask'))
+    imgio.save(minmask, stack.affine, outfile)
     return outfile
 
 
@@ -59,6 +58,12 @@ def get_subid(instr, pattern='B[0-9]{2}-[0-9]{3}'):
     return subid
 
 
+def _infile_subid(callargs):
+    """ subject of a traced call, from its infile argument"""
+    return get_subid(callargs['infile'])
+
+
+@tracing.traced(subject=_infile_subid)
 def template_timeseries_sub(infile, template, mask, outdir):
     """
     Run subject data against template to find timesearies specific
@@ -90,7 +95,10 @@ def template_timeseries_sub(infile, template, mask, outdir):
     fsl_glm -i <file> -d <melodicIC> -o <outdir>/dr_stage1_${subid}.txt
     --demean -m <mask>;
     """
-    fpth, fnme, fext = split_filename(infile)
+    # fsl_glm runs in outdir, so paths are absolute
+    infile, template, mask, outdir = [os.path.abspath(x) for x in
+                                      (infile, template, mask, outdir)]
+    fpth, fnme, fext = imgio.split_filename(infile)
     f = os.path.join(fpth, fnme)
     subid = get_subid(f)
     outfile = os.path.join(outdir, 'dr_stage1_%s.txt'%(subid))
@@ -99,9 +107,9 @@ def template_timeseries_sub(infile, template, mask, outdir):
                     '-o %s'%(outfile),
                     '--demean',
                     '-m %s'%(mask)])
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
-        print cout.runtime.stderr
+    cout = executor.run(cmd, cwd=outdir, subject=subid)
+    if not cout.ok:
+        print cout.stderr
         return None
     else:
         return outfile
@@ -135,6 +143,7 @@ def concat_regressors(a,b, outdir = None):
     return outf
         
 
+@tracing.traced(subject=_infile_subid)
 def sub_spatial_map(infile, design, mask, outdir, desnorm=True, out_res=False, mvt=None):
     """ glm on ts data using stage1 txt file as model
     Parameters
@@ -171,6 +180,9 @@ def sub_spatial_map(infile, design, mask, outdir, desnorm=True, out_res=False, m
     """
     
     subid = get_subid(infile)
+    # fsl_glm runs in outdir, so paths are absolute
+    infile, design, mask, outdir = [os.path.abspath(x) for x in
+                                    (infile, design, mask, outdir)]
     # define outfiles
     stage2_ts = os.path.join(outdir, 'dr_stage2_%s'%(subid))
     stage2_tsz = os.path.join(outdir,'dr_stage2_%s_Z'%(subid))
@@ -178,7 +190,7 @@ def sub_spatial_map(infile, design, mask, outdir, desnorm=True, out_res=False, m
     ext = get_fsl_outputtype()
     # add movment regressor to design if necessary
     if not mvt is None: 
-        design = concat_regressors(design, mvt)
+        design = os.path.abspath(concat_regressors(design, mvt))
     # generate command
     cmd = ' '.join(['fsl_glm -i %s'%(infile),
                     '-d %s'%(design),
@@ -191,10 +203,10 @@ def sub_spatial_map(infile, design, mask, outdir, desnorm=True, out_res=False, m
         cmd = ' '.join([cmd, '--des_norm'])
     if out_res:
         cmd = ' '.join([cmd, '--out_res=%s'%(stage2_res)])
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
+    cout = executor.run(cmd, cwd=outdir, subject=subid)
+    if not cout.ok:
         print cmd
-        print cout.runtime.stderr
+        print cout.stderr
         return None, None
     else:
         return stage2_ts + ext, stage2_tsz + ext
@@ -208,13 +220,13 @@ def dual_regression(infile, template, mask, desnorm = 1):
         get timeseries for maps
         split individual subjects components into separate files
         returns list of files
-        
+    commands run in the directory of mask (without changing the working
+    directory of this process, so subjects can run in threads, see
+    cohort_dual_regression)
     """
-    startdir = os.getcwd()
-    outdir, _ = os.path.split(mask)
-    os.chdir(outdir)
+    outdir, _ = os.path.split(os.path.abspath(mask))
     
-    melodicpth, melodicnme, melodicext = split_filename(template)
+    melodicpth, melodicnme, melodicext = imgio.split_filename(template)
     template = os.path.join(melodicpth, melodicnme)
     #for f in infiles:
     stage1txt = template_timeseries_sub(infile, template, mask, outdir)
@@ -228,24 +240,51 @@ def dual_regression(infile, template, mask, desnorm = 1):
     allic = split_components(stage2_ts, subid, outdir)
     if allic is None:
         return None
-    
-    os.chdir(startdir)
     return allic
-    
 
+
+def cohort_dual_regression(infiles, template, mask, desnorm=1, nproc=4):
+    """
+    dual_regression of every subject, nproc subjects at a time (the
+    FSL commands are limited by the shared command executor, see
+    executor.get_executor)
+
+    Returns
+    -------
+    subd : dict
+        {subid : list of component files, None if failed}
+    """
+    def run_subject(infile):
+        return get_subid(infile), dual_regression(infile, template, mask,
+                                                  desnorm)
+    if nproc > 1 and len(infiles) > 1:
+        pool = ThreadPool(min(nproc, len(infiles)))
+        try:
+            results = pool.map(run_subject, infiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_subject(f) for f in infiles]
+    return dict(results)
+
+
+@tracing.traced(subject='subid')
 def split_components(file4d, subid, outdir):
     """ split subjects 4d components into individual files
     Notes
     -----
     fslsplit <outdir>/dr_stage2_$s $OUTPUT/dr_stage2_${s}_ic"""
+    # fslsplit runs in outdir, so paths are absolute
+    file4d, outdir = os.path.abspath(file4d), os.path.abspath(outdir)
     outic = os.path.join(outdir, 'dr_stage2_%s_ic'%(subid))
     cmd = ' '.join(['fslsplit',
                     file4d,
                     outic])
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
+    cout = executor.run(cmd, cwd=outdir, subject=subid)
+    if not cout.ok:
         print cmd
-        print cout.runtime.stderr
+        print cout.stderr
         return None
     
     allic = glob('%s*'%(outic))
@@ -260,6 +299,7 @@ def find_component_number(instr, pattern = 'ic[0-9]{4}'):
         raise IOError('%s not found in %s'%(pattern, instr))
     
 
+@tracing.traced()
 def merge_components(datadir, globstr = 'dr_stage2_*_ic0000.nii.gz'):
     """
     concatenate components across subjects
@@ -272,7 +312,8 @@ def merge_components(datadir, globstr = 'dr_stage2_*_ic0000.nii.gz'):
     subject_order : list
         list holding the order of subjects in 4d component file
     """
-    allf = glob(os.path.join(datadir, globstr))
+    # absolute, fslmerge runs in datadir
+    allf = glob(os.path.join(os.path.abspath(datadir), globstr))
     allf.sort()
     component = find_component_number(allf[0])
     outdir, _ = os.path.split(allf[0])
@@ -280,16 +321,17 @@ def merge_components(datadir, globstr = 'dr_stage2_*_ic0000.nii.gz'):
     subject_order = [get_subid(x) for x in allf]
     mergefile = os.path.join(outdir, 'dr_stage2_%s_4D.nii.gz'%component) 
     cmd = 'fslmerge -t %s '%(mergefile) + ' '.join(allf)
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
+    cout = executor.run(cmd, cwd=outdir)
+    if not cout.ok:
         print cmd
-        print cout.runtime.stderr, cout.runtime.stdout
+        print cout.stderr, cout.stdout
         return
 
     return mergefile, subject_order
     
 
 
+@tracing.traced()
 def sort_maps_randomise(stage2_ics, mask, perms=500):
     """
     TO DO: clean up 
@@ -300,28 +342,30 @@ def sort_maps_randomise(stage2_ics, mask, perms=500):
     randomise -i stage2_ic -o <outdir>/dr_stage3_ic<val> -m <mask> <design> -n <permutations> -T -V
     fslmerge -t stage2_ic4d stage2_ics*
     remove stage2_ics
+    commands run in the directory of mask, randomise at most
+    executor.DEFAULT_LIMITS['randomise'] at a time
     """
-    startdir = os.getcwd()
+    # commands run in outdir, so paths are absolute
+    mask = os.path.abspath(mask)
+    stage2_ics = [os.path.abspath(f) for f in stage2_ics]
     outdir, _ = os.path.split(mask)
-    os.chdir(outdir)
     mask = mask.strip('.nii.gz')
     design = -1
 
     mergefile = stage2_ics[0].replace('.nii.gz', '_4D.nii.gz')
     cmd = 'fslmerge -t %s '%(mergefile) + ' '.join(stage2_ics)
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
+    cout = executor.run(cmd, cwd=outdir)
+    if not cout.ok:
         print cmd
-        print cout.runtime.stderr, cout.runtime.stdout
+        print cout.stderr, cout.stdout
         return
     stage3 = mergefile.replace('stage2', 'stage3')
     cmd = ' '.join(['randomise -i %s'%(mergefile), '-o %s'%(stage3),'%d'%(design),'-m %s'%(mask), '-n %d'%(perms), '-T'])
-    cout = CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
+    cout = executor.run(cmd, cwd=outdir)
+    if not cout.ok:
         print cmd
-        print cout.runtime.stderr, cout.runtime.stdout
+        print cout.stderr, cout.stdout
         return cmd
-    os.chdir(startdir)
 
 if __name__ == '__main__':
 
@@ -333,15 +377,14 @@ if __name__ == '__main__':
     
     #mask = create_common_mask(infiles, outdir)
     mask = basedir + '/ica.gica/dual_regress/mask.nii.gz'
-    subd =  {}
-    for f in infiles:
-        subid = get_subid(f)
-        allic = dual_regressions(f, template, mask)
-        subd.update({subid:allic})
-    # run randomise
-    for i in range(len(subd[subd.keys()[0]])):
-        if i == 0:
-            continue
-        items = [x[i] for x in sorted(subd.values())]
-        cmd = sort_maps_randomise(items, mask, perms=500)
+    subd = cohort_dual_regression(infiles, template, mask, nproc=8)
+    # run randomise, components overlap within the randomise limit
+    ncomp = len(subd[subd.keys()[0]])
+    allitems = [[x[i] for x in sorted(subd.values())]
+                for i in range(1, ncomp)]
+    pool = ThreadPool(4)
+    pool.map(lambda items: sort_maps_randomise(items, mask, perms=500),
+             allitems)
+    pool.close()
+    pool.join()
  
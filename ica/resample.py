@@ -0,0 +1,262 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Native resampling of functional series to standard space
+
+The FEAT registration (example_func2highres.mat followed by
+highres2standard_warp) is composed once per subject into a single map
+from standard space voxels to example_func voxel coordinates, stored as
+trilinear interpolation indices and weights, and cached on disk. Every
+volume is then resampled with one vectorised gather, in time chunks
+over a pool of processes, without FSL.
+
+resample_series(filtered_func, regdir, MNI152_T1_3mm_brain, outfile)
+"""
+import os
+import hashlib
+from multiprocessing import Pool
+import numpy as np
+import nibabel as ni
+from nibabel.openers import ImageOpener
+from _tools_path import imgio, tracing, executor
+
+# nifti intent codes of displacement fields (none, vector, FSL fnirt
+# displacement field), other FSL codes (2007-2009) are coefficients
+DISPLACEMENT_INTENTS = (0, 1007, 2006)
+
+
+def fsl_vox2mm(img):
+    """ 4 X 4 matrix from voxel to FSL (scaled, possibly x flipped) mm
+    coordinates, the space of flirt matrices and fnirt fields"""
+    shape = img.shape[:3]
+    zooms = img.get_header().get_zooms()[:3]
+    vox2mm = np.diag(list(zooms) + [1.])
+    if np.linalg.det(img.get_affine()) > 0:
+        # radiological (neurological storage) flip
+        vox2mm[0, 0] = -zooms[0]
+        vox2mm[0, 3] = (shape[0] - 1) * zooms[0]
+    return vox2mm
+
+
+def load_displacement(warpfile, ref):
+    """
+    fnirt warp as a relative displacement field (x, y, z, 3) in mm
+
+    A coefficient file (the FEAT default) is converted once with
+    fnirtfileutils to <warp>_field.nii.gz next to it, including the
+    affine part of the warp (--withaff, fnirt was run with --aff and
+    applywarp applies it)
+    """
+    img = ni.load(warpfile)
+    intent = int(img.get_header()['intent_code'])
+    if intent not in DISPLACEMENT_INTENTS:
+        fieldfile = warpfile.replace('.nii.gz', '_field.nii.gz')
+        if not os.path.isfile(fieldfile) or \
+           os.path.getmtime(fieldfile) < os.path.getmtime(warpfile):
+            out = executor.run(['fnirtfileutils', '-i', warpfile,
+                                '-r', ref, '-o', fieldfile, '--withaff'])
+            if not out.ok:
+                raise IOError('fnirtfileutils failed on %s: %s'%(
+                    warpfile, out.stderr))
+        img = ni.load(fieldfile)
+    field = np.asarray(img.get_data(), dtype=np.float64)
+    return field.reshape(img.shape[:3] + (3,))
+
+
+def compose_coords(premat, field, func_img, ref_img):
+    """
+    map every ref voxel to (fractional) voxel coordinates of func_img
+
+    Parameters
+    ----------
+    premat : array
+        4 X 4 flirt matrix, func to highres (FSL mm)
+    field : array or None
+        (ref shape + (3,)) relative displacement (mm) from ref to highres,
+        None for affine only (premat to ref)
+    func_img, ref_img : nibabel images
+
+    Returns
+    -------
+    coords : array
+        (ref shape + (3,)) voxel coordinates in func_img
+    """
+    shape = ref_img.shape[:3]
+    grid = np.indices(shape).reshape((3, -1)).astype(np.float64)
+    ref_mm = np.dot(fsl_vox2mm(ref_img),
+                    np.vstack((grid, np.ones((1, grid.shape[1])))))
+    if field is not None:
+        ref_mm[:3] += field.reshape((-1, 3)).T
+    mm2vox = np.linalg.inv(fsl_vox2mm(func_img))
+    transform = np.dot(mm2vox, np.linalg.inv(premat))
+    coords = np.dot(transform, ref_mm)[:3]
+    return coords.T.reshape(shape + (3,))
+
+
+def trilinear_weights(coords, shape):
+    """
+    trilinear interpolation of a volume of shape at coords
+
+    Returns
+    -------
+    inside : array
+        flat (C order) indices of the coords within the volume
+    idx : array
+        (len(inside), 8) flat (F order) indices of the 8 neighbours
+    weights : array
+        (len(inside), 8) float32 weights
+    """
+    coords = coords.reshape((-1, 3))
+    upper = np.array(shape) - 1
+    inside = np.nonzero(np.all((coords >= 0) & (coords <= upper),
+                               axis=1))[0]
+    c = coords[inside]
+    base = np.minimum(np.floor(c).astype(int), np.maximum(upper - 1, 0))
+    frac = c - base
+    idx = np.empty((len(inside), 8), dtype=np.int64)
+    weights = np.empty((len(inside), 8), dtype=np.float32)
+    strides = np.array([1, shape[0], shape[0] * shape[1]])
+    for corner in range(8):
+        offset = np.array([(corner >> axis) & 1 for axis in range(3)])
+        corner_idx = np.minimum(base + offset, upper)
+        idx[:, corner] = np.dot(corner_idx, strides)
+        weights[:, corner] = np.prod(np.where(offset, frac, 1 - frac),
+                                     axis=1)
+    return inside, idx, weights
+
+
+def transform_key(premat_file, warpfile, func_img, ref_img):
+    """ sha1 of everything the coordinate map depends on"""
+    sha1 = hashlib.sha1()
+    sha1.update(open(premat_file, 'rb').read())
+    if warpfile is not None:
+        st = os.stat(warpfile)
+        sha1.update('%s %d %f'%(os.path.abspath(warpfile), st.st_size,
+                                st.st_mtime))
+    for img in (func_img, ref_img):
+        sha1.update(str(img.shape[:3]))
+        sha1.update(str(img.get_header().get_zooms()[:3]))
+        sha1.update(img.get_affine().tostring())
+    return sha1.hexdigest()
+
+
+@tracing.traced()
+def get_coordinate_map(regdir, func_img, ref, cachedir=None, nonlinear=True):
+    """
+    composed example_func -> standard map of a feat reg directory as
+    trilinear weights (see trilinear_weights), cached in cachedir
+    (default regdir) and recomputed only if its inputs changed
+
+    Returns
+    -------
+    inside, idx, weights : arrays
+    """
+    premat_file = os.path.join(regdir, 'example_func2highres.mat')
+    warpfile = None
+    if nonlinear:
+        warpfile = os.path.join(regdir, 'highres2standard_warp.nii.gz')
+    ref_img = imgio.load(ref)
+    if cachedir is None:
+        cachedir = regdir
+    key = transform_key(premat_file, warpfile, func_img, ref_img)
+    cachefile = os.path.join(cachedir, 'func2standard_%s.npz'%(key[:16]))
+    if os.path.isfile(cachefile):
+        cached = np.load(cachefile)
+        return cached['inside'], cached['idx'], cached['weights']
+    field = None
+    if warpfile is not None:
+        field = load_displacement(warpfile, ref)
+    coords = compose_coords(np.loadtxt(premat_file), field, func_img,
+                            ref_img)
+    inside, idx, weights = trilinear_weights(coords, func_img.shape[:3])
+    tmpfile = cachefile + '.tmp.npz'
+    np.savez(tmpfile, inside=inside, idx=idx, weights=weights)
+    os.rename(tmpfile, cachefile)
+    return inside, idx, weights
+
+
+# shared by resample workers, set by _init_resample_worker
+_resample_state = {}
+
+def _init_resample_worker(inside, idx, weights, nref):
+    _resample_state.update(inside=inside, idx=idx, weights=weights,
+                           nref=nref)
+
+
+def _resample_chunk(chunk):
+    """ resample (x, y, z, nt) chunk, returns (nref, nt) float32 (C order
+    ref voxels)"""
+    st = _resample_state
+    nt = chunk.shape[3]
+    src = chunk.reshape((-1, nt), order='F')
+    out = np.zeros((st['nref'], nt), dtype=np.float32)
+    out[st['inside']] = np.einsum('vc,vct->vt', st['weights'],
+                                  src[st['idx']].astype(np.float32))
+    return out
+
+
+@tracing.traced()
+def resample_series(infile, regdir, ref, outfile, chunk_size=10, nproc=1,
+                    cachedir=None, nonlinear=True):
+    """
+    resample a 4D series in example_func space to the ref grid through
+    the composed premat and nonlinear warp of a feat reg directory
+
+    Parameters
+    ----------
+    infile : str
+        4D series (eg. filtered_func_data.nii.gz)
+    regdir : str
+        feat reg directory (example_func2highres.mat,
+        highres2standard_warp.nii.gz)
+    ref : str
+        standard space reference image (eg. MNI152_T1_3mm_brain.nii.gz)
+    outfile : str
+        resampled float32 4D series on the ref grid
+    chunk_size : int
+        volumes per chunk
+    nproc : int
+        number of processes resampling chunks
+    cachedir : str or None
+        directory of the cached coordinate map (default regdir)
+    nonlinear : bool
+        apply the nonlinear warp (False for premat only, affine to ref)
+
+    Returns
+    -------
+    outfile : str
+    """
+    img = imgio.load(infile)
+    ref_img = imgio.load(ref)
+    inside, idx, weights = get_coordinate_map(regdir, img, ref, cachedir,
+                                              nonlinear)
+    refshape = ref_img.shape[:3]
+    nvols = int(np.prod(img.shape[3:]))
+    hdr = ni.Nifti1Header()
+    hdr.set_data_shape(refshape + (nvols,))
+    hdr.set_data_dtype(np.float32)
+    hdr.set_zooms(ref_img.get_header().get_zooms()[:3] +
+                  (img.get_header().get_zooms() + (1.,))[3:4])
+    hdr.set_qform(ref_img.get_affine(), 1)
+    hdr.set_sform(ref_img.get_affine(), 1)
+    initargs = (inside, idx, weights, int(np.prod(refshape)))
+    chunks = imgio.iter_volumes(infile, chunk_size)
+    if nproc > 1:
+        pool = Pool(nproc, _init_resample_worker, initargs)
+        results = pool.imap(_resample_chunk, chunks)
+    else:
+        _init_resample_worker(*initargs)
+        results = (_resample_chunk(chunk) for chunk in chunks)
+    try:
+        with ImageOpener(outfile, 'wb') as fobj:
+            hdr.write_to(fobj)
+            fobj.write(b'\x00' * (hdr.get_data_offset() - fobj.tell()))
+            for res in results:
+                # ref voxels are C order, nifti is F order
+                vols = res.reshape(refshape + (res.shape[1],))
+                fobj.write(vols.tostring(order='F'))
+    finally:
+        if nproc > 1:
+            pool.close()
+            pool.join()
+    return outfile
@@ -2,12 +2,14 @@ import os, shutil
 from datetime import datetime as dtime
 from glob import glob
 import tempfile
-from nipype.interfaces.base import CommandLine
-from nipype.interfaces.fsl import ApplyWarp, ImageMaths, ImageStats
+from multiprocessing.pool import ThreadPool
+import resample
+from _tools_path import tracing
 
 
-
-def applywarp(infile, ref, regdir, outname):
+def get_transform(regdir):
+    """ return (warp, premat) of a feat reg directory, None if either
+    is missing"""
     warp = os.path.join(regdir, 'highres2standard_warp.nii.gz')
     premat = os.path.join(regdir, 'example_func2highres.mat')
     if not os.path.isfile(warp):
@@ -16,16 +18,59 @@ def applywarp(infile, ref, regdir, outname):
     if not os.path.isfile(premat):
         print 'no premat found ', premat
         return None
-    startdir = os.getcwd()
-    pth, nme = os.path.split(infile)
-    os.chdir(pth)
+    return warp, premat
+
+
+def is_current(outfile, depends):
+    """ True if outfile exists and is newer than all files in depends"""
+    if not os.path.isfile(outfile):
+        return False
+    outtime = os.path.getmtime(outfile)
+    return all([os.path.getmtime(f) < outtime for f in depends])
+
+
+def applywarp(infile, ref, regdir, outname, interp=None, clobber=False):
+    """
+    warp infile to ref with the premat and nonlinear warp of regdir,
+    saving to outname
+
+    Parameters
+    ----------
+    infile : str
+        image in example_func space
+    ref : str
+        reference (standard space) image
+    regdir : str
+        feat reg directory holding highres2standard_warp.nii.gz and
+        example_func2highres.mat
+    outname : str
+        warped output file
+    interp : str or None
+        'nn', 'trilinear', 'sinc' or 'spline' (default FSL, trilinear)
+    clobber : bool
+        re-run even if outname is newer than infile, warp and premat
+
+    Returns
+    -------
+    warped : str or None
+        outname, None if failed
+    """
+    transform = get_transform(regdir)
+    if transform is None:
+        return None
+    warp, premat = transform
+    if not clobber and is_current(outname, [infile, warp, premat]):
+        return outname
+    from nipype.interfaces.fsl import ApplyWarp
     mywarp = ApplyWarp()
     mywarp.inputs.in_file = infile
     mywarp.inputs.ref_file = ref
     mywarp.inputs.field_file = warp
     mywarp.inputs.premat = premat
-    warpout = mywarp.run()
-    os.chdir(startdir)
+    mywarp.inputs.out_file = outname
+    if interp is not None:
+        mywarp.inputs.interp = interp
+    warpout = tracing.run_command(mywarp)
     if warpout.runtime.returncode == 0:
         #apply warp successful
         warped = warpout.outputs.out_file
@@ -35,19 +80,139 @@ def applywarp(infile, ref, regdir, outname):
         return None
 
 
+def native_warp(infile, ref, regdir, outname, clobber=False, nproc=1):
+    """
+    trilinear warp of infile to ref without FSL, through the cached
+    composed transform of regdir (see resample.resample_series)
+
+    Returns
+    -------
+    warped : str or None
+        outname, None if failed
+    """
+    transform = get_transform(regdir)
+    if transform is None:
+        return None
+    if not clobber and is_current(outname, [infile] + list(transform)):
+        return outname
+    return resample.resample_series(infile, regdir, ref, outname,
+                                    nproc=nproc)
+
+
+@tracing.traced(subject=lambda callargs: callargs['job'][0])
+def warp_subject(job, ref, clobber=False, native=False):
+    """
+    apply one subject's transform to all of its images
+
+    Parameters
+    ----------
+    job : tuple
+        (subid, regdir, images), images is a list of
+        (infile, outname, interp) for functional data, masks, seeds, ...
+    ref : str
+        reference (standard space) image
+    native : bool
+        warp trilinear images with native_warp instead of FSL applywarp
+
+    Returns
+    -------
+    subid : str
+    warped : list
+        outname (or None if failed) for each of images
+    """
+    subid, regdir, images = job
+    warped = []
+    for infile, outname, interp in images:
+        try:
+            if native and interp in (None, 'trilinear'):
+                warped.append(native_warp(infile, ref, regdir, outname,
+                                          clobber))
+            else:
+                warped.append(applywarp(infile, ref, regdir, outname,
+                                        interp, clobber))
+        except Exception, err:
+            print '%s: %s failed %s'%(subid, infile, err)
+            warped.append(None)
+    return subid, warped
+
+
+def batch_applywarp(jobs, ref, nproc=4, clobber=False, native=False):
+    """
+    warp the images of many subjects, one job per subject (see
+    warp_subject), at most nproc applywarp processes at a time
+
+    Returns
+    -------
+    warped : dict
+        {subid : list of outnames (None if failed)}
+    """
+    if nproc > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(nproc, len(jobs)))
+        try:
+            results = pool.map(lambda job: warp_subject(job, ref, clobber,
+                                                        native), jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [warp_subject(job, ref, clobber, native) for job in jobs]
+    return dict(results)
+
+
+def find_jobs(basedir, outdir, restglob='4d*.feat/filtered_func_data.nii.gz',
+              subglob='B*', extras=()):
+    """
+    one job per subject (see warp_subject) from a single glob over
+    <basedir>/<subglob>/<restglob>, the first (sorted) match of a subject
+    with several
+
+    Parameters
+    ----------
+    extras : list
+        (glob relative to the feat directory, outname suffix, interp) of
+        additional images (eg. masks, seeds) warped with the same transform
+
+    Returns
+    -------
+    jobs : list
+        (subid, regdir, images) tuples, sorted by subid; the functional
+        data is saved to <outdir>/<subid>_rest_3mm.nii.gz
+    """
+    jobs = []
+    subids = set()
+    for resting in sorted(glob(os.path.join(basedir, subglob, restglob))):
+        restdir, _ = os.path.split(resting)
+        subid = os.path.relpath(resting, basedir).split(os.sep)[0]
+        if subid in subids:
+            # outputs are named by subject
+            continue
+        subids.add(subid)
+        regdir = os.path.join(restdir, 'reg')
+        images = [(resting,
+                   os.path.join(outdir, '%s_rest_3mm.nii.gz'%(subid)),
+                   None)]
+        for extraglob, suffix, interp in extras:
+            for f in sorted(glob(os.path.join(restdir, extraglob))):
+                nme = os.path.split(f)[1].split('.')[0]
+                images.append((f, os.path.join(outdir, '%s_%s_%s.nii.gz'%(
+                    subid, nme, suffix)), interp))
+        jobs.append((subid, regdir, images))
+    return jobs
+
+
 if __name__ == '__main__':
 
 
     template = '/home/jagust/pib_bac/ica/data/templates/MNI152_T1_3mm_brain.nii.gz'
-    allsubs = glob('/home/jagust/pib_bac/ica/data/fromBeth/B*')
+    basedir = '/home/jagust/pib_bac/ica/data/fromBeth'
 
     outdir = '/home/jagust/pib_bac/ica/data/tr189_melodic'
+    # masks are warped with nearest neighbour interpolation
+    extras = [('mask.nii.gz', '3mm', 'nn')]
+    nproc = 4
 
-    for item in allsubs:
-        subid = item.split('/')[-1]
-        resting = glob('%s/4d*.feat/filtered_func_data.nii.gz'%(item))[0]
-        restdir, _ = os.path.split(resting)
-        regdir = os.path.join(restdir, 'reg')
-        outfile = os.path.join(outdir, '%s_rest_3mm.nii.gz'%(subid))
-        warped = applywarp(resting, template, regdir, outfile)
-        
+    jobs = find_jobs(basedir, outdir, extras=extras)
+    warped = batch_applywarp(jobs, template, nproc=nproc)
+    for subid, outfiles in sorted(warped.items()):
+        if None in outfiles:
+            print '%s: warp failed'%(subid)
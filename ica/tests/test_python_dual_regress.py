@@ -104,3 +104,36 @@ def test_create_common_mask():
     newmask = pydr.create_common_mask([infile,], outdir)
     assert_equal(ni.load(realmask).get_data(), ni.load(newmask).get_data())
     clean_tmpdir(outdir)
+
+def test_relative_paths():
+    # fsl_glm runs in outdir, relative inputs are passed as absolute
+    # paths (a script standing in for fsl_glm records its arguments)
+    tmpdir = tmp_outdir()
+    bindir = join(tmpdir, 'bin')
+    os.mkdir(bindir)
+    argfile = join(tmpdir, 'args.txt')
+    script = join(bindir, 'fsl_glm')
+    with open(script, 'w') as fid:
+        fid.write('#!/bin/sh\necho "$@" > %s\n'%argfile)
+    os.chmod(script, 0755)
+    os.mkdir(join(tmpdir, 'out'))
+    path, startdir = os.environ['PATH'], os.getcwd()
+    os.environ['PATH'] = os.pathsep.join([bindir, path])
+    os.chdir(tmpdir)
+    try:
+        outf = pydr.template_timeseries_sub('B00-000_func.nii.gz',
+                                            'template.nii.gz', 'mask.nii.gz',
+                                            'out')
+    finally:
+        os.chdir(startdir)
+        os.environ['PATH'] = path
+    tmpdir = os.path.realpath(tmpdir)
+    assert_equal(os.path.realpath(outf),
+                 join(tmpdir, 'out', 'dr_stage1_B00-000.txt'))
+    args = open(argfile).read().split()
+    for flag, fname in [('-i', 'B00-000_func'), ('-d', 'template.nii.gz'),
+                        ('-m', 'mask.nii.gz')]:
+        value = args[args.index(flag) + 1]
+        assert_equal(os.path.isabs(value), True)
+        assert_equal(os.path.realpath(value), join(tmpdir, fname))
+    clean_tmpdir(tmpdir)
@@ -0,0 +1,136 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as ni
+from scipy import ndimage
+from numpy.testing import (assert_equal, assert_almost_equal)
+from .. import resample
+
+
+def make_reg(outdir, prng):
+    """ example_func (4D), ref and reg directory with a shift premat and a
+    smooth displacement field"""
+    func_aff = np.diag([-3., 3, 3, 1])
+    func_aff[:3, 3] = [30, -40, -20]
+    dat = prng.rand(12, 13, 10, 7).astype(np.float32) * 100
+    funcfile = join(outdir, 'filtered_func_data.nii.gz')
+    img = ni.Nifti1Image(dat, func_aff)
+    img.get_header().set_zooms((3, 3, 3, 2))
+    img.to_filename(funcfile)
+    ref_aff = np.diag([2., 2, 2, 1])
+    ref = join(outdir, 'ref.nii.gz')
+    ni.Nifti1Image(np.zeros((15, 18, 14)), ref_aff).to_filename(ref)
+    regdir = join(outdir, 'reg')
+    os.mkdir(regdir)
+    premat = np.eye(4)
+    premat[:3, 3] = [1.5, -2, 1]
+    np.savetxt(join(regdir, 'example_func2highres.mat'), premat)
+    field = np.zeros((15, 18, 14, 3), dtype=np.float32)
+    field[..., 0] = np.linspace(-1, 1, 15)[:, None, None]
+    field[..., 2] = .5
+    warp = ni.Nifti1Image(field, ref_aff)
+    warp.get_header()['intent_code'] = 2006
+    warp.to_filename(join(regdir, 'highres2standard_warp.nii.gz'))
+    return funcfile, ref, regdir, dat, premat, field
+
+
+def test_fsl_vox2mm():
+    img = ni.Nifti1Image(np.zeros((10, 4, 4)), np.diag([2., 2, 2, 1]))
+    vox2mm = resample.fsl_vox2mm(img)
+    assert_almost_equal(np.dot(vox2mm, [0, 1, 2, 1]), [18, 2, 4, 1])
+    img = ni.Nifti1Image(np.zeros((10, 4, 4)), np.diag([-2., 2, 2, 1]))
+    vox2mm = resample.fsl_vox2mm(img)
+    assert_almost_equal(np.dot(vox2mm, [0, 1, 2, 1]), [0, 2, 4, 1])
+
+
+def test_resample_series():
+    prng = np.random.RandomState(0)
+    outdir = mkdtemp()
+    funcfile, ref, regdir, dat, premat, field = make_reg(outdir, prng)
+    outfile = resample.resample_series(funcfile, regdir, ref,
+                                       join(outdir, 'rest_std.nii.gz'),
+                                       chunk_size=3, nproc=2)
+    res = ni.load(outfile)
+    assert_equal(res.shape, (15, 18, 14, 7))
+    assert_almost_equal(res.get_affine(), np.diag([2., 2, 2, 1]))
+    # reference, explicit composition and scipy trilinear interpolation
+    func_img, ref_img = ni.load(funcfile), ni.load(ref)
+    grid = np.indices((15, 18, 14)).reshape((3, -1))
+    ref_mm = np.dot(resample.fsl_vox2mm(ref_img),
+                    np.vstack((grid, np.ones(grid.shape[1]))))
+    ref_mm[:3] += field.reshape((-1, 3)).T
+    func_mm = np.dot(np.linalg.inv(premat), ref_mm)
+    coords = np.dot(np.linalg.inv(resample.fsl_vox2mm(func_img)), func_mm)
+    inside = np.all((coords[:3] >= 0) &
+                    (coords[:3] <= np.array([11, 12, 9])[:, None]), axis=0)
+    resdat = res.get_data().reshape((-1, 7))
+    for t in [0, 6]:
+        expected = ndimage.map_coordinates(dat[..., t], coords[:3], order=1)
+        assert_almost_equal(resdat[inside, t], expected[inside], decimal=3)
+        assert_equal(resdat[~inside, t], 0)
+    # coordinate map is cached and reused
+    cached = [f for f in os.listdir(regdir) if f.startswith('func2standard')]
+    assert_equal(len(cached), 1)
+    outfile2 = resample.resample_series(funcfile, regdir, ref,
+                                        join(outdir, 'rest_std2.nii'))
+    assert_almost_equal(ni.load(outfile2).get_data(), res.get_data(),
+                        decimal=4)
+    os.system('rm -rf %s'%outdir)
+
+
+def test_native_warp():
+    from .. import rest_2_3mm
+    prng = np.random.RandomState(1)
+    outdir = mkdtemp()
+    funcfile, ref, regdir, dat, premat, field = make_reg(outdir, prng)
+    outname = join(outdir, 'rest_3mm.nii.gz')
+    jobs = [('B01-001', regdir, [(funcfile, outname, None)])]
+    warped = rest_2_3mm.batch_applywarp(jobs, ref, native=True)
+    assert_equal(warped['B01-001'], [outname])
+    assert_equal(ni.load(outname).shape, (15, 18, 14, 7))
+    os.system('rm -rf %s'%outdir)
+
+
+def test_load_displacement():
+    prng = np.random.RandomState(2)
+    outdir = mkdtemp()
+    funcfile, ref, regdir, dat, premat, field = make_reg(outdir, prng)
+    fieldsrc = join(regdir, 'highres2standard_warp.nii.gz')
+    assert_almost_equal(resample.load_displacement(fieldsrc, ref), field)
+    # coefficient file, converted by fnirtfileutils (a script standing
+    # in for FSL that records its arguments and writes the field)
+    warpfile = join(outdir, 'coef_warp.nii.gz')
+    coef = ni.Nifti1Image(np.zeros((4, 5, 4, 3), dtype=np.float32),
+                          np.eye(4))
+    coef.get_header()['intent_code'] = 2007
+    coef.to_filename(warpfile)
+    bindir = join(outdir, 'bin')
+    os.mkdir(bindir)
+    argfile = join(outdir, 'args.txt')
+    script = join(bindir, 'fnirtfileutils')
+    with open(script, 'w') as fid:
+        fid.write('\n'.join(['#!/bin/sh',
+                             'echo "$@" >> %s'%argfile,
+                             'while [ $# -gt 0 ]; do',
+                             '  if [ "$1" = "-o" ]; then out=$2; fi',
+                             '  shift',
+                             'done',
+                             'cp %s $out'%fieldsrc, '']))
+    os.chmod(script, 0755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = os.pathsep.join([bindir, path])
+    try:
+        disp = resample.load_displacement(warpfile, ref)
+        # converted once
+        disp = resample.load_displacement(warpfile, ref)
+    finally:
+        os.environ['PATH'] = path
+    assert_almost_equal(disp, field)
+    fieldfile = join(outdir, 'coef_warp_field.nii.gz')
+    args = open(argfile).read().splitlines()
+    assert_equal(args, ['-i %s -r %s -o %s --withaff'%(warpfile, ref,
+                                                       fieldfile)])
+    os.system('rm -rf %s'%outdir)
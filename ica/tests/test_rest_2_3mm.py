@@ -0,0 +1,67 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+from numpy.testing import assert_equal
+from .. import rest_2_3mm
+
+
+def touch(filename, mtime):
+    open(filename, 'a').close()
+    os.utime(filename, (mtime, mtime))
+
+
+def make_subjects(basedir, subids):
+    for subid in subids:
+        regdir = join(basedir, subid, '4d_rest.feat', 'reg')
+        os.makedirs(regdir)
+        featdir = join(basedir, subid, '4d_rest.feat')
+        touch(join(featdir, 'filtered_func_data.nii.gz'), 1000)
+        touch(join(featdir, 'mask.nii.gz'), 1000)
+        touch(join(regdir, 'highres2standard_warp.nii.gz'), 1000)
+        touch(join(regdir, 'example_func2highres.mat'), 1000)
+
+
+def test_find_jobs():
+    basedir = mkdtemp()
+    make_subjects(basedir, ['B01-002', 'B01-001'])
+    # a second feat directory of a subject is not a second job
+    os.makedirs(join(basedir, 'B01-001', '4d_rest2.feat'))
+    touch(join(basedir, 'B01-001', '4d_rest2.feat',
+               'filtered_func_data.nii.gz'), 1000)
+    outdir = join(basedir, 'out')
+    jobs = rest_2_3mm.find_jobs(basedir, outdir,
+                                extras=[('mask.nii.gz', '3mm', 'nn')])
+    assert_equal([job[0] for job in jobs], ['B01-001', 'B01-002'])
+    subid, regdir, images = jobs[0]
+    assert_equal(regdir, join(basedir, subid, '4d_rest.feat', 'reg'))
+    assert_equal(images[0][1], join(outdir, 'B01-001_rest_3mm.nii.gz'))
+    assert_equal(images[1][1:], (join(outdir, 'B01-001_mask_3mm.nii.gz'),
+                                 'nn'))
+    os.system('rm -rf %s'%basedir)
+
+
+def test_batch_applywarp_current():
+    basedir = mkdtemp()
+    make_subjects(basedir, ['B01-001', 'B01-002'])
+    outdir = join(basedir, 'out')
+    os.mkdir(outdir)
+    jobs = rest_2_3mm.find_jobs(basedir, outdir)
+    # outputs newer than inputs and transforms are not re-run
+    for _, _, images in jobs:
+        for _, outname, _ in images:
+            touch(outname, 2000)
+    warped = rest_2_3mm.batch_applywarp(jobs, 'ref.nii.gz', nproc=2)
+    assert_equal(warped['B01-002'],
+                 [join(outdir, 'B01-002_rest_3mm.nii.gz')])
+    assert_equal(rest_2_3mm.is_current(join(outdir, 'B01-002_rest_3mm.nii.gz'),
+                                       [jobs[1][2][0][0]]), True)
+    touch(jobs[1][2][0][0], 3000)
+    assert_equal(rest_2_3mm.is_current(join(outdir, 'B01-002_rest_3mm.nii.gz'),
+                                       [jobs[1][2][0][0]]), False)
+    # missing transform
+    os.remove(join(jobs[0][1], 'example_func2highres.mat'))
+    warped = rest_2_3mm.batch_applywarp(jobs[:1], 'ref.nii.gz')
+    assert_equal(warped['B01-001'], [None])
+    os.system('rm -rf %s'%basedir)
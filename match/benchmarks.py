@@ -0,0 +1,244 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Timing and accuracy benchmarks for the matching metrics
+
+Synthetic component and template stacks are generated, each metric is
+timed both as the scalar function looped over all pairs and as the
+all-pairs (vectorized) function, and the vectorized results are checked
+against the scalar calc_eta, calc_gof and dice_coefficient.
+
+Timings can be saved as a baseline (json) and later runs compared to it
+
+python benchmarks.py -save baseline.json
+python benchmarks.py -compare baseline.json
+"""
+import os, sys
+import json
+import time
+import argparse
+import numpy as np
+import matching
+import reproducibility
+
+
+def make_synthetic(shape=(40, 48, 40), ncomp=30, ntemplate=10, seed=0):
+    """
+    Generate synthetic z-scored components, binary templates and mask
+
+    each template is a smoothed random blob field, thresholded, and half
+    of the components are noisy copies of a template
+
+    Returns
+    -------
+    components : array
+        4D (shape + (ncomp,)) array of z-scored components
+    templates : array
+        4D (shape + (ntemplate,)) binary array of template networks
+    mask : array
+        3D boolean brain mask (ellipsoid)
+    """
+    prng = np.random.RandomState(seed)
+    grid = np.indices(shape).astype(float)
+    centre = (np.array(shape, dtype=float)[:, None, None, None] - 1) / 2.
+    radius = np.array(shape, dtype=float)[:, None, None, None] / 2.
+    mask = (((grid - centre) / radius)**2).sum(0) <= 1
+    templates = np.zeros(shape + (ntemplate,))
+    for i in range(ntemplate):
+        blobs = np.zeros(shape)
+        for centre in prng.rand(3, 3) * np.array(shape)[:, None]:
+            dist = ((grid - centre[:, None, None, None])**2).sum(0)
+            blobs += np.exp(-dist / (2 * (min(shape) / 8.)**2))
+        templates[..., i] = blobs > .5
+    components = prng.randn(*(shape + (ncomp,)))
+    for i in range(min(ncomp // 2, ntemplate)):
+        components[..., i] += 3 * templates[..., i]
+    components = (components - components.mean(axis=3)[..., None]) / \
+                 components.std(axis=3)[..., None]
+    return components, templates, mask
+
+
+def time_call(func, args=(), repeat=3):
+    """ best wall time (seconds) over repeat calls of func(*args),
+    and the result of the last call"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.time()
+        result = func(*args)
+        best = min(best, time.time() - start)
+    return best, result
+
+
+def scalar_eta(a, b):
+    return np.array([[matching.calc_eta(x, y) for y in b] for x in a])
+
+
+def scalar_gof(a, b):
+    mask = np.ones(a.shape[1])
+    return np.array([[matching.calc_gof(x, y, mask) for y in b] for x in a])
+
+
+def scalar_dice(a, b):
+    return np.array([[matching.dice_coefficient(x, y) for y in b]
+                     for x in a])
+
+
+def scalar_corr(a, b):
+    return np.array([[np.corrcoef(x, y)[0, 1] for y in b] for x in a])
+
+
+def scalar_sweep(input, template, thresholds):
+    dice, gof = [], []
+    for thr in thresholds:
+        network = ((template >= thr) & (template > 0)).astype(float)
+        gof.append(matching.calc_gof(input, network, np.ones(input.shape)))
+        dice.append(matching.dice_coefficient(network,
+                                              (input > 0).astype(float)))
+    return np.array(dice), np.array(gof)
+
+
+def get_metric_pairs(components, templates, mask, thresholds):
+    """ return {name : (scalar_call, vectorized_call)}, each call
+    a (function, args) tuple returning comparable arrays"""
+    comps = matching.get_masked_rows(components, mask)
+    temps = matching.get_masked_rows(templates, mask)
+    regions = (comps > 2).astype(float)
+    sweep_input = comps[0]
+    sweep_template = comps[1] + 2 * temps[0]
+    pairs = {
+        'eta': ((scalar_eta, (comps, temps)),
+                (matching.calc_eta_matrix, (comps, temps))),
+        'gof': ((scalar_gof, (comps, temps)),
+                (matching.calc_gof_matrix, (comps, temps))),
+        'dice': ((scalar_dice, (regions, temps)),
+                 (matching.dice_matrix, (regions, temps))),
+        'corr': ((scalar_corr, (comps, temps)),
+                 (reproducibility.correlation_matrix, (comps, temps))),
+        'threshold_sweep': (
+            (scalar_sweep, (sweep_input, sweep_template, thresholds)),
+            (lambda *args: matching.threshold_sweep(*args)[:2],
+             (sweep_input, sweep_template, thresholds)))}
+    return pairs
+
+
+def run_benchmarks(shape=(40, 48, 40), ncomp=30, ntemplate=10,
+                   nthresh=20, repeat=3, seed=0, tol=1e-8):
+    """
+    Time every metric (scalar over all pairs and vectorized), and check
+    vectorized results agree with scalar results to tol
+
+    Returns
+    -------
+    results : dict
+        {metric: {'scalar': seconds, 'vectorized': seconds,
+                  'speedup': scalar / vectorized, 'max_abs_diff': float}}
+        plus 'config' describing the synthetic data
+
+    Raises
+    ------
+    AssertionError if a vectorized result differs from the scalar result
+    by more than tol
+    """
+    components, templates, mask = make_synthetic(shape, ncomp, ntemplate,
+                                                 seed)
+    thresholds = np.linspace(0, 3, nthresh)
+    results = {'config': {'shape': list(shape), 'ncomp': ncomp,
+                          'ntemplate': ntemplate, 'nthresh': nthresh,
+                          'nvoxels': int(mask.sum()), 'seed': seed}}
+    pairs = get_metric_pairs(components, templates, mask, thresholds)
+    for name, ((sfunc, sargs), (vfunc, vargs)) in sorted(pairs.items()):
+        stime, sres = time_call(sfunc, sargs, repeat=1)
+        vtime, vres = time_call(vfunc, vargs, repeat=repeat)
+        diff = np.nanmax(np.abs(np.array(sres) - np.array(vres)))
+        if diff > tol:
+            raise AssertionError('%s: vectorized differs from scalar '
+                                 'by %g (tol %g)'%(name, diff, tol))
+        results[name] = {'scalar': stime, 'vectorized': vtime,
+                         'speedup': stime / max(vtime, 1e-9),
+                         'max_abs_diff': float(diff)}
+    return results
+
+
+def save_baseline(results, outfile):
+    """ write benchmark results to json file outfile"""
+    with open(outfile, 'w+') as fid:
+        json.dump(results, fid, indent=2, sort_keys=True)
+    return os.path.abspath(outfile)
+
+
+def compare_baseline(results, baseline, slowdown=1.5):
+    """
+    compare vectorized timings in results to those in baseline
+
+    Parameters
+    ----------
+    results : dict
+        output of run_benchmarks
+    baseline : str or dict
+        json file written by save_baseline (or its contents)
+    slowdown : float
+        ratio of new / baseline time considered a regression (default 1.5)
+
+    Returns
+    -------
+    regressions : dict
+        {metric: (baseline_seconds, new_seconds)} for metrics slower
+        than slowdown * baseline
+    """
+    if isinstance(baseline, basestring):
+        baseline = json.load(open(baseline))
+    if not baseline.get('config') == results.get('config'):
+        raise ValueError('baseline config %s does not match %s'%(
+            baseline.get('config'), results.get('config')))
+    regressions = {}
+    for name, res in results.items():
+        if name == 'config' or name not in baseline:
+            continue
+        old = baseline[name]['vectorized']
+        if res['vectorized'] > slowdown * old:
+            regressions[name] = (old, res['vectorized'])
+    return regressions
+
+
+def print_results(results):
+    print 'config: %s'%(results['config'])
+    print '%-16s %10s %10s %8s %10s'%('metric', 'scalar', 'vector',
+                                      'speedup', 'max diff')
+    for name, res in sorted(results.items()):
+        if name == 'config':
+            continue
+        print '%-16s %10.4f %10.4f %8.1f %10.2g'%(name, res['scalar'],
+                                                  res['vectorized'],
+                                                  res['speedup'],
+                                                  res['max_abs_diff'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Time matching metrics on synthetic data and check '+\
+        'vectorized results against scalar results')
+    parser.add_argument('-shape', type=int, nargs=3, default=[40, 48, 40],
+                        help='shape of synthetic volumes (default 40 48 40)')
+    parser.add_argument('-ncomp', type=int, default=30,
+                        help='number of components (default 30)')
+    parser.add_argument('-ntemplate', type=int, default=10,
+                        help='number of templates (default 10)')
+    parser.add_argument('-repeat', type=int, default=3,
+                        help='repeats of each vectorized call (default 3)')
+    parser.add_argument('-save', dest='save', default=None,
+                        help='save timings to this json baseline file')
+    parser.add_argument('-compare', dest='compare', default=None,
+                        help='compare timings to this json baseline file')
+    args = parser.parse_args()
+    results = run_benchmarks(tuple(args.shape), args.ncomp, args.ntemplate,
+                             repeat=args.repeat)
+    print_results(results)
+    if args.save:
+        print 'wrote %s'%(save_baseline(results, args.save))
+    if args.compare:
+        regressions = compare_baseline(results, args.compare)
+        for name, (old, new) in sorted(regressions.items()):
+            print 'REGRESSION %s: %2.4f -> %2.4f'%(name, old, new)
+        if regressions:
+            sys.exit(1)
@@ -2,10 +2,10 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
 from glob import glob
+from multiprocessing import Pool
 import numpy as np
 import nibabel as ni
-from scipy.ndimage import affine_transform
-from scipy.stats import pearsonr
+from _tools_path import imgio, tracing
 
 def reslice_data(img, change_dat, change_aff):
     """ reslices data in space_define_file to matrix of
@@ -26,6 +26,7 @@ def reslice_data(img, change_dat, change_aff):
     
     Tv = np.dot(np.linalg.inv(change_aff), 
                 np.dot(T, img.get_affine()))
+    from scipy.ndimage import affine_transform
     data = affine_transform(change_dat.squeeze(), 
                             Tv[0:3,0:3], 
                             offset=Tv[0:3,3], 
@@ -39,11 +40,11 @@ def get_graymask(infile, threshold=.2):
     thresholds at threshold (default .2), binarizes
     return new nibabel image (not saved)
     """
-    img = ni.load(infile)
-    dat = img.get_data()
-    dat[dat < threshold] = 0
-    dat[dat >= threshold] = 1
-    newimg = ni.Nifti1Image(dat, img.get_affine(),  ni.Nifti1Header())
+    img = imgio.load(infile)
+    dat = np.asarray(img.dataobj)
+    # out of place, do not modify data nibabel may have cached
+    dat = (dat >= threshold).astype(dat.dtype)
+    newimg = ni.Nifti1Image(dat, img.get_affine(), img.get_header())
     return newimg
 
 def calc_eta(a, b, getr = False):
@@ -84,6 +85,7 @@ def calc_eta(a, b, getr = False):
     eta = 1 - (SSW.sum() / SST.sum())
 
     if getr:
+        from scipy.stats import pearsonr
         outr = pearsonr(a,b)
         return (eta, outr)
     else:
@@ -106,6 +108,32 @@ def dice_coefficient(regiona, regionb):
     return numerator / float(denominator)
 
 
+def dice_matrix(a, b):
+    """ dice coefficient between every row of a and every row of b
+    (see dice_coefficient)
+
+    Parameters
+    ----------
+    a : array
+        n X nvoxels array of (binary) regions
+    b : array
+        m X nvoxels array of (binary) regions
+
+    Returns
+    -------
+    dice : array
+        n X m array of dice coefficients
+    """
+    a = np.atleast_2d(np.asarray(a, dtype=np.float64))
+    b = np.atleast_2d(np.asarray(b, dtype=np.float64))
+    if not a.shape[1] == b.shape[1]:
+        raise IOError("shape mismatch a(%d) , b(%d)"%(a.shape[1],
+                                                      b.shape[1]))
+    numerator = 2 * np.dot(a, b.T)
+    denominator = a.sum(1)[:, np.newaxis] + b.sum(1)[np.newaxis, :]
+    return numerator / denominator
+
+
 def calc_gof(input, template, mask):
     """
     Calc Goodness of Fit or
@@ -138,18 +166,454 @@ def calc_gof(input, template, mask):
     return gof
 
 
+def get_masked_rows(dat, mask=None):
+    """ return 3D or 4D array dat as a nvolumes X nvoxels array,
+    restricted to voxels where mask > 0 (if mask is not None)"""
+    dat = np.asarray(dat)
+    if mask is None:
+        mask = np.ones(dat.shape[:3], dtype=bool)
+    if not dat.shape[:3] == mask.shape:
+        raise IOError('shape mismatch, data: %s, mask: %s'%(dat.shape[:3],
+                                                            mask.shape))
+    rows = dat[mask > 0]
+    if rows.ndim == 1:
+        return rows[np.newaxis, :]
+    return rows.T
+
+
+def _eta_from_dot(ab, aa, bb, sa, sb, nvox):
+    """ cohen's eta from dot products and sums of a (rows) and b (columns)
+    SSW = sum((a-b)**2) / 2, SST = sum of squares about the grand mean"""
+    ssw = (aa[:, np.newaxis] + bb[np.newaxis, :] - 2 * ab) / 2.
+    sst = aa[:, np.newaxis] + bb[np.newaxis, :] - \
+          (sa[:, np.newaxis] + sb[np.newaxis, :])**2 / (2. * nvox)
+    return 1 - ssw / sst
+
+
+def calc_eta_matrix(a, b):
+    """
+    Cohen's eta between every row of a and every row of b
+    (see calc_eta)
+
+    Parameters
+    ----------
+    a : array
+        n X nvoxels array (eg. components)
+    b : array
+        m X nvoxels array (eg. template networks)
+
+    Returns
+    -------
+    eta : array
+        n X m array of cohen's eta
+    """
+    a = np.atleast_2d(np.asarray(a, dtype=np.float64))
+    b = np.atleast_2d(np.asarray(b, dtype=np.float64))
+    if not a.shape[1] == b.shape[1]:
+        raise IOError("shape mismatch a(%d) , b(%d)"%(a.shape[1],
+                                                      b.shape[1]))
+    return _eta_from_dot(np.dot(a, b.T), (a**2).sum(1), (b**2).sum(1),
+                         a.sum(1), b.sum(1), a.shape[1])
+
+
+def _gof_from_dot(netsum, nonsum, netn, nonn):
+    return netsum / netn - nonsum / nonn
+
+
+def calc_gof_matrix(input, template):
+    """
+    Goodness of fit between every row of input and every row of template
+    (see calc_gof)
+
+    Parameters
+    ----------
+    input : array
+        n X nvoxels array of z-transformed networks (already masked)
+    template : array
+        m X nvoxels array of template networks, voxels > 0 are in network
+        voxels == 0 are outside network
+
+    Returns
+    -------
+    gof : array
+        n X m array of goodness of fit
+    """
+    input = np.atleast_2d(np.asarray(input, dtype=np.float64))
+    template = np.atleast_2d(template)
+    if not input.shape[1] == template.shape[1]:
+        raise IOError("shape mismatch input(%d) , template(%d)"%(
+            input.shape[1], template.shape[1]))
+    network = (template > 0).astype(np.float64)
+    non_network = (template == 0).astype(np.float64)
+    return _gof_from_dot(np.dot(input, network.T),
+                         np.dot(input, non_network.T),
+                         network.sum(1), non_network.sum(1))
+
+
+def permutation_indices(nperm, nvox, prng, blocks=None):
+    """
+    Generate permutations of voxel indices
+
+    Parameters
+    ----------
+    nperm : int
+        number of permutations
+    nvox : int
+        number of voxels
+    prng : numpy.random.RandomState
+        random number generator
+    blocks : array or None
+        block label of each voxel, if given whole blocks are shuffled
+        (voxels keep their order within a block) to preserve local
+        spatial structure, else voxels are shuffled independently
+
+    Returns
+    -------
+    perms : array
+        nperm X nvox array, row p maps voxel v to voxel perms[p, v]
+    """
+    if blocks is None:
+        return np.array([prng.permutation(nvox) for _ in range(nperm)])
+    labels, blocks = np.unique(blocks, return_inverse=True)
+    order = np.argsort(blocks, kind='mergesort')
+    within = np.empty(nvox, dtype=np.int64)
+    within[order] = np.arange(nvox)
+    ranks = np.array([prng.permutation(len(labels)) for _ in range(nperm)])
+    keys = ranks[:, blocks] * nvox + within[np.newaxis, :]
+    perms = np.empty((nperm, nvox), dtype=np.int64)
+    perms[:, order] = np.argsort(keys, axis=1)
+    return perms
+
+
+def spatial_blocks(mask, block_size):
+    """ label masked voxels by the cube of block_size voxels (per side)
+    they fall in, for use with permutation_indices"""
+    coords = np.array(np.nonzero(mask > 0)) // block_size
+    nblocks = np.array(mask.shape) // block_size + 1
+    return np.ravel_multi_index(coords, nblocks)
+
+
+# state shared with worker processes, set by _init_perm_worker
+_perm_state = {}
+
+
+def _init_perm_worker(state):
+    _perm_state.update(state)
+
+
+def permuted_dot(a, b, perms, maxbytes=2**26):
+    """
+    dot(a, b[:, perm].T) for every perm in perms, computed in batches of
+    permutations as single matrix products of at most maxbytes
+
+    Permuting b by perm gives the same products as permuting a by the
+    inverse of perm, so the array with fewer rows is the one permuted.
+
+    Returns
+    -------
+    dots : array
+        a.shape[0] X b.shape[0] X nperm array
+    """
+    nperm, nvox = perms.shape
+    swap = a.shape[0] < b.shape[0]
+    if swap:
+        a, b, perms = b, a, np.argsort(perms, axis=1)
+    step = max(1, maxbytes // (b.shape[0] * nvox * b.itemsize))
+    dots = np.empty((a.shape[0], b.shape[0], nperm))
+    for start in range(0, nperm, step):
+        bp = b[:, perms[start:start + step]].reshape((-1, nvox))
+        dots[:, :, start:start + step] = np.dot(a, bp.T).reshape(
+            (a.shape[0], b.shape[0], -1))
+    if swap:
+        dots = dots.transpose((1, 0, 2))
+    return dots
+
+
+def _perm_null(args):
+    """ null distribution for nperm permutations of the template voxels,
+    returns n X m X nperm array"""
+    seed, nperm = args
+    st = _perm_state
+    nvox = st['a'].shape[1]
+    prng = np.random.RandomState(seed)
+    perms = permutation_indices(nperm, nvox, prng, st['blocks'])
+    dots = permuted_dot(st['a'], st['b'], perms)
+    if st['metric'] == 'eta':
+        return _eta_from_dot(dots, st['aa'][:, np.newaxis],
+                             st['bb'][:, np.newaxis], st['sa'][:, np.newaxis],
+                             st['sb'][:, np.newaxis], nvox)
+    netn = st['netn'].shape[0]
+    if dots.shape[1] > netn:
+        nonsum = dots[:, netn:]
+    else:
+        # binary template, non network sum is the rest of the input sum
+        nonsum = st['sa'][:, np.newaxis, np.newaxis] - dots
+    return _gof_from_dot(dots[:, :netn], nonsum, st['netn'][:, np.newaxis],
+                         st['nonn'][:, np.newaxis])
+
+
+@tracing.traced()
+def permutation_test(input, template, mask=None, metric='gof', nperm=1000,
+                     block_size=None, seed=None, nproc=1, chunk_size=100):
+    """
+    Permutation p-values of gof or eta for every input X template pair
+
+    The null distribution is built by permuting (or block shuffling)
+    template voxels within mask, each permutation is evaluated for all
+    pairs at once as a matrix product.
+
+    Parameters
+    ----------
+    input : array
+        3D or 4D array of (unthresholded, z-transformed) networks,
+        last axis indexes networks (eg. components)
+    template : array
+        3D or 4D array of template networks, last axis indexes templates
+        (binary for gof)
+    mask : array or None
+        3D array restricting voxels for comparison
+    metric : str
+        'gof' (see calc_gof) or 'eta' (see calc_eta)
+    nperm : int
+        number of permutations (default 1000)
+    block_size : int or None
+        if set, shuffle cubes of block_size voxels per side instead of
+        single voxels, preserving spatial smoothness of the template
+    seed : int or None
+        seed for the random number generator, for reproducible p-values
+        (results do not depend on nproc)
+    nproc : int
+        number of processes (default 1)
+    chunk_size : int
+        number of permutations computed per job (default 100)
+
+    Returns
+    -------
+    observed : array
+        ninput X ntemplate array of the metric
+    pvals : array
+        ninput X ntemplate array of one sided (greater) p-values
+    null : array
+        ninput X ntemplate X nperm array holding the null distribution
+    """
+    if not metric in ('gof', 'eta'):
+        raise ValueError('metric must be gof or eta, not %s'%metric)
+    if mask is None:
+        mask = np.ones(np.asarray(input).shape[:3], dtype=bool)
+    a = get_masked_rows(input, mask).astype(np.float64)
+    b = get_masked_rows(template, mask)
+    state = {'metric': metric, 'a': a, 'blocks': None}
+    if block_size is not None:
+        state['blocks'] = spatial_blocks(mask, block_size)
+    if metric == 'eta':
+        b = b.astype(np.float64)
+        observed = calc_eta_matrix(a, b)
+        state.update({'b': b, 'aa': (a**2).sum(1), 'bb': (b**2).sum(1),
+                      'sa': a.sum(1), 'sb': b.sum(1)})
+    else:
+        observed = calc_gof_matrix(a, b)
+        network = (b > 0).astype(np.float64)
+        non_network = (b == 0).astype(np.float64)
+        state.update({'b': network, 'sa': a.sum(1),
+                      'netn': network.sum(1), 'nonn': non_network.sum(1)})
+        if (b < 0).any():
+            state['b'] = np.vstack((network, non_network))
+    prng = np.random.RandomState(seed)
+    sizes = [chunk_size] * (nperm // chunk_size)
+    if nperm % chunk_size:
+        sizes.append(nperm % chunk_size)
+    jobs = zip(prng.randint(0, 2**31 - 1, len(sizes)), sizes)
+    if nproc == 1:
+        _init_perm_worker(state)
+        nulls = map(_perm_null, jobs)
+    else:
+        pool = Pool(nproc, _init_perm_worker, (state,))
+        try:
+            nulls = pool.map(_perm_null, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    null = np.concatenate(nulls, axis=2)
+    exceed = (null >= observed[:, :, np.newaxis]).sum(axis=2)
+    pvals = (exceed + 1.) / (nperm + 1.)
+    return observed, pvals, null
+
+
+@tracing.traced()
+def threshold_sweep(input, template, thresholds, mask=None, input_thresh=0):
+    """
+    Dice, GOF and overlap of input with template thresholded at every
+    threshold in thresholds
+
+    Template values are sorted once and network sums are read from
+    cumulative sums, so the cost is one sort rather than one pass over
+    the data per threshold.
+
+    Parameters
+    ----------
+    input : array
+        3D array of (unthresholded, z-transformed) network, or 4D array
+        with subjects along the last axis
+    template : array
+        3D array of (unthresholded) template network, at each threshold
+        voxels >= threshold and > 0 are in network, all others are not
+        (as threshold_volume followed by calc_gof)
+    thresholds : array
+        thresholds applied to template
+    mask : array or None
+        3D array (or 4D, one mask per subject) restricting voxels used
+        for comparison (default None, all voxels)
+    input_thresh : float
+        voxels of input > input_thresh define the input region used for
+        dice and overlap (default 0)
+
+    Returns
+    -------
+    dice : array
+        dice coefficient of thresholded template and input region
+    gof : array
+        mean input in network - mean input outside network (see calc_gof)
+    overlap : array
+        number of voxels in both thresholded template and input region
+
+    each is shaped (nthresholds,), or (nsubjects, nthresholds) if input
+    is 4D
+    """
+    input = np.asarray(input)
+    template = np.asarray(template).squeeze()
+    single = input.ndim == template.ndim
+    if single:
+        input = input[..., np.newaxis]
+    if not input.shape[:-1] == template.shape:
+        raise IOError('shape mismatch: template:%s, data: %s'%(
+            template.shape, input.shape[:-1]))
+    if mask is None:
+        mask = np.ones(template.shape, dtype=bool)
+    mask = np.asarray(mask) > 0
+    if mask.ndim == template.ndim:
+        mask = mask[..., np.newaxis]
+    anymask = mask.any(axis=-1)
+    tvals = template[anymask]
+    order = np.argsort(tvals, kind='mergesort')
+    tvals = tvals[order]
+    # subjects X sorted voxels
+    weight = mask[anymask][order].T.astype(np.float64)
+    vals = input[anymask][order].T * weight
+    region = (vals > input_thresh) * weight
+
+    def _suffix(dat, idx):
+        csum = np.zeros((dat.shape[0], dat.shape[1] + 1))
+        np.cumsum(dat, axis=1, out=csum[:, 1:])
+        return csum[:, -1:] - csum[:, idx]
+
+    # first sorted voxel >= each threshold, never before the first
+    # voxel > 0 (zero template voxels are not network, see calc_gof)
+    idx = np.maximum(np.searchsorted(tvals, np.atleast_1d(thresholds),
+                                     side='left'),
+                     np.searchsorted(tvals, 0, side='right'))
+    netn = _suffix(weight, idx)
+    nonn = weight.sum(axis=1)[:, np.newaxis] - netn
+    netsum = _suffix(vals, idx)
+    nonsum = vals.sum(axis=1)[:, np.newaxis] - netsum
+    overlap = _suffix(region, idx)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gof = netsum / netn - nonsum / nonn
+        dice = 2 * overlap / (netn + region.sum(axis=1)[:, np.newaxis])
+    if single:
+        return dice[0], gof[0], overlap[0]
+    return dice, gof, overlap
+
+
 def get_template_networks(metaica, thresh=0):
     """
     load a 4D image of template networks,
     threshold at thresh (if necessary, default 0)
     """
-    img = ni.load(metaica)
-    dat  = img.get_data()
-    dat[dat < thresh] = 0
-    newimg = ni.Nifti1Image(dat, img.get_affine(), ni.Nifti1Header())
+    img = imgio.load(metaica)
+    dat = threshold_volume(np.asarray(img.dataobj), thresh)
+    newimg = ni.Nifti1Image(dat, img.get_affine(), img.get_header())
     return newimg
 
 
+def threshold_volume(dat, thresh=None):
+    """ returns dat with values < thresh set to 0 (out of place),
+    or dat itself if thresh is None"""
+    if thresh is None:
+        return dat
+    return np.where(dat < thresh, 0, dat).astype(dat.dtype)
+
+
+class TemplateNetworks(object):
+    """
+    Lazy access to the volumes of a 4D image of template networks
+
+    Volumes are read on request through the image proxy (memory mapped,
+    from the imgio cache for gzipped images), so only the networks used
+    are read.
+    Thresholding is done out of place and the original header is kept.
+
+    Parameters
+    ----------
+    filename : str
+        4D image of template networks (eg. melodic_IC.nii.gz)
+    thresh : float or None
+        values < thresh are set to 0 (default None, no threshold)
+
+    Examples
+    --------
+    >>> templates = TemplateNetworks('melodic_IC.nii.gz', thresh=0)
+    >>> dmn = templates[3]
+    >>> subset = templates.get_volumes([0, 3, 7])
+    """
+    def __init__(self, filename, thresh=None):
+        self.filename = filename
+        self.thresh = thresh
+        self.img = imgio.load(filename)
+        self.shape = self.img.shape
+        self.affine = self.img.get_affine()
+        self.header = self.img.get_header()
+        if len(self.shape) < 4:
+            self.nvols = 1
+        else:
+            self.nvols = self.shape[3]
+
+    def __len__(self):
+        return self.nvols
+
+    def __getitem__(self, idx):
+        return self.get_volume(idx)
+
+    def __iter__(self):
+        for idx in range(self.nvols):
+            yield self.get_volume(idx)
+
+    def get_volume(self, idx):
+        """ return (thresholded) 3D array of volume idx"""
+        if idx < 0:
+            idx += self.nvols
+        if not 0 <= idx < self.nvols:
+            raise IndexError('volume %d out of range (%d volumes)'%(
+                idx, self.nvols))
+        if len(self.shape) < 4:
+            dat = np.asarray(self.img.dataobj)
+        else:
+            dat = np.asarray(self.img.dataobj[..., idx])
+        return threshold_volume(dat.reshape(self.shape[:3]), self.thresh)
+
+    def get_volumes(self, indices):
+        """ return (thresholded) 4D array holding volumes in indices"""
+        return np.concatenate([self.get_volume(idx)[..., np.newaxis]
+                               for idx in indices], axis=3)
+
+    def get_image(self, indices=None):
+        """ return nibabel image of volumes in indices (default all)
+        with the header of the original image"""
+        if indices is None:
+            indices = range(self.nvols)
+        return ni.Nifti1Image(self.get_volumes(indices), self.affine,
+                              self.header)
+
+
 def calc_grecious_connectome_gof(connectome_img, grecious_dict):
     """
     connectome_img : 4d nibabel image
@@ -158,19 +622,18 @@ def calc_grecious_connectome_gof(connectome_img, grecious_dict):
     for each connectome network, calc GOF with Grecios defined networks
     """
     grecios_nets = sorted(grecious_dict.keys())
+    # load each network once, not once per connectome volume
+    networks = [np.asarray(imgio.load(file).dataobj) > 0
+                for name, file in sorted(grecious_dict.items())]
 
-    dat = connectome_img.get_data()
-    x,y,z,vols = dat.shape
+    x,y,z,vols = connectome_img.shape
     gofd = {}
     for i in range(vols):
-        slice = dat[:,:,:,i]
+        slice = np.asarray(connectome_img.dataobj[..., i])
         tmpgof = []
         
-        for cmptn, (name, file) in enumerate(sorted(grecious_dict.items())):
-            netimg = ni.load(file)
-            netdat = netimg.get_data()
-            network =  netdat > 0
-            non_network = np.logical_and(netdat <= 0 ,
+        for cmptn, network in enumerate(networks):
+            non_network = np.logical_and(~network,
                                          slice >0)
             netz = slice[network]
             nonnetz =  slice[non_network]
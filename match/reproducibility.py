@@ -0,0 +1,265 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Component correspondence across repeated ICA runs (bootstrap, split-half)
+
+Each run is a 4D image (or array) of spatial components. Components of
+every run are matched one-to-one to a reference run using the cross-run
+correlation matrix and the Hungarian algorithm, and per-component
+reproducibility statistics are aggregated over all runs.
+"""
+import os
+from multiprocessing import Pool
+import numpy as np
+import nibabel as ni
+from _tools_path import imgio, tracing
+
+
+def get_component_matrix(run, mask=None):
+    """ return components of run as a ncomponents X nvoxels array
+
+    Parameters
+    ----------
+    run : str or array
+        4D file (or array) of spatial components (x, y, z, ncomponents),
+        or a 2D array already shaped ncomponents X nvoxels
+    mask : array or None
+        3D array restricting voxels used (default None, all voxels)
+    """
+    if isinstance(run, basestring):
+        run = imgio.get_data(run)
+    dat = np.asarray(run)
+    if dat.ndim == 2:
+        return dat
+    if mask is None:
+        return dat.reshape((-1, dat.shape[-1])).T
+    if not mask.shape == dat.shape[:-1]:
+        raise ValueError('dimension mismatch, mask: %s, data: %s'%(
+            mask.shape, dat.shape[:-1]))
+    return dat[mask > 0].T
+
+
+def standardize_rows(dat):
+    """ demean each row and scale to unit norm so that the dot product of
+    two standardized rows is their pearson correlation"""
+    dat = np.array(dat, dtype=np.float64)
+    dat -= dat.mean(axis=1)[:, np.newaxis]
+    norm = np.sqrt((dat**2).sum(axis=1))
+    norm[norm == 0] = 1
+    dat /= norm[:, np.newaxis]
+    return dat
+
+
+def correlation_matrix(a, b):
+    """ pearson correlation between every row of a and every row of b
+
+    Parameters
+    ----------
+    a : array
+        ncomponents_a X nvoxels
+    b : array
+        ncomponents_b X nvoxels
+
+    Returns
+    -------
+    corr : array
+        ncomponents_a X ncomponents_b array of pearson R
+    """
+    a = np.atleast_2d(a)
+    b = np.atleast_2d(b)
+    if not a.shape[1] == b.shape[1]:
+        raise IOError("shape mismatch a(%d) , b(%d)"%(a.shape[1],
+                                                      b.shape[1]))
+    return np.dot(standardize_rows(a), standardize_rows(b).T)
+
+
+def match_components(simmat, absolute=True):
+    """ optimal one-to-one assignment of rows to columns of a
+    similarity matrix (Hungarian algorithm)
+
+    Parameters
+    ----------
+    simmat : array
+        nrows X ncols similarity matrix (eg. from correlation_matrix)
+    absolute : bool
+        match on absolute similarity, ICA components have arbitrary sign
+        (default True)
+
+    Returns
+    -------
+    match : array
+        for each row, index of the matched column
+        (-1 if unmatched, when ncols < nrows)
+    sim : array
+        (signed) similarity of each row with its match (nan if unmatched)
+    """
+    score = np.abs(simmat) if absolute else simmat
+    from scipy.optimize import linear_sum_assignment
+    rows, cols = linear_sum_assignment(-score)
+    match = -np.ones(simmat.shape[0], dtype=int)
+    sim = np.empty(simmat.shape[0])
+    sim.fill(np.nan)
+    match[rows] = cols
+    sim[rows] = simmat[rows, cols]
+    return match, sim
+
+
+# state shared with worker processes, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(reference, mask, absolute):
+    _worker_state['reference'] = reference
+    _worker_state['mask'] = mask
+    _worker_state['absolute'] = absolute
+
+
+def _match_to_reference(run):
+    """ match a single run to the (standardized) reference run"""
+    dat = get_component_matrix(run, _worker_state['mask'])
+    simmat = np.dot(_worker_state['reference'], standardize_rows(dat).T)
+    return match_components(simmat, _worker_state['absolute'])
+
+
+def _match_pair(args):
+    """ match run b to run a"""
+    a, b, mask, absolute = args
+    simmat = correlation_matrix(get_component_matrix(a, mask),
+                                get_component_matrix(b, mask))
+    return match_components(simmat, absolute)
+
+
+def _map(func, items, nproc, initializer=None, initargs=()):
+    if nproc == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return map(func, items)
+    pool = Pool(nproc, initializer, initargs)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@tracing.traced()
+def match_runs(reference, runs, mask=None, absolute=True, nproc=1):
+    """ match the components of every run to the components of reference
+
+    Parameters
+    ----------
+    reference : str or array
+        4D file or array of reference components (eg full sample ICA)
+    runs : list
+        list of 4D files or arrays (eg bootstrap ICA runs)
+    mask : array or None
+        3D array restricting voxels used for matching
+    absolute : bool
+        match on absolute correlation (default True)
+    nproc : int
+        number of processes used to match runs (default 1)
+
+    Returns
+    -------
+    match : array
+        nruns X nreference_components array, index of the component in
+        each run matched to each reference component (-1 if unmatched)
+    corr : array
+        nruns X nreference_components array, correlation of each
+        reference component with its match
+    """
+    refdat = standardize_rows(get_component_matrix(reference, mask))
+    results = _map(_match_to_reference, runs, nproc,
+                   initializer=_init_worker,
+                   initargs=(refdat, mask, absolute))
+    match = np.array([x[0] for x in results])
+    corr = np.array([x[1] for x in results])
+    return match, corr
+
+
+@tracing.traced()
+def match_run_pairs(runs, pairs, mask=None, absolute=True, nproc=1):
+    """ match components between arbitrary pairs of runs
+    (eg split-half pairs)
+
+    Parameters
+    ----------
+    runs : list
+        list of 4D files or arrays
+    pairs : list
+        list of (i, j) tuples indexing runs, components of runs[j] are
+        matched to components of runs[i]
+
+    Returns
+    -------
+    results : dict
+        {(i, j): (match, corr)} see match_components
+    """
+    jobs = [(runs[i], runs[j], mask, absolute) for i, j in pairs]
+    results = _map(_match_pair, jobs, nproc)
+    return dict(zip([tuple(x) for x in pairs], results))
+
+
+def reproducibility_stats(corr, thresh=0.7):
+    """ summarize matched correlations over runs for each component
+
+    Parameters
+    ----------
+    corr : array
+        nruns X ncomponents array of matched correlations
+    thresh : float
+        absolute correlation defining a reproduced component (default .7)
+
+    Returns
+    -------
+    stats : dict
+        mean, median, std, min of the absolute matched correlation
+        and proportion of runs where abs(corr) >= thresh, each an array
+        with one value per component
+    """
+    absr = np.abs(np.atleast_2d(corr))
+    valid = ~np.isnan(absr)
+    filled = np.where(valid, absr, 0)
+    nvalid = valid.sum(axis=0)
+    stats = {}
+    stats['mean'] = filled.sum(axis=0) / np.maximum(nvalid, 1)
+    var = (filled**2).sum(axis=0) / np.maximum(nvalid, 1) - stats['mean']**2
+    stats['std'] = np.sqrt(np.maximum(var, 0))
+    stats['median'] = np.array([np.median(col[ok]) if ok.any() else np.nan
+                                for col, ok in zip(absr.T, valid.T)])
+    stats['min'] = np.where(valid, absr, np.inf).min(axis=0)
+    stats['prop_reproduced'] = (filled >= thresh).sum(axis=0) / \
+                               float(absr.shape[0])
+    return stats
+
+
+def component_reproducibility(reference, runs, mask=None, thresh=0.7,
+                              nproc=1):
+    """ match every run to reference and aggregate per-component
+    reproducibility statistics
+
+    Returns
+    -------
+    stats : dict
+        see reproducibility_stats, plus 'match' and 'corr'
+        (nruns X ncomponents) from match_runs
+    """
+    if isinstance(mask, basestring):
+        mask = imgio.get_data(mask)
+    match, corr = match_runs(reference, runs, mask=mask, nproc=nproc)
+    stats = reproducibility_stats(corr, thresh=thresh)
+    stats['match'] = match
+    stats['corr'] = corr
+    return stats
+
+
+def save_reproducibility(stats, outfile):
+    """ write per-component reproducibility statistics to a tab
+    delimited text file, one row per component"""
+    columns = ['mean', 'median', 'std', 'min', 'prop_reproduced']
+    dat = np.vstack([stats[x] for x in columns]).T
+    with open(outfile, 'w+') as fid:
+        fid.write('\t'.join(['component'] + columns) + '\n')
+        for val, row in enumerate(dat):
+            fid.write('\t'.join(['%d'%val] + ['%2.6f'%x for x in row]) + '\n')
+    return os.path.abspath(outfile)
@@ -0,0 +1,2 @@
+# temporary image cache for the tests, see tools/tests
+from ...tools import tests as _tools_tests
@@ -0,0 +1,44 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from .. import benchmarks as bench
+
+
+def test_make_synthetic():
+    comps, temps, mask = bench.make_synthetic((10, 12, 10), 6, 3, seed=1)
+    assert_equal(comps.shape, (10, 12, 10, 6))
+    assert_equal(temps.shape, (10, 12, 10, 3))
+    assert_equal(mask.shape, (10, 12, 10))
+    assert_equal(np.unique(temps), [0, 1])
+    # seeded
+    comps2, _, _ = bench.make_synthetic((10, 12, 10), 6, 3, seed=1)
+    assert_equal(comps, comps2)
+
+
+def test_vectorized_matches_scalar():
+    """ accuracy regression, vectorized metrics reproduce the scalar
+    calc_eta, calc_gof and dice_coefficient"""
+    results = bench.run_benchmarks((12, 14, 12), ncomp=6, ntemplate=3,
+                                   nthresh=5, repeat=1, tol=1e-10)
+    for name in ['eta', 'gof', 'dice', 'corr', 'threshold_sweep']:
+        assert_equal(results[name]['max_abs_diff'] <= 1e-10, True)
+
+
+def test_baseline():
+    results = bench.run_benchmarks((8, 8, 8), ncomp=4, ntemplate=2,
+                                   nthresh=3, repeat=1)
+    outdir = mkdtemp()
+    outf = bench.save_baseline(results, join(outdir, 'baseline.json'))
+    assert_equal(bench.compare_baseline(results, outf), {})
+    slow = dict(results)
+    slow['eta'] = dict(results['eta'])
+    slow['eta']['vectorized'] = 10 * results['eta']['vectorized'] + 1
+    assert_equal(sorted(bench.compare_baseline(slow, outf).keys()), ['eta'])
+    other = bench.run_benchmarks((8, 8, 8), ncomp=3, ntemplate=2,
+                                 nthresh=3, repeat=1)
+    assert_raises(ValueError, bench.compare_baseline, other, outf)
+    os.system('rm -rf %s'%outdir)
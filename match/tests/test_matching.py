@@ -12,6 +12,7 @@ import nibabel as ni
 from unittest import TestCase, skipIf, skipUnless
 from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
 from numpy import (loadtxt, array)
+import numpy as np
 from .. import matching as m
 
 def get_data_dir():
@@ -28,5 +29,190 @@ def clean_tmpdir(tmpdir):
     os.system('rm -rf %s'%tmpdir)
 
 def test_calc_eta():
-    
+    a = array([1., 2., 3., 4.])
+    assert_almost_equal(m.calc_eta(a, a), 1.0)
+    assert_almost_equal(m.calc_eta(a, a[::-1]), 0.0)
+    eta, (r, p) = m.calc_eta(a, 2 * a, getr=True)
+    assert_almost_equal(r, 1.0)
+    assert_raises(IOError, m.calc_eta, a, a[:3])
 
+def make_networks(shape=(6, 7, 8), ninput=3, ntemplate=2, seed=42):
+    """ random z maps, binary templates and mask"""
+    prng = np.random.RandomState(seed)
+    input = prng.randn(*(shape + (ninput,)))
+    template = (prng.rand(*(shape + (ntemplate,))) > .7).astype(float)
+    mask = prng.rand(*shape) > .2
+    return input, template, mask
+
+def test_calc_eta_matrix():
+    input, template, mask = make_networks()
+    a = m.get_masked_rows(input, mask)
+    b = m.get_masked_rows(template + input[..., :2], mask)
+    eta = m.calc_eta_matrix(a, b)
+    assert_equal(eta.shape, (3, 2))
+    for i in range(3):
+        for j in range(2):
+            assert_almost_equal(eta[i, j], m.calc_eta(a[i], b[j]))
+    assert_raises(IOError, m.calc_eta_matrix, a, b[:, :10])
+
+def test_calc_gof_matrix():
+    input, template, mask = make_networks()
+    a = m.get_masked_rows(input, mask)
+    b = m.get_masked_rows(template, mask)
+    gof = m.calc_gof_matrix(a, b)
+    for i in range(3):
+        for j in range(2):
+            assert_almost_equal(gof[i, j], m.calc_gof(input[..., i],
+                                                      template[..., j],
+                                                      mask))
+
+def test_permutation_indices():
+    prng = np.random.RandomState(0)
+    perms = m.permutation_indices(5, 20, prng)
+    assert_equal(np.sort(perms, axis=1), np.tile(np.arange(20), (5, 1)))
+    # block shuffle keeps voxels of a block together, in order
+    blocks = np.repeat(np.arange(4), 5)
+    perms = m.permutation_indices(5, 20, prng, blocks)
+    assert_equal(np.sort(perms, axis=1), np.tile(np.arange(20), (5, 1)))
+    assert_equal((np.diff(perms.reshape((5, 4, 5)), axis=2) == 1).all(),
+                 True)
+
+def test_permuted_dot():
+    prng = np.random.RandomState(0)
+    a = prng.randn(2, 30)
+    b = prng.randn(4, 30)
+    perms = m.permutation_indices(7, 30, prng)
+    dots = m.permuted_dot(a, b, perms, maxbytes=1)
+    swapped = m.permuted_dot(b, a, np.argsort(perms, axis=1))
+    for p, perm in enumerate(perms):
+        assert_almost_equal(dots[:, :, p], np.dot(a, b[:, perm].T))
+        assert_almost_equal(swapped[:, :, p], np.dot(a, b[:, perm].T).T)
+
+def test_permutation_test():
+    input, template, mask = make_networks()
+    # input 0 is the first template plus noise
+    input[..., 0] += 3 * template[..., 0]
+    obs, pvals, null = m.permutation_test(input, template, mask,
+                                          nperm=200, seed=1, chunk_size=64)
+    assert_almost_equal(obs, m.calc_gof_matrix(m.get_masked_rows(input, mask),
+                                               m.get_masked_rows(template,
+                                                                 mask)))
+    assert_equal(null.shape, (3, 2, 200))
+    assert_almost_equal(pvals[0, 0], 1 / 201.)
+    assert_equal((pvals[1:] > .01).all(), True)
+    # seeded, and independent of nproc
+    _, pvals2, null2 = m.permutation_test(input, template, mask, nperm=200,
+                                          seed=1, chunk_size=64, nproc=2)
+    assert_almost_equal(null2, null)
+    # eta with block shuffling
+    obs, pvals, null = m.permutation_test(input, template, mask,
+                                          metric='eta', nperm=50,
+                                          block_size=2, seed=1)
+    assert_almost_equal(obs[0, 0], m.calc_eta(input[..., 0][mask],
+                                              template[..., 0][mask]))
+    assert_equal(null.shape, (3, 2, 50))
+    assert_raises(ValueError, m.permutation_test, input, template, mask,
+                  metric='dice')
+
+def test_threshold_sweep():
+    prng = np.random.RandomState(0)
+    shape = (6, 7, 8)
+    template = prng.rand(*shape)
+    input = prng.randn(*(shape + (3,)))
+    mask = prng.rand(*(shape + (3,))) > .3
+    thresholds = [.05, .2, .5, .8]
+    dice, gof, overlap = m.threshold_sweep(input, template, thresholds,
+                                           mask=mask, input_thresh=.5)
+    assert_equal(dice.shape, (3, 4))
+    for s in range(3):
+        for t, thr in enumerate(thresholds):
+            binary = (template >= thr).astype(float)
+            assert_almost_equal(gof[s, t],
+                                m.calc_gof(input[..., s], binary,
+                                           mask[..., s]))
+            region = np.logical_and(input[..., s] > .5, mask[..., s])
+            network = np.logical_and(binary > 0, mask[..., s])
+            assert_almost_equal(dice[s, t],
+                                m.dice_coefficient(network, region))
+            assert_equal(overlap[s, t],
+                         np.logical_and(network, region).sum())
+    # single subject, shared mask
+    dice, gof, overlap = m.threshold_sweep(input[..., 0], template,
+                                           thresholds)
+    assert_equal(gof.shape, (4,))
+    assert_almost_equal(gof[1], m.calc_gof(input[..., 0],
+                                           (template >= .2).astype(float),
+                                           np.ones(shape)))
+    # voxels at a threshold are in network, as in threshold_volume
+    template[:2] = .5
+    dice, gof, overlap = m.threshold_sweep(input[..., 0], template, [.5],
+                                           input_thresh=-np.inf)
+    network = m.threshold_volume(template, .5) > 0
+    assert_equal(overlap[0], network.sum())
+    # zero template voxels are never network, also at a threshold of 0
+    template = np.zeros(shape)
+    template[1:4, 2:5, 3:6] = prng.rand(3, 3, 3) + .1
+    dice, gof, overlap = m.threshold_sweep(input[..., 0], template, [0, .6])
+    for t, thr in enumerate([0, .6]):
+        binary = m.threshold_volume(template, thr)
+        assert_almost_equal(gof[t], m.calc_gof(input[..., 0], binary,
+                                               np.ones(shape)))
+    assert_raises(IOError, m.threshold_sweep, input, template[:3],
+                  thresholds)
+
+def make_template_file(outdir, nvols=4):
+    prng = np.random.RandomState(0)
+    dat = prng.randn(5, 6, 7, nvols).astype(np.float32)
+    hdr = ni.Nifti1Header()
+    hdr['descrip'] = 'test templates'
+    img = ni.Nifti1Image(dat, np.diag([2, 2, 2, 1]), hdr)
+    outf = join(outdir, 'templates.nii')
+    img.to_filename(outf)
+    return outf, dat
+
+def test_template_networks():
+    outdir = tmp_outdir()
+    outf, dat = make_template_file(outdir)
+    templates = m.TemplateNetworks(outf, thresh=0)
+    assert_equal(len(templates), 4)
+    expected = dat.copy()
+    expected[expected < 0] = 0
+    assert_almost_equal(templates[2], expected[..., 2])
+    assert_almost_equal(templates[-1], expected[..., 3])
+    assert_almost_equal(templates.get_volumes([3, 1]), expected[..., [3, 1]])
+    assert_raises(IndexError, templates.get_volume, 4)
+    img = templates.get_image([0, 1])
+    assert_equal(img.shape, (5, 6, 7, 2))
+    assert_equal(img.get_header()['descrip'], templates.header['descrip'])
+    # thresholding does not touch the data on disk or the cached array
+    assert_almost_equal(np.asarray(templates.img.dataobj), dat)
+    clean_tmpdir(outdir)
+
+def test_get_template_networks():
+    outdir = tmp_outdir()
+    outf, dat = make_template_file(outdir)
+    orig = ni.load(outf)
+    cached = orig.get_data()
+    img = m.get_template_networks(outf, thresh=.5)
+    newdat = img.get_data()
+    assert_equal((newdat[newdat != 0] >= .5).all(), True)
+    assert_equal(img.get_header()['descrip'], orig.get_header()['descrip'])
+    assert_almost_equal(cached, dat)
+    clean_tmpdir(outdir)
+
+def test_get_graymask():
+    outdir = tmp_outdir()
+    outf, dat = make_template_file(outdir, nvols=1)
+    img = m.get_graymask(outf, threshold=.2)
+    assert_equal(img.get_data(), (dat >= .2).astype(np.float32))
+    clean_tmpdir(outdir)
+
+def test_dice_matrix():
+    input, template, mask = make_networks()
+    a = (m.get_masked_rows(input, mask) > 0).astype(float)
+    b = m.get_masked_rows(template, mask)
+    dice = m.dice_matrix(a, b)
+    for i in range(3):
+        for j in range(2):
+            assert_almost_equal(dice[i, j], m.dice_coefficient(a[i], b[j]))
+    assert_raises(IOError, m.dice_matrix, a, b[:, :10])
@@ -0,0 +1,90 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from scipy.stats import pearsonr
+from .. import reproducibility as rep
+
+
+def make_runs(nruns=4, ncomp=5, shape=(6, 7, 8), noise=.1, seed=42):
+    """ reference components, plus noisy, shuffled, sign flipped copies"""
+    prng = np.random.RandomState(seed)
+    ref = prng.randn(*(shape + (ncomp,)))
+    runs, perms = [], []
+    for i in range(nruns):
+        perm = prng.permutation(ncomp)
+        signs = prng.choice([-1, 1], ncomp)
+        run = ref[..., perm] * signs + noise * prng.randn(*ref.shape)
+        runs.append(run)
+        perms.append(perm)
+    return ref, runs, perms
+
+
+def test_correlation_matrix():
+    prng = np.random.RandomState(1)
+    a = prng.randn(3, 50)
+    b = prng.randn(4, 50)
+    corr = rep.correlation_matrix(a, b)
+    assert_equal(corr.shape, (3, 4))
+    for i in range(3):
+        for j in range(4):
+            assert_almost_equal(corr[i, j], pearsonr(a[i], b[j])[0])
+    assert_raises(IOError, rep.correlation_matrix, a, b[:, :10])
+
+
+def test_match_components():
+    simmat = np.array([[.1, -.9, .2],
+                       [.8, .7, .1],
+                       [.2, .6, .3]])
+    match, sim = rep.match_components(simmat)
+    assert_equal(match, [1, 0, 2])
+    assert_almost_equal(sim, [-.9, .8, .3])
+    # signed matching
+    match, sim = rep.match_components(simmat, absolute=False)
+    assert_equal(match, [2, 0, 1])
+    # fewer columns than rows
+    match, sim = rep.match_components(simmat[:, :2])
+    assert_equal(match, [1, 0, -1])
+    assert_equal(np.isnan(sim[2]), True)
+
+
+def test_match_runs():
+    ref, runs, perms = make_runs()
+    mask = np.ones(ref.shape[:3])
+    mask[0] = 0
+    match, corr = rep.match_runs(ref, runs, mask=mask)
+    for val, perm in enumerate(perms):
+        # reference component perm[k] is found at position k in run
+        assert_equal(match[val][perm], np.arange(len(perm)))
+    assert_equal((np.abs(corr) > .9).all(), True)
+    # parallel gives the same answer
+    pmatch, pcorr = rep.match_runs(ref, runs, mask=mask, nproc=2)
+    assert_equal(pmatch, match)
+    assert_almost_equal(pcorr, corr)
+
+
+def test_match_run_pairs():
+    ref, runs, perms = make_runs(nruns=2)
+    res = rep.match_run_pairs(runs, [(0, 1)])
+    match, corr = res[(0, 1)]
+    # component k of run0 is ref perm0[k], found in run1 at argsort(perm1)
+    expected = np.argsort(perms[1])[perms[0]]
+    assert_equal(match, expected)
+
+
+def test_component_reproducibility():
+    ref, runs, perms = make_runs()
+    stats = rep.component_reproducibility(ref, runs, thresh=.9)
+    assert_equal(stats['corr'].shape, (4, 5))
+    assert_almost_equal(stats['mean'], np.abs(stats['corr']).mean(0))
+    assert_almost_equal(stats['std'], np.abs(stats['corr']).std(0))
+    assert_equal(stats['prop_reproduced'], np.ones(5))
+    outdir = mkdtemp()
+    outf = rep.save_reproducibility(stats, join(outdir, 'repro.txt'))
+    dat = np.loadtxt(outf, skiprows=1)
+    assert_equal(dat.shape, (5, 6))
+    assert_almost_equal(dat[:, 1], stats['mean'], decimal=5)
+    os.system('rm -rf %s'%outdir)
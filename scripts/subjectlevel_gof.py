@@ -1,11 +1,11 @@
 import os, sys
-import nibabel as ni
 import numpy as np
 from glob import glob
-import pandas
 import argparse
 sys.path.insert(0, '/home/jagust/jelman/rsfmri_ica/code/connectivity/match')
 import matching
+# tools/ modules, put on sys.path by matching
+from _tools_path import imgio
 
 
 def get_subjects_files(subdir):
@@ -16,7 +16,8 @@ def get_subjects_files(subdir):
     return result
 
 def main(template, subjectsdir, thresh = 0, run_eta = False):
-    tdat = ni.load(template).get_data().squeeze()
+    import pandas
+    tdat = imgio.get_data(template).squeeze()
 
     _, tname = os.path.split(template)
     tname = tname.split('.')[0]
@@ -25,7 +26,7 @@ def main(template, subjectsdir, thresh = 0, run_eta = False):
     for sf in subfiles:
         pth, nme = os.path.split(sf)
         nme = nme.split('.')[0]
-        tmpdat = ni.load(sf).get_data().squeeze()
+        tmpdat = imgio.get_data(sf).squeeze()
         if not tmpdat.shape == tdat.shape:
             raise IndexError('shape mismatch: '+\
                              'template:%s, data: %s'%(tdat.shape, 
@@ -1,7 +1,8 @@
 import sys
-import nibabel as nib
 sys.path.insert(0, '/home/jagust/jelman/rsfmri_ica/code/connectivity/match')
 import matching
+# tools/ modules, put on sys.path by matching
+from _tools_path import imgio
 import pandas
 import os
 
@@ -68,7 +69,7 @@ if __name__ == '__main__':
     #                        'data/standard', 
     #                        'MNI152_T1_2mm_brain_mask.nii.gz')
     maskfile = os.path.join('/home/jagust/jelman/templates',
-                            'MNI152_T1_2mm_brain_mask.nii.gz')
+                            'MNI152_T1_2mm_brain_mask.nii.gz')
 
 
     #Set output directory of matching metrics
@@ -77,19 +78,16 @@ if __name__ == '__main__':
     outfile = 'MatchingMetrics_Greicius2012.csv'
     #Descriptive list of metrics to be run.
     #Used when generating columns of output
-    metrics = ['gof', 'eta', 'pear_r', 'pear_p']
+    metrics = ['gof', 'eta', 'pear_r', 'pear_p']
 
 
     #Load 4d ICA output, 4d template images and mask image
     ########################################################
-    icaimg = nib.load(icafile)      #4D group ICA output
-    icadat = icaimg.get_data()
-    tempimg = nib.load(tempfile)    #4D template for matching
-    tempdat = tempimg.get_data()
-    maskimg = nib.load(maskfile)    #Mask to restrict gof calculation
-    maskdat = maskimg.get_data()
-
-    #Get shape of ICA data. 't' represents number of components
+    icadat = imgio.get_data(icafile)    #4D group ICA output
+    templates = matching.TemplateNetworks(tempfile) #4D template, read lazily
+    maskdat = imgio.get_data(maskfile)  #Mask to restrict gof calculation
+
+    #Get shape of ICA data. 't' represents number of components
     x, y, z, t = icadat.shape
 
 
@@ -116,12 +114,15 @@ if __name__ == '__main__':
     #Create empty dataframe to hold metric scores
     matchframe = pandas.DataFrame(index=row_index, columns=template_map.values())
 
+    #Read only the template volumes listed in mapfile
+    tempvols = dict([(net, templates[net - 1]) for net in template_map])
+
     #Calculate matching metrics of all components with template networks  
     for cmpnt in range(t):  #Loop over all components in 4d ICA file
         icavol = icadat[:,:,:,cmpnt]
 
         for net in template_map.keys(): #Loop over all networks in 4d template
-            tempvol = tempdat[:,:,:,(net - 1)]
+            tempvol = tempvols[net]
             tempname = template_map[net]
             gof = matching.calc_gof(icavol, #Calc goodness of fit (Greicius 2004)
                                     tempvol,
@@ -24,90 +24,89 @@ import os, sys, re
 from glob import glob
 import argparse
 sys.path.insert(0, '/home/jagust/cindeem/CODE/manja')
-import preprocess as pp
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools'))
+import imgio
+import tracing
+import executor
+import volstack
 import numpy as np
 from numpy import loadtxt, array
 import nibabel as ni
 
+def seed_correlation(dat, seedval):
+    """ pearson correlation of each row of a nvoxels X ntimepoints
+    array with seedval, 0 for constant rows"""
+    dat = np.array(dat, dtype=np.float64)
+    dat -= dat.mean(axis=1)[:, np.newaxis]
+    seedval = np.asarray(seedval, dtype=np.float64)
+    seedval = seedval - seedval.mean()
+    norm = np.sqrt((dat**2).sum(axis=1)) * np.sqrt((seedval**2).sum())
+    corr = np.dot(dat, seedval)
+    valid = norm > 0
+    corr[valid] /= norm[valid]
+    corr[~valid] = 0
+    return corr
+
+@tracing.traced(subject='seed')
 def seed_voxel_corrz(fourd, seed, outdir):
     """ uses numpy, nibabel to calc timeseries correlation
-    with seed values, ztransforms and saves to file in outdir"""
-    _, seedname, _ = pp.split_filename(seed)
-    outfile = os.path.join(outdir, '%s_corrz.nii.gz'%(seedname))
+    with seed values, ztransforms and saves to file (float32, extension
+    from FSLOUTPUTTYPE) in outdir"""
+    return seed_voxel_masked_corrz(fourd, seed, None, outdir)
+
+@tracing.traced(subject='seed')
+def seed_voxel_masked_corrz(fourd, seed, maskf, outdir, chunk_size=20000):
+    """ seed_voxel_corrz restricted to the voxels of maskf (0 outside),
+    correlating chunk_size voxels at a time"""
+    _, seedname, _ = imgio.split_filename(seed)
+    outfile = imgio.output_filename(os.path.join(outdir,
+                                                 '%s_corrz'%(seedname)))
     seedval = np.loadtxt(seed)
-    img = ni.load(fourd)
-    dat = img.get_data()
-    new = np.zeros(dat.shape[:3])
-    for i, slice in enumerate(dat):
-        for j, part in enumerate(slice):
-            res = np.corrcoef(part, seedval)
-            new[i,j,:] = res[-1,:-1]
-    new = np.arctanh(new)
-    new[np.isnan(new)] = 0
-    newimg = ni.Nifti1Image(new, img.get_affine())
-    newimg.to_filename(outfile)
-    return outfile
-
-def seed_voxel_masked_corrz(fourd, seed, maskf, outdir):
-    _, seedname, _ = pp.split_filename(seed)
-    outfile = os.path.join(outdir, '%s_corrz.nii.gz'%(seedname))
-    seedval = np.loadtxt(seed)
-    img = ni.load(fourd)
-    imgdim = img.get_shape()[:3]
-    maskdim = ni.load(maskf).get_shape()
-    if not maskdim == imgdim:
-        raise ValueError('dimension mismatch, mask: %s, data: %s'%(maskdim, imgdim))
-    dat = img.get_data()
-    maskdat = ni.load(maskf).get_data()
-    mask = maskdat > 0
-    masked_dat = dat[mask,:]
-    steps = [x * mask.shape[0]/10 for x in range(10)]
-    steps.append(-1)
-    allres = np.zeros(masked_dat.shape[0])
-    for i, stop in enumerate(steps):
-        start = steps[i]
-        clump = masked_dat[start:s,:]
-        tmpres = np.corrcoef(clump, seed)
-        allres[start:s] = tmpres[-1,:-1]
-    new = np.zeros(dat.shape[:3])
-    new[mask] = allres
-    newimg = ni.Nifti1Image(new, img.get_affine())
-    newimg.to_filename(outfile)
+    stack = volstack.MaskedVolumeStack.from_image(fourd, maskf)
+    allres = np.zeros(stack.nvoxels)
+    for start, chunk in stack.iter_chunks(chunk_size):
+        allres[start:start + len(chunk)] = seed_correlation(chunk, seedval)
+    allres = np.arctanh(allres)
+    allres[np.isnan(allres)] = 0
+    stack.save(outfile, allres)
     return outfile
 
 
 
 
 def generate_seed_voxelcorrelation(fourd, seed, outdir):
-    _, seedname, _ = pp.split_filename(seed)
+    _, seedname, _ = imgio.split_filename(seed)
     outfile = os.path.join(outdir, '%s_corr.nii.gz'%(seedname))
+    # runs in outdir, so paths are absolute
     cmd = ' '.join(['3dfim+',
                     '-input',
-                    fourd,
+                    os.path.abspath(fourd),
                     '-ideal_file',
-                    seed,
+                    os.path.abspath(seed),
                     '-out',
                     'Correlation', 
                     '-bucket',
-                    outfile])
-    cout = pp.CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
-        print cout.runtime.stderr
+                    os.path.abspath(outfile)])
+    cout = executor.run(cmd, cwd=outdir, subject=seedname)
+    if not cout.ok:
+        print cout.stderr
         return None
     return outfile
 
 def ztrans_correl(infile):
     outfile = infile.replace('_corr', '_corrZ')
+    # runs in the directory of infile, so paths are absolute
     cmd = ' '.join(['3dcalc',
                     '-a',
-                    infile,
+                    os.path.abspath(infile),
                     '-expr',
                     '"log((a+1)/(a-1))/2"',
                     '-prefix',
-                    outfile])
-    cout = pp.CommandLine(cmd).run()
-    if not cout.runtime.returncode == 0:
-        print cout.runtime.stderr
+                    os.path.abspath(outfile)])
+    cout = executor.run(cmd, cwd=os.path.dirname(os.path.abspath(infile)))
+    if not cout.ok:
+        print cout.stderr
         return None
     return outfile
 
@@ -169,7 +168,7 @@ def get_precision(infile):
         return precision
     
 def main(datadir, globstr, seedname, resid, mask=None):    
-   
+    import preprocess as pp
     fullglob = os.path.join(datadir, globstr, seedname)
     allf = sorted(glob(fullglob))
     
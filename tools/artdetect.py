@@ -0,0 +1,350 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Artifact detection for fMRI series (intensity and motion outliers)
+
+In process replacement for nipype.algorithms.rapidart.ArtifactDetect
+(mask_type='spm_global', use_norm=True, intersect_mask=True), volumes
+are streamed from disk once and the outlier indices are returned
+directly.
+
+Intensity outliers : volumes where the z-scored (detrended, optionally
+    differenced) global signal exceeds zintensity_threshold
+Motion outliers : volumes where the composite norm of the motion
+    parameters (maximum displacement of six points on a 70-110mm box
+    around the brain) exceeds norm_threshold
+"""
+import os
+import numpy as np
+import nibabel as ni
+from nibabel.openers import ImageOpener
+import imgio
+import tracing
+
+# midpoints of the faces of a box around the brain (mm), as used by rapidart
+BRAIN_PTS = np.vstack((np.hstack((np.diag([70, 70, 75]),
+                                  np.diag([-70, -110, -45]))),
+                       np.ones((1, 6))))
+
+
+def iter_volumes(infiles):
+    """
+    yield the volumes of a 4D file, or of a list of 3D (or 4D) files,
+    one 3D array at a time
+
+    Data are read sequentially from the image file (gzipped or not),
+    so each volume is decompressed exactly once and only one volume is
+    held in memory.
+    """
+    if isinstance(infiles, basestring):
+        infiles = [infiles]
+    for f in infiles:
+        img = ni.load(f)
+        proxy = img.dataobj
+        shape = img.shape[:3]
+        nvols = int(np.prod(img.shape[3:]))
+        dtype = np.dtype(proxy.dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        slope, inter = proxy.slope, proxy.inter
+        with ImageOpener(img.file_map['image'].filename) as fobj:
+            fobj.seek(proxy.offset)
+            for _ in range(nvols):
+                raw = fobj.read(nbytes)
+                if not len(raw) == nbytes:
+                    raise IOError('%s is truncated'%(f))
+                vol = np.frombuffer(raw, dtype=dtype).reshape(shape,
+                                                              order='F')
+                if slope == 1 and inter == 0:
+                    yield vol
+                else:
+                    yield vol * slope + inter
+
+
+def read_volumes(infile, indices):
+    """
+    read only the volumes at indices (along the 4th axis) of a 4D file,
+    see imgio.read_volumes
+
+    Returns
+    -------
+    dat : array
+        (x, y, z, len(indices)) array, volumes in the order of indices
+    """
+    return imgio.read_volumes(infile, indices)
+
+
+def spm_global(vol, global_threshold=8.):
+    """ spm_global like mean of volume, mean of voxels greater than
+    (mean of volume / global_threshold)"""
+    vol = np.asarray(vol, dtype=np.float64)
+    inmask = vol > (np.nanmean(vol) / global_threshold)
+    return np.nansum(vol[inmask]) / inmask.sum()
+
+
+class GlobalSignal(object):
+    """
+    Streaming spm_global signal, one value per volume added with update
+
+    With intersect_mask (the rapidart default) the signal of every
+    volume is its mean within the voxels above (volume mean /
+    global_threshold) in all volumes. update keeps only the intersection
+    so far and the sum of each volume within the mask of the first
+    volume; the voxels that later left the intersection are subtracted
+    by finalize, from a second read of the volumes that is only needed
+    when there are any. If the intersection covers less than 1/10 of
+    the volume, or intersect_mask is False, the signal of each volume is
+    spm_global (its own mask).
+
+    Parameters
+    ----------
+    global_threshold : float
+        spm_global threshold factor (default 8)
+    intersect_mask : bool
+        mean within the intersection of the volume masks (default True)
+    """
+    def __init__(self, global_threshold=8., intersect_mask=True):
+        self.global_threshold = global_threshold
+        self.intersect_mask = intersect_mask
+        self.mask = None
+        self.first_mask = None
+        self.sums = []
+        self.spm_global = []
+
+    def update(self, vol):
+        """ add one 3D volume"""
+        fvol = np.asarray(vol, dtype=np.float64)
+        inmask = fvol > (np.nanmean(fvol) / self.global_threshold)
+        self.spm_global.append(np.nansum(fvol[inmask]) / inmask.sum())
+        if not self.intersect_mask:
+            return
+        if self.mask is None:
+            self.first_mask = inmask
+            self.mask = inmask.copy()
+        else:
+            self.mask &= inmask
+        self.sums.append(np.nansum(fvol[self.first_mask]))
+
+    def finalize(self, infiles=None):
+        """
+        global signal, 1D array
+
+        infiles (the 4D file or list of 3D files passed to update) are
+        read again (see iter_volumes) if voxels of the first volume mask
+        left the intersection, a ValueError if then None
+        """
+        if not self.intersect_mask or self.mask is None or \
+           self.mask.sum() < self.mask.size / 10:
+            return np.array(self.spm_global)
+        sums = np.array(self.sums)
+        dropped = self.first_mask & ~self.mask
+        if dropped.any():
+            if infiles is None:
+                raise ValueError('%d voxels left the intersection mask, '
+                                 'infiles needed'%dropped.sum())
+            drop = np.array([np.nansum(np.asarray(vol[dropped],
+                                                  dtype=np.float64))
+                             for vol in iter_volumes(infiles)])
+            if not len(drop) == len(sums):
+                raise ValueError('%d volumes in infiles, %d updates'%(
+                    len(drop), len(sums)))
+            sums -= drop
+        return sums / self.mask.sum()
+
+
+def global_signal(infiles, global_threshold=8., intersect_mask=True):
+    """ spm_global signal of each volume of a 4D file or list of 3D files
+    (see iter_volumes and GlobalSignal), returns 1D array"""
+    gs = GlobalSignal(global_threshold, intersect_mask)
+    for vol in iter_volumes(infiles):
+        gs.update(vol)
+    return gs.finalize(infiles)
+
+
+def intensity_zscores(g, use_differences=False):
+    """ z-score of the linearly detrended global signal g, if
+    use_differences z-score the volume to volume differences
+    (first value 0)"""
+    from scipy import signal
+    gz = signal.detrend(np.asarray(g, dtype=np.float64))
+    if use_differences:
+        gz = np.concatenate(([0], np.diff(gz)))
+    return (gz - gz.mean()) / gz.std()
+
+
+def load_motion_params(param_file, source='SPM'):
+    """
+    load motion parameters and reorder to the SPM convention
+
+    Parameters
+    ----------
+    param_file : str or array
+        text file of motion parameters (eg. rp_*.txt or *_mcf.par),
+        one row per volume
+    source : str
+        'SPM' (x, y, z (mm), pitch, roll, yaw (rad)) or
+        'FSL' (rotations (rad) then translations (mm))
+
+    Returns
+    -------
+    params : array
+        nvols X 6 array, translations (mm) then rotations (rad)
+    """
+    if isinstance(param_file, basestring):
+        params = np.loadtxt(param_file)
+    else:
+        params = np.asarray(param_file, dtype=np.float64)
+    params = np.atleast_2d(params)
+    if source.upper() == 'FSL':
+        params = params[:, [3, 4, 5, 0, 1, 2]]
+    elif not source.upper() == 'SPM':
+        raise ValueError('param_source must be SPM or FSL, not %s'%source)
+    return params[:, :6]
+
+
+def motion_affines(params):
+    """ nvols X 4 X 4 rigid body affines (translation . Rx . Ry . Rz)
+    for nvols X 6 motion parameters in SPM convention"""
+    nvols = params.shape[0]
+    cos, sin = np.cos(params[:, 3:]), np.sin(params[:, 3:])
+    rot = np.tile(np.eye(3), (3, nvols, 1, 1))
+    # rotation about x, y, z as in spm_matrix / rapidart
+    for axis, (i, j) in enumerate([(1, 2), (0, 2), (0, 1)]):
+        rot[axis, :, i, i] = cos[:, axis]
+        rot[axis, :, j, j] = cos[:, axis]
+        rot[axis, :, i, j] = sin[:, axis]
+        rot[axis, :, j, i] = -sin[:, axis]
+    affines = np.tile(np.eye(4), (nvols, 1, 1))
+    affines[:, :3, :3] = np.einsum('tij,tjk,tkl->til', rot[0], rot[1], rot[2])
+    affines[:, :3, 3] = params[:, :3]
+    return affines
+
+
+def composite_norm(params, use_differences=True, pts=BRAIN_PTS):
+    """
+    composite norm of motion, for each volume
+
+    Parameters
+    ----------
+    params : array
+        nvols X 6 motion parameters in SPM convention
+    use_differences : bool
+        if True maximum displacement (mm) of pts from the previous volume
+        (first volume 0), else rms displacement of pts from their mean
+        position
+    pts : array
+        4 X npts homogeneous coordinates (mm) of points to track
+
+    Returns
+    -------
+    norm : array
+        1D array, one value per volume
+    """
+    newpos = np.einsum('tij,jp->tip', motion_affines(params), pts)[:, :3]
+    if use_differences:
+        diff = np.zeros(newpos.shape)
+        diff[1:] = np.diff(newpos, axis=0)
+        return np.sqrt((diff**2).sum(axis=1)).max(axis=1)
+    newpos = newpos.reshape((newpos.shape[0], -1))
+    newpos = newpos - newpos.mean(axis=0)
+    return np.sqrt((newpos**2).mean(axis=1))
+
+
+def framewise_displacement(params, radius=50.):
+    """ framewise displacement (Power et al. 2012), sum of absolute
+    volume to volume changes in translation (mm) and rotation (rad,
+    converted to mm on a sphere of radius) for nvols X 6 motion
+    parameters in SPM convention (first volume 0), or for
+    (... X nvols X 6) stacks of them"""
+    params = np.atleast_2d(params)
+    fd = np.zeros(params.shape[:-1])
+    delta = np.abs(np.diff(params, axis=-2))
+    fd[..., 1:] = delta[..., :3].sum(axis=-1) + \
+                  radius * delta[..., 3:6].sum(axis=-1)
+    return fd
+
+
+@tracing.traced()
+def detect_artifacts(infiles, param_file, param_source='SPM',
+                     norm_threshold=1, zintensity_threshold=4,
+                     use_differences=(True, False), global_threshold=8.,
+                     intersect_mask=True, g=None):
+    """
+    Find intensity and motion outlier volumes in a fMRI series
+
+    Parameters
+    ----------
+    infiles : str or list
+        4D file, or list of 3D files, of (realigned) fMRI series
+    param_file : str or array
+        motion parameters file, one row per volume
+    param_source : str
+        'SPM' or 'FSL', convention of param_file (default 'SPM')
+    norm_threshold : float
+        composite norm (mm) threshold for motion outliers (default 1)
+    zintensity_threshold : float
+        z threshold for intensity outliers (default 4)
+    use_differences : tuple of bool
+        use volume to volume differences for (motion, intensity)
+        (default (True, False))
+    global_threshold : float
+        spm_global threshold factor (default 8)
+    intersect_mask : bool
+        global signal within the mask common to all volumes (default
+        True, as rapidart), see GlobalSignal
+    g : array or None
+        global signal of infiles, if already computed in another pass
+        over the data (see GlobalSignal), read from infiles if None
+
+    Returns
+    -------
+    result : dict
+        outliers : sorted indices of all outlier volumes
+        motion_outliers : indices of volumes with norm > norm_threshold
+        intensity_outliers : indices of volumes with abs(z) > threshold
+        global_signal, intensity_z, norm, fd : 1D arrays, one per volume
+        stats : counts of common, intensity only and motion only outliers
+    """
+    params = load_motion_params(param_file, param_source)
+    if g is None:
+        g = global_signal(infiles, global_threshold, intersect_mask)
+    g = np.asarray(g)
+    if not len(g) == params.shape[0]:
+        raise IndexError('shape mismatch: volumes = %d, '%(len(g)) +\
+                         'motion parameters = %d'%(params.shape[0]))
+    gz = intensity_zscores(g, use_differences[1])
+    norm = composite_norm(params, use_differences[0])
+    iidx = np.nonzero(np.abs(gz) > zintensity_threshold)[0]
+    tidx = np.nonzero(norm > norm_threshold)[0]
+    result = {'outliers': np.union1d(iidx, tidx),
+              'motion_outliers': tidx,
+              'intensity_outliers': iidx,
+              'global_signal': g,
+              'intensity_z': gz,
+              'norm': norm,
+              'fd': framewise_displacement(params)}
+    result['stats'] = {
+        'common_outliers': len(np.intersect1d(iidx, tidx)),
+        'intensity_outliers': len(np.setdiff1d(iidx, tidx)),
+        'motion_outliers': len(np.setdiff1d(tidx, iidx))}
+    return result
+
+
+def save_artifacts(result, infile, outdir):
+    """ write outlier indices, global signal and norm to outdir, using
+    the rapidart file names (art.<name>_outliers.txt, ...)
+
+    Returns
+    -------
+    outfiles : dict
+        {'outliers', 'intensity', 'norm'} : files written
+    """
+    _, nme = os.path.split(infile)
+    nme = os.path.splitext(nme)[0]
+    outfiles = {'outliers': os.path.join(outdir, 'art.%s_outliers.txt'%nme),
+                'intensity': os.path.join(outdir,
+                                          'global_intensity.%s.txt'%nme),
+                'norm': os.path.join(outdir, 'norm.%s.txt'%nme)}
+    np.savetxt(outfiles['outliers'], result['outliers'], fmt='%d')
+    np.savetxt(outfiles['intensity'], result['global_signal'], fmt='%.2f')
+    np.savetxt(outfiles['norm'], result['norm'], fmt='%.4f')
+    return outfiles
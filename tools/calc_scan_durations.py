@@ -2,26 +2,308 @@
 import os
 import sys
 import argparse
+from multiprocessing import Pool
 import numpy as np
-import scipy.special as sspec
-from scipy import interpolate
-from scipy.signal import cubic
+import imgio
+import tracing
+import volstack
 
 
 def spline_dtrend(data, tr = 2):
-    """use spline to detrend data"""
-    ## need to subsample timepoints
-    # for accurate low freq detrending
-    y = data
-    x = np.arange(len(data))
-    xx = np.arange(0, len(data), tr)
-    tck = interpolate.splrep(xx, y, s=0)
-    ynew = interpolate.splev(xx,tck,der=0)
-    res = data - ynew
-    return res
+    """use spline to detrend data, cubic B-spline drift with knots
+    every tr timepoints (subsampled for accurate low freq detrending)
+    data is 1D or (nvoxels X ntimepoints), see detrend"""
+    data = np.asarray(data, dtype=np.float64)
+    basis = spline_basis(data.shape[-1], knot_spacing=tr)
+    return detrend(data, basis)
 
 def demean(data):
-    """ remove mean value from a dataset"""
-    return data - data.mean()
+    """ remove mean value from a dataset (from each row of a
+    nvoxels X ntimepoints array)"""
+    data = np.asarray(data)
+    return data - data.mean(axis=-1)[..., np.newaxis]
+
+
+def polynomial_basis(ntimepoints, order=2):
+    """ ntimepoints X (order + 1) Legendre polynomials (on [-1, 1]),
+    the first column is the constant"""
+    import scipy.special as sspec
+    x = np.linspace(-1, 1, ntimepoints)
+    return np.array([sspec.eval_legendre(i, x)
+                     for i in range(order + 1)]).T
+
+
+def spline_basis(ntimepoints, knot_spacing=20, k=3):
+    """ ntimepoints X nbasis B-spline basis of degree k, interior knots
+    every knot_spacing timepoints, each column evaluated from unit
+    coefficients with interpolate.splev (the columns sum to 1, so the
+    constant is spanned)"""
+    from scipy import interpolate
+    x = np.arange(ntimepoints, dtype=float)
+    interior = np.arange(knot_spacing, ntimepoints - 1, knot_spacing,
+                         dtype=float)
+    knots = np.concatenate(([x[0]] * (k + 1), interior,
+                            [x[-1]] * (k + 1)))
+    nbasis = len(knots) - k - 1
+    basis = np.empty((ntimepoints, nbasis))
+    for i in range(nbasis):
+        coef = np.zeros(len(knots))
+        coef[i] = 1
+        basis[:, i] = interpolate.splev(x, (knots, coef, k))
+    return basis
+
+
+def cosine_basis(ntimepoints, tr=2, cutoff=128.):
+    """ ntimepoints X nbasis discrete cosine set (as spm_dctmtx), the
+    constant plus all cosines with period longer than cutoff (secs)"""
+    ncos = int(np.floor(2 * ntimepoints * tr / cutoff)) + 1
+    t = np.arange(ntimepoints)
+    freq = np.arange(ncos)
+    basis = np.cos(np.pi * np.outer(2 * t + 1, freq) / (2. * ntimepoints))
+    basis[:, 0] = 1
+    return basis
+
+
+def drift_basis(ntimepoints, kind='poly', tr=2, order=2, knot_spacing=20,
+                cutoff=128.):
+    """
+    drift regressors for detrend
+
+    Parameters
+    ----------
+    ntimepoints : int
+        number of timepoints
+    kind : str or list
+        'poly' (Legendre polynomials up to order), 'spline' (cubic B-spline,
+        knots every knot_spacing timepoints), 'cosine' (cosines with
+        period > cutoff secs), or a list of these to combine
+    tr : float
+        repetition time (secs)
+
+    Returns
+    -------
+    basis : array
+        ntimepoints X nregressors array, full column rank
+    """
+    if isinstance(kind, basestring):
+        kind = [kind]
+    bases = []
+    for k in kind:
+        if k == 'poly':
+            bases.append(polynomial_basis(ntimepoints, order))
+        elif k == 'spline':
+            bases.append(spline_basis(ntimepoints, knot_spacing))
+        elif k == 'cosine':
+            bases.append(cosine_basis(ntimepoints, tr, cutoff))
+        else:
+            raise ValueError('unknown drift basis %s'%k)
+    basis = np.hstack(bases)
+    # combined bases share the constant, keep independent columns
+    u, s, _ = np.linalg.svd(basis, full_matrices=False)
+    rank = (s > s[0] * ntimepoints * np.finfo(float).eps).sum()
+    if rank < basis.shape[1]:
+        basis = u[:, :rank]
+    return basis
+
+
+def residual_projector(basis):
+    """ ntimepoints X ntimepoints matrix removing the span of basis,
+    rows of data . residual_projector(basis) are the detrended rows"""
+    basis = np.asarray(basis, dtype=np.float64)
+    return np.eye(basis.shape[0]) - np.dot(basis, np.linalg.pinv(basis))
+
+
+def detrend(data, basis, keep_mean=False):
+    """
+    remove the drift regressors in basis from every timeseries, with
+    one shared projection
+
+    Parameters
+    ----------
+    data : array
+        1D timeseries or nvoxels X ntimepoints array
+    basis : array
+        ntimepoints X nregressors drift basis (see drift_basis)
+    keep_mean : bool
+        add the mean of each timeseries back after detrending
+
+    Returns
+    -------
+    res : array
+        detrended data, same shape as data
+    """
+    data = np.asarray(data, dtype=np.float64)
+    if not data.shape[-1] == basis.shape[0]:
+        raise ValueError('ntimepoints mismatch, data: %d, basis: %d'%(
+            data.shape[-1], basis.shape[0]))
+    # projector is symmetric
+    res = np.dot(data, residual_projector(basis))
+    if keep_mean:
+        res += data.mean(axis=-1)[..., np.newaxis]
+    return res
+
+
+def bandpass(data, tr=2, highpass=None, lowpass=None):
+    """
+    FFT bandpass filter timeseries (last axis of data)
+
+    Parameters
+    ----------
+    data : array
+        1D timeseries or nvoxels X ntimepoints array
+    tr : float
+        repetition time (secs)
+    highpass : float or None
+        remove frequencies below highpass (Hz), None keeps all low
+        frequencies (including the mean)
+    lowpass : float or None
+        remove frequencies above lowpass (Hz), None keeps all high
+        frequencies
+
+    Returns
+    -------
+    filtered : array
+        same shape as data
+    """
+    data = np.asarray(data, dtype=np.float64)
+    ntimepoints = data.shape[-1]
+    freqs = np.fft.rfftfreq(ntimepoints, d=tr)
+    keep = np.ones(len(freqs), dtype=bool)
+    if highpass is not None:
+        keep &= freqs >= highpass
+    if lowpass is not None:
+        keep &= freqs <= lowpass
+    spectrum = np.fft.rfft(data, axis=-1)
+    spectrum[..., ~keep] = 0
+    return np.fft.irfft(spectrum, n=ntimepoints, axis=-1)
+
+
+# shared by filter workers, set by _init_filter_worker
+_filter_state = {}
+
+def _init_filter_worker(projector, tr, highpass, lowpass, keep_mean):
+    _filter_state.update(projector=projector, tr=tr, highpass=highpass,
+                         lowpass=lowpass, keep_mean=keep_mean)
+
+
+def _filter_chunk(chunk):
+    """ detrend (shared projector) then bandpass one voxel chunk"""
+    st = _filter_state
+    chunk = np.asarray(chunk, dtype=np.float64)
+    res = chunk
+    if st['projector'] is not None:
+        res = np.dot(chunk, st['projector'])
+    if st['highpass'] is not None or st['lowpass'] is not None:
+        res = bandpass(res, st['tr'], st['highpass'], st['lowpass'])
+    if st['keep_mean']:
+        res += chunk.mean(axis=-1)[:, np.newaxis]
+    return res
+
+
+def filter_timeseries(data, tr=2, basis=None, highpass=None, lowpass=None,
+                      keep_mean=False, chunk_size=20000, nproc=1):
+    """
+    detrend (basis) and bandpass (highpass, lowpass) a nvoxels X
+    ntimepoints matrix, in chunks of chunk_size voxels over nproc
+    processes
+
+    Returns
+    -------
+    res : array
+        nvoxels X ntimepoints float64 array
+    """
+    data = np.atleast_2d(data)
+    projector = None
+    if basis is not None:
+        if not data.shape[-1] == basis.shape[0]:
+            raise ValueError('ntimepoints mismatch, data: %d, basis: %d'%(
+                data.shape[-1], basis.shape[0]))
+        projector = residual_projector(basis)
+    initargs = (projector, tr, highpass, lowpass, keep_mean)
+    chunks = [data[i:i + chunk_size]
+              for i in range(0, data.shape[0], chunk_size)]
+    if nproc > 1 and len(chunks) > 1:
+        pool = Pool(min(nproc, len(chunks)), _init_filter_worker, initargs)
+        try:
+            res = pool.map(_filter_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_filter_worker(*initargs)
+        res = [_filter_chunk(chunk) for chunk in chunks]
+    if not res:
+        return np.zeros(data.shape)
+    return np.concatenate(res)
+
+
+@tracing.traced()
+def filter_image(infile, outfile, mask=None, tr=None, kind='poly',
+                 highpass=None, lowpass=None, keep_mean=True, nproc=1,
+                 **basis_kw):
+    """
+    detrend and bandpass filter a 4D image within mask
+
+    Parameters
+    ----------
+    infile : str
+        4D image
+    outfile : str
+        filtered 4D image (float32), zero outside mask
+    mask : str or array or None
+        brain mask, if None all voxels with non zero variance
+    tr : float or None
+        repetition time (secs), from the header if None
+    kind : str, list or None
+        drift basis (see drift_basis), None for no detrending
+    highpass, lowpass : float or None
+        band edges (Hz), see bandpass
+    basis_kw : dict
+        order, knot_spacing, cutoff passed to drift_basis
+
+    Returns
+    -------
+    outfile : str
+    """
+    img = imgio.load(infile)
+    if tr is None:
+        tr = float(img.get_header().get_zooms()[3])
+    if mask is None:
+        mask = img.get_data().std(axis=3) > 0
+    stack = volstack.MaskedVolumeStack.from_image(img, mask)
+    basis = None
+    if kind is not None:
+        basis = drift_basis(stack.nvolumes, kind, tr, **basis_kw)
+    res = filter_timeseries(stack.data, tr, basis, highpass, lowpass,
+                            keep_mean, nproc=nproc)
+    stack.to_image(res).to_filename(outfile)
+    return outfile
+
+
+if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(
+        description='Voxelwise detrending and bandpass filtering of 4D fMRI')
+    parser.add_argument('infile', type=str, help='4D fMRI file')
+    parser.add_argument('outfile', type=str, help='filtered 4D file')
+    parser.add_argument('-mask', dest='mask', default=None,
+                        help='brain mask (default non constant voxels)')
+    parser.add_argument('-tr', type=float, dest='tr', default=None,
+                        help='repetition time (default from header)')
+    parser.add_argument('-drift', dest='drift', nargs='+',
+                        default=['poly'],
+                        help='drift bases: poly spline cosine (default poly)')
+    parser.add_argument('-highpass', type=float, dest='highpass',
+                        default=None, help='highpass cutoff (Hz)')
+    parser.add_argument('-lowpass', type=float, dest='lowpass',
+                        default=None, help='lowpass cutoff (Hz)')
+    parser.add_argument('-nproc', type=int, dest='nproc', default=1,
+                        help='number of processes (default 1)')
 
+    if len(sys.argv) == 1:
+        parser.print_help()
+    else:
+        args = parser.parse_args()
+        print filter_image(args.infile, args.outfile, args.mask, args.tr,
+                           args.drift, args.highpass, args.lowpass,
+                           nproc=args.nproc)
@@ -0,0 +1,337 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Cohort QA batch runner
+
+Runs artifact detection (rapid_art) and the one pass QA statistics
+(qa_stats), both from a single read of the data, for many subjects in a
+worker pool, and collects a summary of every subject into a single
+tab-delimited cohort index.
+
+Each subject's data_QA directory holds a manifest (qa_manifest.json) of
+the inputs (size, mtime and sha1 of every file) and the QA settings used.
+A subject is only re-run if its inputs or settings changed, unchanged
+files (same size and mtime) are not re-hashed.
+
+python cohort_qa.py -datapath /home/jagust/rsfmri/data \
+    -infile '{subj}/func/filtered_func_data.nii.gz' \
+    -params '{subj}/func/mc/prefiltered_func_data_mcf.par' \
+    -params_source FSL -nproc 12 B05-201 B05-202 ...
+"""
+import os, sys
+import json
+import hashlib
+import traceback
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import nibabel as ni
+import artdetect
+import rapid_art
+import imgio
+import qa_stats
+import tracing
+
+MANIFEST = 'qa_manifest.json'
+SUMMARY = 'qa_summary.json'
+INDEX_COLUMNS = ['subject', 'status', 'nvols', 'n_outliers',
+                 'n_motion_outliers', 'n_intensity_outliers',
+                 'n_common_outliers', 'fd_mean', 'fd_max', 'dvars_mean',
+                 'dvars_max', 'tsnr_mean', 'tsnr_median', 'qadir']
+
+
+def file_hash(filename, blocksize=2**20):
+    """ sha1 hex digest of the contents of filename"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fid:
+        block = fid.read(blocksize)
+        while block:
+            sha1.update(block)
+            block = fid.read(blocksize)
+    return sha1.hexdigest()
+
+
+def input_manifest(infiles, previous=None):
+    """
+    describe infiles by size, mtime and sha1
+
+    Parameters
+    ----------
+    infiles : list
+        files to describe
+    previous : dict or None
+        earlier manifest, the sha1 of a file whose size and mtime are
+        unchanged is taken from here instead of re-reading the file
+
+    Returns
+    -------
+    manifest : dict
+        {abspath : {'size': int, 'mtime': float, 'sha1': str}}
+    """
+    if previous is None:
+        previous = {}
+    manifest = {}
+    for f in infiles:
+        f = os.path.abspath(f)
+        st = os.stat(f)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime}
+        old = previous.get(f, {})
+        if old.get('size') == entry['size'] and \
+           old.get('mtime') == entry['mtime'] and 'sha1' in old:
+            entry['sha1'] = old['sha1']
+        else:
+            entry['sha1'] = file_hash(f)
+        manifest[f] = entry
+    return manifest
+
+
+def _same_inputs(old, new):
+    """ True if two input manifests list the same files and contents"""
+    if not sorted(old) == sorted(new):
+        return False
+    return all([old[f]['sha1'] == new[f]['sha1'] for f in new])
+
+
+def load_json(infile):
+    """ contents of json file infile, None if missing or unreadable"""
+    try:
+        with open(infile) as fid:
+            return json.load(fid)
+    except (IOError, ValueError):
+        return None
+
+
+def save_json(obj, outfile):
+    """ write obj to outfile (via a temporary file so readers never
+    see a partial file)"""
+    tmpfile = outfile + '.tmp'
+    with open(tmpfile, 'w+') as fid:
+        json.dump(obj, fid, indent=2, sort_keys=True)
+    os.rename(tmpfile, outfile)
+    return outfile
+
+
+def summarize(art, qa):
+    """
+    summary statistics of one subject's QA
+
+    Parameters
+    ----------
+    art : dict
+        output of artdetect.detect_artifacts
+    qa : dict
+        output of qa_stats.qa_stats
+
+    Returns
+    -------
+    summary : dict
+        outlier counts, FD and DVARS mean / max, mean and median tSNR
+        within the QA mask
+    """
+    tsnr = qa['tsnr'][qa['mask']]
+    summary = {'nvols': len(art['norm']),
+               'n_outliers': len(art['outliers']),
+               'n_motion_outliers': len(art['motion_outliers']),
+               'n_intensity_outliers': len(art['intensity_outliers']),
+               'n_common_outliers': art['stats']['common_outliers'],
+               'fd_mean': float(art['fd'][1:].mean()),
+               'fd_max': float(art['fd'].max()),
+               'dvars_mean': float(qa['dvars'][1:].mean()),
+               'dvars_max': float(qa['dvars'].max()),
+               'tsnr_mean': float(tsnr.mean()),
+               'tsnr_median': float(np.median(tsnr))}
+    return summary
+
+
+@tracing.traced(subject='subject')
+def subject_qa(subject, infiles, param_file, param_source='SPM', thresh=4,
+               outdir=None, ncomp=10, save_maps=True, force=False):
+    """
+    run artifact detection and QA statistics for one subject, unless
+    the data_QA directory holds results for identical inputs and settings
+
+    Parameters
+    ----------
+    subject : str
+        subject id, as written to the cohort index
+    infiles : str or list
+        4D file or list of 3D files of fMRI series
+    param_file : str
+        motion parameters file
+    param_source : str
+        'SPM' or 'FSL' (default 'SPM')
+    thresh : float
+        intensity z threshold (default 4)
+    outdir : str or None
+        directory in which data_QA is created (default dir of infiles)
+    ncomp : int
+        number of QA principal components (default 10)
+    save_maps : bool
+        save QA maps and traces (see qa_stats.save_qa_stats) to data_QA
+    force : bool
+        re-run even if up to date
+
+    Returns
+    -------
+    summary : dict
+        see summarize, plus 'subject', 'status' ('ran' or 'current')
+        and 'qadir'
+    """
+    if isinstance(infiles, basestring):
+        infiles = [infiles]
+    if outdir is None:
+        outdir, _ = os.path.split(infiles[0])
+    qadir = os.path.join(outdir, 'data_QA')
+    settings = {'param_source': param_source, 'thresh': thresh,
+                'ncomp': ncomp, 'save_maps': save_maps}
+    old = load_json(os.path.join(qadir, MANIFEST)) or {}
+    inputs = input_manifest(infiles + [param_file], old.get('inputs'))
+    summary = load_json(os.path.join(qadir, SUMMARY))
+    if not force and summary is not None and \
+       old.get('settings') == settings and \
+       _same_inputs(old.get('inputs', {}), inputs):
+        summary['status'] = 'current'
+        # refresh mtimes so the next scan need not hash again
+        save_json({'inputs': inputs, 'settings': settings},
+                  os.path.join(qadir, MANIFEST))
+        return summary
+    # one read of the data for both QA statistics and artifact detection
+    # (a second only if voxels left the global signal mask)
+    gsignal = artdetect.GlobalSignal()
+    qa = qa_stats.qa_stats(infiles, ncomp=ncomp, gsignal=gsignal)
+    art = rapid_art.main(infiles, param_file, param_source, thresh, outdir,
+                         clobber=True, g=gsignal.finalize(infiles))
+    if save_maps:
+        _, nme, _ = imgio.split_filename(infiles[0])
+        qa_stats.save_qa_stats(qa, ni.load(infiles[0]).get_affine(), qadir,
+                               nme)
+    summary = summarize(art, qa)
+    summary.update({'subject': subject, 'qadir': qadir})
+    save_json(summary, os.path.join(qadir, SUMMARY))
+    save_json({'inputs': inputs, 'settings': settings},
+              os.path.join(qadir, MANIFEST))
+    summary['status'] = 'ran'
+    return summary
+
+
+def _subject_qa(args):
+    """ Pool worker, subject_qa(*args) with failures reported in the
+    summary rather than raised"""
+    try:
+        return subject_qa(*args)
+    except Exception:
+        return {'subject': args[0], 'status': 'failed',
+                'error': traceback.format_exc()}
+
+
+def cohort_qa(jobs, param_source='SPM', thresh=4, ncomp=10, save_maps=True,
+              force=False, nproc=1):
+    """
+    run subject_qa for every subject in a pool of nproc workers
+
+    Parameters
+    ----------
+    jobs : list
+        (subject, infiles, param_file, outdir) tuples
+    param_source, thresh, ncomp, save_maps, force : see subject_qa
+    nproc : int
+        number of worker processes (default 1)
+
+    Returns
+    -------
+    summaries : list
+        one summary dict per subject, in the order of jobs; failed
+        subjects have status 'failed' and the traceback in 'error'
+    """
+    args = [(subj, infiles, param_file, param_source, thresh, outdir,
+             ncomp, save_maps, force)
+            for subj, infiles, param_file, outdir in jobs]
+    if nproc > 1 and len(args) > 1:
+        pool = Pool(min(nproc, len(args)))
+        try:
+            summaries = pool.map(_subject_qa, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        summaries = [_subject_qa(arg) for arg in args]
+    return summaries
+
+
+def save_cohort_index(summaries, outfile):
+    """ write one row per subject (INDEX_COLUMNS) to tab-delimited
+    outfile, missing values are written as NA"""
+    with open(outfile, 'w+') as fid:
+        fid.write('\t'.join(INDEX_COLUMNS) + '\n')
+        for summary in summaries:
+            row = []
+            for col in INDEX_COLUMNS:
+                val = summary.get(col, 'NA')
+                if isinstance(val, float):
+                    val = '%2.4f'%val
+                row.append(str(val))
+            fid.write('\t'.join(row) + '\n')
+    return os.path.abspath(outfile)
+
+
+def make_jobs(subjects, datapath, infile_template, param_template,
+              outdir_template=None):
+    """ (subject, infiles, param_file, outdir) for each subject, templates
+    are relative to datapath and formatted with subj=<subject>"""
+    jobs = []
+    for subj in subjects:
+        infile = os.path.join(datapath, infile_template.format(subj=subj))
+        param_file = os.path.join(datapath,
+                                  param_template.format(subj=subj))
+        outdir = None
+        if outdir_template is not None:
+            outdir = os.path.join(datapath,
+                                  outdir_template.format(subj=subj))
+        jobs.append((subj, [infile], param_file, outdir))
+    return jobs
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run artifact detection and QA for a cohort, '+\
+        'writing a single cohort QA index')
+    parser.add_argument('subjects', type=str, nargs='+',
+                        help='subject ids')
+    parser.add_argument('-datapath', dest='datapath', default='.',
+                        help='project directory containing subjects')
+    parser.add_argument('-infile', dest='infile', required=True,
+                        help="""4D fMRI file relative to datapath,
+                        {subj} is replaced by the subject id""")
+    parser.add_argument('-params', dest='params', required=True,
+                        help='motion parameters file relative to datapath')
+    parser.add_argument('-params_source', dest='params_source',
+                        default='SPM', help='SPM or FSL (default SPM)')
+    parser.add_argument('-thresh', type=float, dest='thresh', default=4,
+                        help='Intensity threshold (default 4)')
+    parser.add_argument('-outdir', dest='outdir', default=None,
+                        help="""directory for data_QA relative to datapath
+                        (default directory of infile)""")
+    parser.add_argument('-nproc', type=int, dest='nproc', default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('-force', action='store_true', dest='force',
+                        help='re-run subjects that are up to date')
+    parser.add_argument('-index', dest='index',
+                        default='cohort_qa_index.txt',
+                        help='cohort index file (default '+\
+                        'cohort_qa_index.txt in datapath)')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+    else:
+        args = parser.parse_args()
+        jobs = make_jobs(args.subjects, args.datapath, args.infile,
+                         args.params, args.outdir)
+        summaries = cohort_qa(jobs, args.params_source, args.thresh,
+                              force=args.force, nproc=args.nproc)
+        for summary in summaries:
+            if summary['status'] == 'failed':
+                print 'FAILED %s\n%s'%(summary['subject'], summary['error'])
+        outfile = save_cohort_index(summaries,
+                                    os.path.join(args.datapath, args.index))
+        print 'wrote %s'%(outfile)
@@ -1,13 +1,209 @@
+"""
+Cohort motion diagnostics
 
+Motion parameter files of every subject are read once (load_cohort_motion)
+into a (subjects X volumes X 6) array, summarised with vectorised
+framewise displacement and displacement statistics (motion_summary), and
+then compared between groups (chi_sq_movement) or correlated with
+variables of interest (movement_withx).
 
+>>> params, nvols = load_cohort_motion(param_files, source='FSL')
+>>> summary = motion_summary(params)
+>>> chi_sq_movement(summary, groups == 1, groups == 2)
+>>> movement_withx(summary, age)
+"""
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import artdetect
 
-def chi_sq_movement(groupa, groupb):
+MOTION_METRICS = ['fd_mean', 'fd_max', 'disp_mean', 'disp_max',
+                  'n_supra']
+
+
+def load_cohort_motion(param_files, source='SPM', nproc=4):
+    """
+    read motion parameter files of many subjects
+
+    Parameters
+    ----------
+    param_files : list
+        motion parameter files (SPM rp_*.txt or FSL *.par), one per subject
+    source : str
+        'SPM' or 'FSL' (see artdetect.load_motion_params)
+    nproc : int
+        number of reader threads (default 4)
+
+    Returns
+    -------
+    params : array
+        nsubjects X max(nvols) X 6 array in SPM convention (translations
+        mm, rotations rad), padded with nan for shorter runs
+    nvols : array
+        number of volumes of each subject
+    """
+    pool = ThreadPool(max(1, min(nproc, len(param_files))))
+    try:
+        allparams = pool.map(lambda f: artdetect.load_motion_params(f,
+                                                                    source),
+                             param_files)
+    finally:
+        pool.close()
+        pool.join()
+    nvols = np.array([p.shape[0] for p in allparams], dtype=int)
+    params = np.empty((len(allparams), nvols.max(), 6))
+    params.fill(np.nan)
+    for i, p in enumerate(allparams):
+        params[i, :nvols[i]] = p
+    return params, nvols
+
+
+def motion_summary(params, fd_thresh=.5, radius=50.):
+    """
+    per subject motion statistics, vectorised over subjects
+
+    Parameters
+    ----------
+    params : array
+        nsubjects X nvols X 6 (nan padded) array, see load_cohort_motion
+    fd_thresh : float
+        framewise displacement (mm) threshold for supra threshold frames
+        (default .5)
+    radius : float
+        head radius (mm) converting rotations to displacement (default 50)
+
+    Returns
+    -------
+    summary : dict
+        fd_mean, fd_max : mean and max framewise displacement (mm)
+        disp_mean, disp_max : mean and max translation (mm) from the
+            first volume
+        n_supra : number of frames with fd > fd_thresh
+        fd : nsubjects X nvols framewise displacement (nan padded)
+    """
+    params = np.asarray(params, dtype=np.float64)
+    if params.ndim == 2:
+        params = params[np.newaxis]
+    fd = artdetect.framewise_displacement(params, radius)
+    valid = np.isfinite(params).all(axis=2)
+    fd[~valid] = np.nan
+    disp = np.sqrt(((params[:, :, :3] - params[:, :1, :3])**2).sum(axis=2))
+    with np.errstate(invalid='ignore'):
+        n_supra = (fd > fd_thresh).sum(axis=1)
+    summary = {'fd_mean': np.nanmean(fd[:, 1:], axis=1),
+               'fd_max': np.nanmax(fd, axis=1),
+               'disp_mean': np.nanmean(disp, axis=1),
+               'disp_max': np.nanmax(disp, axis=1),
+               'n_supra': n_supra,
+               'nvols': valid.sum(axis=1),
+               'fd': fd}
+    return summary
+
+
+def chi_sq_movement(summary, groupa, groupb):
     """ examine if their are significant displacement
-    differences between two groups"""
-    pass
+    differences between two groups
+
+    Parameters
+    ----------
+    summary : dict
+        output of motion_summary
+    groupa, groupb : array
+        boolean masks (or indices) of subjects in each group
+
+    Returns
+    -------
+    result : dict
+        table : 2 X 2 counts of (supra threshold, other) frames per group
+        chi2, p, dof : chi square test of table (scipy chi2_contingency)
+        t, t_p : Welch t test of each metric in MOTION_METRICS, arrays
+            in the order of MOTION_METRICS
+    """
+    from scipy import stats
+    groupa = np.asarray(groupa)
+    groupb = np.asarray(groupb)
+    supra = summary['n_supra']
+    # frames with an fd value, the first of each run has none
+    frames = summary['nvols'] - 1
+    table = np.array([[supra[groupa].sum(), (frames - supra)[groupa].sum()],
+                      [supra[groupb].sum(), (frames - supra)[groupb].sum()]])
+    chi2, p, dof, _ = stats.chi2_contingency(table)
+    metrics = np.array([summary[m] for m in MOTION_METRICS], dtype=float)
+    t, t_p = stats.ttest_ind(metrics[:, groupa], metrics[:, groupb],
+                             axis=1, equal_var=False)
+    return {'table': table, 'chi2': chi2, 'p': p, 'dof': dof,
+            't': t, 't_p': t_p}
 
 
-def movement_withx():
+def movement_withx(summary, x):
     """ check for correlation between displacement and
-    variable of interest"""
-    pass
+    variable of interest
+
+    Parameters
+    ----------
+    summary : dict
+        output of motion_summary
+    x : array
+        nsubjects variable of interest, or nsubjects X nvariables
+
+    Returns
+    -------
+    r : array
+        len(MOTION_METRICS) X nvariables pearson correlations
+    p : array
+        two sided p values of r
+    """
+    from scipy import stats
+    x = np.asarray(x, dtype=np.float64)
+    if x.ndim == 1:
+        x = x[:, np.newaxis]
+    metrics = np.array([summary[m] for m in MOTION_METRICS],
+                       dtype=float).T
+    if not x.shape[0] == metrics.shape[0]:
+        raise ValueError('x has %d subjects, motion summary %d'%(
+            x.shape[0], metrics.shape[0]))
+    if not np.all(np.isfinite(x)):
+        raise ValueError('x has missing values, remove those subjects')
+    n = x.shape[0]
+    za = (metrics - metrics.mean(axis=0)) / metrics.std(axis=0)
+    zb = (x - x.mean(axis=0)) / x.std(axis=0)
+    r = np.clip(np.dot(za.T, zb) / n, -1, 1)
+    with np.errstate(divide='ignore'):
+        t = r * np.sqrt((n - 2) / (1 - r**2))
+    p = 2 * stats.t.sf(np.abs(t), n - 2)
+    return r, p
+
+
+def cohort_motion(param_files, groups=None, x=None, source='SPM',
+                  fd_thresh=.5, nproc=4):
+    """
+    read all motion files once, summarise, and run the group comparison
+    (if groups) and covariate correlation (if x)
+
+    Parameters
+    ----------
+    param_files : list
+        motion parameter files, one per subject
+    groups : array or None
+        group label of each subject, exactly two distinct labels
+    x : array or None
+        variable(s) of interest, see movement_withx
+
+    Returns
+    -------
+    result : dict
+        summary (motion_summary), chi_sq (chi_sq_movement) and
+        withx ((r, p) of movement_withx) when computed
+    """
+    params, _ = load_cohort_motion(param_files, source, nproc)
+    summary = motion_summary(params, fd_thresh)
+    result = {'summary': summary}
+    if groups is not None:
+        groups = np.asarray(groups)
+        labels = np.unique(groups)
+        if not len(labels) == 2:
+            raise ValueError('need two groups, got %s'%(labels))
+        result['chi_sq'] = chi_sq_movement(summary, groups == labels[0],
+                                           groups == labels[1])
+    if x is not None:
+        result['withx'] = movement_withx(summary, x)
+    return result
@@ -0,0 +1,315 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Shared executor of external (FSL, AFNI) commands
+
+Commands are submitted as jobs that run in the background, each in its
+own working directory (passed to the process, the working directory of
+this process is never changed), with a timeout and retries. At most
+max_jobs commands run at a time, and at most limits[tool] of one tool
+(eg. randomise), so many subjects can be processed in threads without
+oversubscribing cores. Every job returns a CommandResult.
+
+The shared executor (get_executor, used by run and submit) is
+configured from the environment
+
+CONNECTIVITY_MAX_JOBS : commands at a time (default number of cpus)
+CONNECTIVITY_TOOL_LIMITS : per tool limits, eg. 'randomise=2,fsl_glm=8'
+    (default DEFAULT_LIMITS)
+
+>>> res = run('fsl_glm -i func -d melodic_IC -o stage1.txt', cwd=outdir)
+>>> if not res.ok: print res.stderr
+>>> jobs = [submit(cmd, cwd=outdir, timeout=3600) for cmd in cmds]
+>>> results = [job.wait() for job in jobs]
+"""
+import os
+import time
+import shlex
+import threading
+import subprocess
+from multiprocessing import cpu_count
+import tracing
+
+DEFAULT_LIMITS = {'randomise': 2}
+# return code of a command that could not be started (as the shell)
+NOT_FOUND = 127
+
+
+class CommandResult(object):
+    """
+    outcome of one command
+
+    Attributes
+    ----------
+    cmdline : str
+    cwd : str or None
+        working directory of the command
+    returncode : int
+        of the last attempt, NOT_FOUND if the command could not be
+        started, None if it timed out
+    stdout, stderr : str
+        output of the last attempt
+    duration : float
+        wall time of all attempts (secs)
+    attempts : int
+    timed_out : bool
+        the last attempt was killed after its timeout
+    """
+    def __init__(self, cmdline, cwd=None):
+        self.cmdline = cmdline
+        self.cwd = cwd
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.duration = 0.
+        self.attempts = 0
+        self.timed_out = False
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return 'CommandResult(%r, returncode=%s, attempts=%d)'%(
+            self.cmdline, self.returncode, self.attempts)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class CommandJob(object):
+    """ a submitted command, wait() returns its CommandResult"""
+    def __init__(self, cmdline, cwd=None):
+        self.result = CommandResult(cmdline, cwd)
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ CommandResult of the job, None if not done within timeout
+        (secs)"""
+        self._done.wait(timeout)
+        if not self.done():
+            return None
+        return self.result
+
+
+def tool_name(cmd):
+    """ executable name of a command (string or argument list)"""
+    if isinstance(cmd, basestring):
+        cmd = cmd.split()
+    if not cmd:
+        return ''
+    return os.path.split(cmd[0])[1]
+
+
+def parse_limits(spec):
+    """ {tool : limit} of a 'tool=n,tool=n' string"""
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        try:
+            tool, limit = item.split('=')
+            limits[tool.strip()] = int(limit)
+        except ValueError:
+            raise ValueError('bad tool limit %s in %s'%(item, spec))
+    return limits
+
+
+def _execute(args, cwd, env, timeout):
+    """ run args once, returns (returncode, stdout, stderr, timed_out)"""
+    try:
+        proc = subprocess.Popen(args, cwd=cwd, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    except OSError, err:
+        return NOT_FOUND, '', '%s: %s'%(args[0], err), False
+    killed = []
+    timer = None
+    if timeout is not None:
+        def kill():
+            killed.append(True)
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if killed:
+        return None, stdout, stderr, True
+    return proc.returncode, stdout, stderr, False
+
+
+class CommandExecutor(object):
+    """
+    run external commands in background threads with concurrency
+    limits
+
+    Parameters
+    ----------
+    max_jobs : int or None
+        commands running at a time (default number of cpus)
+    limits : dict or None
+        {tool : commands of that tool running at a time}
+    timeout : float or None
+        default timeout of a command (secs, None for no timeout)
+    retries : int
+        default number of retries after a failure or timeout
+    retry_delay : float
+        secs before a retry, doubled after each retry
+    """
+    def __init__(self, max_jobs=None, limits=None, timeout=None, retries=0,
+                 retry_delay=1.):
+        if max_jobs is None:
+            max_jobs = cpu_count()
+        self.max_jobs = max(1, max_jobs)
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+        self._tool_slots = {}
+        self._lock = threading.Lock()
+        for tool, limit in (limits or {}).items():
+            self.set_limit(tool, limit)
+
+    def set_limit(self, tool, limit):
+        """ at most limit commands of tool at a time (jobs submitted
+        after this)"""
+        with self._lock:
+            self._tool_slots[tool] = threading.BoundedSemaphore(max(1,
+                                                                   limit))
+
+    def _tool_slot(self, tool):
+        with self._lock:
+            return self._tool_slots.get(tool)
+
+    def _run_job(self, job, args, env, timeout, retries, subject):
+        res = job.result
+        tool = tool_name(args)
+        tool_slot = self._tool_slot(tool)
+        start = time.time()
+        delay = self.retry_delay
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(delay)
+                    delay *= 2
+                # wait for the tool before taking a global slot, jobs
+                # of other tools are not held up meanwhile
+                if tool_slot is not None:
+                    tool_slot.acquire()
+                try:
+                    with self._slots:
+                        with tracing.span(tool, 'subprocess', subject,
+                                          cmdline=res.cmdline, cwd=res.cwd,
+                                          attempt=attempt + 1) as sp:
+                            out = _execute(args, res.cwd, env, timeout)
+                            sp.set_args(returncode=out[0],
+                                        timed_out=out[3])
+                finally:
+                    if tool_slot is not None:
+                        tool_slot.release()
+                (res.returncode, res.stdout, res.stderr,
+                 res.timed_out) = out
+                res.attempts = attempt + 1
+                if res.ok or res.returncode == NOT_FOUND:
+                    break
+        except Exception, err:
+            res.returncode = None
+            res.stderr = '%s: %s'%(err.__class__.__name__, err)
+        finally:
+            res.duration = time.time() - start
+            job._done.set()
+
+    def submit(self, cmd, cwd=None, timeout=-1, retries=None, env=None,
+               subject=None):
+        """
+        start cmd in the background
+
+        Parameters
+        ----------
+        cmd : str or list
+            command line (split as the shell would, not run in a shell)
+            or argument list
+        cwd : str or None
+            working directory of the command (default that of this
+            process)
+        timeout : float or None
+            secs after which the command is killed (default executor
+            timeout, None for none)
+        retries : int or None
+            retries after a failure or timeout (default executor retries)
+        env : dict or None
+            environment of the command (default os.environ)
+        subject : str or None
+            subject id recorded in the trace (see tracing)
+
+        Returns
+        -------
+        job : CommandJob
+        """
+        if isinstance(cmd, basestring):
+            args = shlex.split(cmd)
+            cmdline = cmd
+        else:
+            args = [str(arg) for arg in cmd]
+            cmdline = ' '.join(args)
+        if timeout == -1:
+            timeout = self.timeout
+        if retries is None:
+            retries = self.retries
+        if cwd is not None and not os.path.isdir(cwd):
+            raise IOError('working directory %s does not exist'%cwd)
+        job = CommandJob(cmdline, cwd)
+        thread = threading.Thread(target=self._run_job,
+                                  args=(job, args, env, timeout, retries,
+                                        subject))
+        thread.daemon = True
+        thread.start()
+        return job
+
+    def run(self, cmd, cwd=None, timeout=-1, retries=None, env=None,
+            subject=None):
+        """ submit cmd and wait for its CommandResult"""
+        return self.submit(cmd, cwd, timeout, retries, env, subject).wait()
+
+    def map(self, cmds, cwd=None, timeout=-1, retries=None, env=None):
+        """ run all cmds (within the limits), CommandResults in the order
+        of cmds"""
+        jobs = [self.submit(cmd, cwd, timeout, retries, env) for cmd in cmds]
+        return [job.wait() for job in jobs]
+
+
+# shared by run and submit, created by get_executor
+_executor = {}
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """ the shared CommandExecutor (see module doc for its settings)"""
+    with _executor_lock:
+        if 'shared' not in _executor:
+            limits = dict(DEFAULT_LIMITS)
+            limits.update(parse_limits(
+                os.environ.get('CONNECTIVITY_TOOL_LIMITS', '')))
+            max_jobs = os.environ.get('CONNECTIVITY_MAX_JOBS')
+            if max_jobs is not None:
+                max_jobs = int(max_jobs)
+            _executor['shared'] = CommandExecutor(max_jobs, limits)
+    return _executor['shared']
+
+
+def submit(cmd, cwd=None, timeout=-1, retries=None, env=None, subject=None):
+    """ submit cmd to the shared executor (see CommandExecutor.submit)"""
+    return get_executor().submit(cmd, cwd, timeout, retries, env, subject)
+
+
+def run(cmd, cwd=None, timeout=-1, retries=None, env=None, subject=None):
+    """ run cmd with the shared executor, returns its CommandResult"""
+    return get_executor().run(cmd, cwd, timeout, retries, env, subject)
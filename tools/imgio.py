@@ -0,0 +1,464 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Shared image reading with an uncompressed, memory mappable cache
+
+Gzipped NIfTI cannot be memory mapped, every get_data() decompresses the
+whole file. Here a .nii.gz is decompressed once into a cache directory
+(an uncompressed .nii, keyed on the path, size and mtime of the source)
+and opened memory mapped from there, so later reads of the same file,
+from any module or process, are page cache hits and single volumes or
+slabs are read without touching the rest of the file.
+
+The cache is limited in size (least recently used files are evicted)
+and configured from the environment
+
+CONNECTIVITY_CACHE : cache directory (default ~/.cache/connectivity)
+CONNECTIVITY_CACHE_SIZE : size limit in GB (default 20)
+CONNECTIVITY_NOCACHE : if set, read gzipped files directly
+
+Images are written with save (or streamed through open_writer): float32
+or scaled int16 data, gzip level CONNECTIVITY_COMPRESSLEVEL (default 1,
+as nibabel) compressed in independent blocks over
+CONNECTIVITY_WRITE_THREADS threads (default 4), the extension of
+names without one from FSLOUTPUTTYPE (see output_filename).
+
+>>> img = load('filtered_func_data.nii.gz')
+>>> vol = get_volume('filtered_func_data.nii.gz', 10)
+>>> prefetch(allfiles, nproc=8)
+>>> save(dat, affine, output_filename('mask'), dtype=np.int16)
+"""
+import os
+import zlib
+import hashlib
+import tempfile
+import threading
+import subprocess
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import nibabel as ni
+from nibabel.arraywriters import make_array_writer, get_slope_inter
+from nibabel.openers import ImageOpener
+import tracing
+
+_cache_lock = threading.Lock()
+
+
+def split_filename(fname):
+    """ (path, name, extension) of fname, .nii.gz, .img.gz and .tar.gz
+    are one extension (as nipype.utils.filemanip.split_filename, without
+    importing nipype)"""
+    pth, fname = os.path.split(fname)
+    for ext in ('.nii.gz', '.img.gz', '.tar.gz', '.niml.dset'):
+        if fname.lower().endswith(ext):
+            return pth, fname[:-len(ext)], fname[-len(ext):]
+    nme, ext = os.path.splitext(fname)
+    return pth, nme, ext
+
+
+def cache_dir():
+    """ cache directory, created if missing"""
+    cdir = os.environ.get('CONNECTIVITY_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'connectivity'))
+    if not os.path.isdir(cdir):
+        try:
+            os.makedirs(cdir)
+        except OSError:
+            # created by another process
+            if not os.path.isdir(cdir):
+                raise
+    return cdir
+
+
+def cache_limit():
+    """ cache size limit in bytes"""
+    return int(float(os.environ.get('CONNECTIVITY_CACHE_SIZE', 20)) * 2**30)
+
+
+def use_cache(filename):
+    """ True if filename is gzipped and caching is enabled"""
+    return filename.endswith('.gz') and \
+        not os.environ.get('CONNECTIVITY_NOCACHE')
+
+
+def cache_path(filename):
+    """ uncompressed cache file of filename (keyed on abspath, size
+    and mtime, so a changed source is a cache miss)"""
+    filename = os.path.abspath(filename)
+    st = os.stat(filename)
+    key = hashlib.sha1('%s %d %r'%(filename, st.st_size,
+                                   st.st_mtime)).hexdigest()
+    nme = os.path.split(filename)[1]
+    if nme.endswith('.gz'):
+        nme = nme[:-3]
+    return os.path.join(cache_dir(), '%s_%s'%(key[:16], nme))
+
+
+def _decompress(filename, outfile, blocksize=2**22):
+    """ decompress gzipped filename to outfile, with pigz (separate
+    read, decompress, checksum and write threads) if available, else
+    zlib streaming (which releases the GIL, so several files decompress
+    in parallel threads, see prefetch)"""
+    pigz = find_executable('pigz')
+    if pigz is not None:
+        with open(outfile, 'wb') as fid:
+            if subprocess.call([pigz, '-dc', filename], stdout=fid) == 0:
+                return outfile
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    with open(filename, 'rb') as src:
+        with open(outfile, 'wb') as fid:
+            block = src.read(blocksize)
+            while block:
+                fid.write(decomp.decompress(block))
+                # concatenated gzip members
+                while decomp.unused_data:
+                    rest = decomp.unused_data
+                    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    fid.write(decomp.decompress(rest))
+                block = src.read(blocksize)
+            fid.write(decomp.flush())
+    return outfile
+
+
+def evict(limit=None, keep=()):
+    """ remove least recently used cache files until the cache is
+    under limit bytes (default cache_limit()), files in keep stay"""
+    if limit is None:
+        limit = cache_limit()
+    cdir = cache_dir()
+    files = []
+    for f in os.listdir(cdir):
+        f = os.path.join(cdir, f)
+        if f.endswith('.nii') and os.path.isfile(f):
+            st = os.stat(f)
+            files.append((st.st_mtime, st.st_size, f))
+    total = sum([size for _, size, _ in files])
+    for _, size, f in sorted(files):
+        if total <= limit:
+            break
+        if f in keep:
+            continue
+        try:
+            os.remove(f)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+
+def cached(filename):
+    """
+    uncompressed, memory mappable version of filename
+
+    filename itself if not gzipped (or caching disabled), else its cache
+    file, decompressed on a miss; the cache file's mtime records its
+    last use for LRU eviction
+    """
+    if not use_cache(filename):
+        return filename
+    outfile = cache_path(filename)
+    if os.path.isfile(outfile):
+        os.utime(outfile, None)
+        return outfile
+    # decompress to a temporary file, rename is atomic so concurrent
+    # readers never see a partial file
+    fd, tmpfile = tempfile.mkstemp(suffix='.tmp', dir=cache_dir())
+    os.close(fd)
+    # mkstemp creates 0600, the cache may be shared by several users
+    os.chmod(tmpfile, 0644)
+    try:
+        with tracing.span('imgio.decompress', 'io', file=filename):
+            _decompress(filename, tmpfile)
+        os.rename(tmpfile, outfile)
+    finally:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+    with _cache_lock:
+        evict(keep=(outfile,))
+    return outfile
+
+
+def prefetch(filenames, nproc=4):
+    """ fill the cache for filenames, decompressing nproc files at a
+    time, returns the cache files"""
+    filenames = list(filenames)
+    if nproc > 1 and len(filenames) > 1:
+        pool = ThreadPool(min(nproc, len(filenames)))
+        try:
+            return pool.map(cached, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    return [cached(f) for f in filenames]
+
+
+def load(filename):
+    """ nibabel image of filename, memory mapped from the cache for
+    gzipped files"""
+    return ni.load(cached(filename), mmap=True)
+
+
+def get_data(filename):
+    """ data array of filename (a memory map when the image is not
+    scaled)"""
+    return load(filename).get_data()
+
+
+def get_volume(filename, idx):
+    """ 3D array of volume idx (4th axis) of filename, only that
+    volume is read"""
+    img = load(filename)
+    if len(img.shape) < 4:
+        if not idx in (0, -1):
+            raise IndexError('volume %d of 3D image %s'%(idx, filename))
+        return np.asarray(img.dataobj).reshape(img.shape[:3])
+    nvols = img.shape[3]
+    if not -nvols <= idx < nvols:
+        raise IndexError('volume %d out of range (%d volumes)'%(idx, nvols))
+    return np.asarray(img.dataobj[..., idx])
+
+
+def read_volumes(filename, indices):
+    """
+    (x, y, z, len(indices)) array of volumes indices of filename, in
+    the order of indices
+
+    The image is opened once and the volumes are read in increasing
+    order by seeking past the others, so an uncompressed (or cached)
+    file is only read where needed and a gzipped file (caching
+    disabled) is decompressed once, up to the last index.
+    """
+    img = load(filename)
+    proxy = img.dataobj
+    shape = img.shape[:3]
+    nvols = int(np.prod(img.shape[3:]))
+    indices = np.asarray(indices, dtype=int)
+    if np.any(indices >= nvols) or np.any(indices < -nvols):
+        raise IndexError('%s has %d volumes, asked for %s'%(filename, nvols,
+                                                           indices))
+    indices = np.where(indices < 0, indices + nvols, indices)
+    dtype = np.dtype(proxy.dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    scaled = not (proxy.slope == 1 and proxy.inter == 0)
+    dat = None
+    with ImageOpener(img.file_map['image'].filename) as fobj:
+        for pos in np.argsort(indices, kind='mergesort'):
+            fobj.seek(proxy.offset + indices[pos] * nbytes)
+            raw = fobj.read(nbytes)
+            if not len(raw) == nbytes:
+                raise IOError('%s is truncated'%(filename))
+            vol = np.frombuffer(raw, dtype=dtype).reshape(shape, order='F')
+            if scaled:
+                vol = vol * proxy.slope + proxy.inter
+            if dat is None:
+                dat = np.empty(shape + (len(indices),), dtype=vol.dtype)
+            dat[..., pos] = vol
+    if dat is None:
+        dat = np.empty(shape + (0,), dtype=dtype)
+    return dat
+
+
+def get_slab(filename, start, stop, axis=2):
+    """ slab start:stop along axis (default 2, slices) of filename,
+    all volumes, read lazily from the memory map"""
+    img = load(filename)
+    slicer = [slice(None)] * len(img.shape)
+    slicer[axis] = slice(start, stop)
+    return np.asarray(img.dataobj[tuple(slicer)])
+
+
+def iter_volumes(filename, chunk_size=1):
+    """ yield (x, y, z, n <= chunk_size) arrays of consecutive volumes
+    of a 4D file"""
+    img = load(filename)
+    nvols = int(np.prod(img.shape[3:]))
+    for start in range(0, nvols, chunk_size):
+        stop = min(start + chunk_size, nvols)
+        chunk = np.asarray(img.dataobj[..., start:stop])
+        yield chunk.reshape(img.shape[:3] + (stop - start,))
+
+
+# FSLOUTPUTTYPE values and their extensions
+FSL_EXTENSIONS = {'NIFTI': '.nii',
+                  'NIFTI_PAIR': '.img',
+                  'NIFTI_GZ': '.nii.gz',
+                  'NIFTI_PAIR_GZ': '.img.gz'}
+
+
+def output_ext():
+    """ extension of FSLOUTPUTTYPE (.nii.gz if not set)"""
+    ftype = os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ')
+    try:
+        return FSL_EXTENSIONS[ftype]
+    except KeyError:
+        raise ValueError('unknown FSLOUTPUTTYPE %s'%ftype)
+
+
+def output_filename(filename):
+    """ filename with the extension of FSLOUTPUTTYPE (replacing any
+    nifti extension it has)"""
+    for ext in sorted(FSL_EXTENSIONS.values(), key=len, reverse=True):
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+            break
+    return filename + output_ext()
+
+
+def compress_level():
+    """ gzip level of written images"""
+    return int(os.environ.get('CONNECTIVITY_COMPRESSLEVEL', 1))
+
+
+def write_threads():
+    """ number of threads compressing written images"""
+    return int(os.environ.get('CONNECTIVITY_WRITE_THREADS', 4))
+
+
+def _compress_block(block, compresslevel):
+    """ one complete gzip member of block"""
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress(block) + comp.flush()
+
+
+class BlockGzipWriter(object):
+    """
+    write only file object compressing blocksize blocks of its input
+    into independent gzip members over nthreads threads (zlib releases
+    the GIL), members are concatenated in order, a valid gzip file for
+    gzip, nibabel and pigz
+    """
+    def __init__(self, filename, compresslevel=None, nthreads=None,
+                 blocksize=2**22):
+        if compresslevel is None:
+            compresslevel = compress_level()
+        if nthreads is None:
+            nthreads = write_threads()
+        self.compresslevel = compresslevel
+        self.nthreads = max(1, nthreads)
+        self.blocksize = blocksize
+        self._fobj = open(filename, 'wb')
+        self._buffer = []
+        self._buffered = 0
+        self._pos = 0
+        self._pending = []
+        self._pool = None
+        if self.nthreads > 1:
+            self._pool = ThreadPool(self.nthreads)
+
+    def tell(self):
+        """ uncompressed position"""
+        return self._pos
+
+    def write(self, data):
+        data = bytes(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._pos += len(data)
+        if self._buffered >= self.blocksize:
+            data = b''.join(self._buffer)
+            nblocks = len(data) // self.blocksize
+            for i in range(nblocks):
+                self._submit(data[i * self.blocksize:
+                                  (i + 1) * self.blocksize])
+            rest = data[nblocks * self.blocksize:]
+            self._buffer = [rest]
+            self._buffered = len(rest)
+
+    def _submit(self, block):
+        if self._pool is None:
+            self._fobj.write(_compress_block(block, self.compresslevel))
+            return
+        self._pending.append(self._pool.apply_async(
+            _compress_block, (block, self.compresslevel)))
+        # bound memory to a few blocks per thread
+        while len(self._pending) > 2 * self.nthreads:
+            self._fobj.write(self._pending.pop(0).get())
+
+    def close(self):
+        if self._fobj.closed:
+            return
+        try:
+            if self._buffered or not self._pos:
+                self._submit(b''.join(self._buffer))
+            for res in self._pending:
+                self._fobj.write(res.get())
+        finally:
+            self._buffer = []
+            self._pending = []
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+            self._fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_writer(filename, compresslevel=None, nthreads=None):
+    """ file object writing filename, block gzip compressed (see
+    BlockGzipWriter) if it ends with .gz and compresslevel is not 0"""
+    if filename.endswith('.gz') and not compresslevel == 0:
+        return BlockGzipWriter(filename, compresslevel, nthreads)
+    return open(filename, 'wb')
+
+
+@tracing.traced(cat='io')
+def save(data, affine, filename, header=None, dtype=np.float32,
+         compresslevel=None, nthreads=None):
+    """
+    write data to a nifti image
+
+    Parameters
+    ----------
+    data : array
+        image data
+    affine : array
+        4 X 4 voxel to world affine
+    filename : str
+        output file, .nii, .nii.gz, .img or .img.gz (see output_filename
+        for the FSLOUTPUTTYPE extension)
+    header : nibabel header or None
+        header to copy fields (eg. TR) from
+    dtype : numpy dtype or None
+        stored data type, float32 by default, integer types are scaled
+        to their range (scl_slope, scl_inter) unless data fits, None for
+        the data type of data
+    compresslevel : int or None
+        gzip level (0-9, default compress_level()), .nii.gz only
+    nthreads : int or None
+        compression threads (default write_threads())
+
+    Returns
+    -------
+    filename : str
+    """
+    data = np.asanyarray(data)
+    if dtype is None:
+        dtype = data.dtype
+    if filename.endswith(('.img', '.img.gz', '.hdr')):
+        img = ni.Nifti1Pair(data, affine, header)
+        img.set_data_dtype(dtype)
+        img.to_filename(filename)
+        return filename
+    img = ni.Nifti1Image(data, affine, header)
+    img.update_header()
+    hdr = img.get_header()
+    hdr.set_data_dtype(dtype)
+    writer = make_array_writer(data, hdr.get_data_dtype(), True, True)
+    slope, inter = get_slope_inter(writer)
+    if slope is None:
+        slope, inter = 1., 0.
+    if inter is None:
+        inter = 0.
+    hdr.set_slope_inter(slope, inter)
+    hdr.set_data_offset(0)
+    with open_writer(filename, compresslevel, nthreads) as fobj:
+        hdr.write_to(fobj)
+        fobj.write(b'\x00' * (hdr.get_data_offset() - fobj.tell()))
+        writer.to_fileobj(fobj, order='F')
+    return filename
@@ -1,8 +1,22 @@
 import os, sys
+import re
+from multiprocessing import Pool
 import numpy as np
 import nibabel as nib
 from glob import glob
-import general_utilities as gu
+import imgio
+import tracing
+import rapid_art
+import volstack
+
+#Per voxel affiliation metrics, and prefix of their output files
+METRICS = {'meandiff': 'nets_diff',
+           'seconddiff': 'nets_seconddiff',
+           'splitdiff': 'nets_splitdiff',
+           'winner': 'nets_winner',
+           'entropy': 'nets_entropy',
+           'participation': 'nets_participation'}
+MARGINS = ('meandiff', 'seconddiff', 'splitdiff')
 
 def get_dims(data):
     """
@@ -21,80 +35,353 @@ def get_dims(data):
     n_scans = data.shape[-1]
     return n_voxels, n_scans
 
-def get_primary_net(dat_array2d):
+def affiliation_margins(dat_array2d):
+    """
+    Margins of the primary (max) network over the others, for each row
+    of a voxels X networks array, in float32 without masked arrays
+
+    Input:
+    dat_array2d : numpy array
+                voxels X networks
+
+    Returns:
+    margins : dict of numpy arrays (voxels, float32)
+            meandiff : primary network minus mean of the other networks
+            seconddiff : primary network minus the second highest network
+            splitdiff : primary network minus sum of the other networks
+    """
+    dat = np.asarray(dat_array2d, dtype=np.float32)
+    assert len(dat.shape) == 2
+    n_nets = dat.shape[1]
+    prim_net = dat.max(axis=1)
+    others_sum = dat.sum(axis=1) - prim_net
+    margins = {'splitdiff': prim_net - others_sum}
+    if n_nets > 1:
+        margins['meandiff'] = prim_net - others_sum / (n_nets - 1)
+        second = np.partition(dat, n_nets - 2, axis=1)[:, n_nets - 2]
+        margins['seconddiff'] = prim_net - second
+    else:
+        margins['meandiff'] = np.zeros(dat.shape[0], dtype=np.float32)
+        margins['seconddiff'] = np.zeros(dat.shape[0], dtype=np.float32)
+    return margins
+
+def affiliation_metrics(dat_array2d, metrics=MARGINS):
     """
-    Given a 2D numpy array, returns an array with the max value across
-    the last axis and a masked array with all values except the max
+    Per voxel affiliation metrics for each row of a voxels X networks
+    array, from one pass over the data
 
     Input:
     dat_array2d : numpy array
+                voxels X networks
+    metrics : list
+                any of METRICS
+                meandiff, seconddiff, splitdiff : see affiliation_margins
+                winner : primary (max) network, 1 based (int16)
+                entropy : entropy of the affiliation weights (positive
+                    values normalized to sum to 1) divided by
+                    log(networks), 0 for one network, 1 for all equal
+                participation : participation coefficient of the
+                    affiliation weights, 1 - sum(weights**2), scaled by
+                    networks / (networks - 1) to [0, 1]
+
+    Returns:
+    values : dict of numpy arrays (voxels, float32 or int16 for winner)
+    """
+    unknown = [m for m in metrics if m not in METRICS]
+    if unknown:
+        raise ValueError('unknown metrics %s, choose from %s'%(
+            unknown, sorted(METRICS)))
+    dat = np.asarray(dat_array2d, dtype=np.float32)
+    assert len(dat.shape) == 2
+    n_nets = dat.shape[1]
+    values = {}
+    if any([m in MARGINS for m in metrics]):
+        margins = affiliation_margins(dat)
+        values.update([(m, margins[m]) for m in metrics if m in MARGINS])
+    if 'winner' in metrics:
+        values['winner'] = (dat.argmax(axis=1) + 1).astype(np.int16)
+    if 'entropy' in metrics or 'participation' in metrics:
+        weights = np.maximum(dat, 0)
+        total = weights.sum(axis=1)
+        valid = total > 0
+        weights[valid] /= total[valid][:, np.newaxis]
+        if 'entropy' in metrics:
+            plogp = np.zeros(weights.shape, dtype=np.float32)
+            nonzero = weights > 0
+            plogp[nonzero] = weights[nonzero] * np.log(weights[nonzero])
+            entropy = -plogp.sum(axis=1)
+            if n_nets > 1:
+                entropy /= np.log(n_nets)
+            values['entropy'] = entropy.astype(np.float32)
+        if 'participation' in metrics:
+            part = 1 - (weights**2).sum(axis=1)
+            part[~valid] = 0
+            if n_nets > 1:
+                part *= n_nets / (n_nets - 1.)
+            values['participation'] = part.astype(np.float32)
+    return values
+
+def calculate_metrics(dat_array, mask=None, metrics=MARGINS,
+                      chunk_size=50000):
+    """
+    Computes affiliation_metrics for every voxel of a (x, y, z, networks)
+    array, over chunks of chunk_size brain-masked voxels read from
+    dat_array one chunk at a time (MaskedVolumeStack.iter_extract),
+    so only one chunk of voxels is copied (and cast to float32, the
+    precision of affiliation_metrics) at a time, and of a nibabel proxy
+    only the slices of that chunk are read
+
+    Input:
+    dat_array : numpy array, memory map or nibabel proxy (img.dataobj)
+                last axis is networks
+    mask : numpy array or None
+                voxels to compute (shape dat_array.shape[:-1]), default all
+    metrics : list
+                see affiliation_metrics
+    chunk_size : int
+                number of voxels per chunk
 
     Returns:
-    prim_array : numpy array
-                array of max values across the last dimension
-    other_array : numpy masked array
-                masked array of all values from dat_array2d
-                except those contained in prim_array
-    """
-    assert len(dat_array2d.shape) == 2
-    prim_net_idx = dat_array2d.argmax(axis=1)
-    prim_net = dat_array2d.max(axis=1)
-    prim_net = np.reshape(prim_net, (dat_array2d.shape[0],1))
-    other_nets = np.ma.array(dat_array2d, mask=False)
-    other_nets.mask[np.arange(len(dat_array2d)),prim_net_idx] = True
-    return prim_net, other_nets
-
-def calculate_diff_map(dat_array):
+    values : dict of numpy arrays (shape dat_array.shape[:-1])
+            see affiliation_metrics, 0 outside mask
+    """
+    if mask is None:
+        mask = np.ones(dat_array.shape[:-1], dtype=bool)
+    stack = volstack.MaskedVolumeStack.from_mask(mask)
+    chunk_values = [affiliation_metrics(chunk, metrics)
+                    for _, chunk in stack.iter_extract(dat_array,
+                                                       chunk_size)]
+    values = {}
+    if chunk_values:
+        for key in chunk_values[0]:
+            values[key] = stack.to_volume(np.concatenate(
+                [val[key] for val in chunk_values]))
+    for key in metrics:
+        # empty mask
+        if key not in values:
+            dtype = np.int16 if key == 'winner' else np.float32
+            values[key] = np.zeros(stack.shape, dtype=dtype)
+    return values
+
+def calculate_margins(dat_array, mask=None, chunk_size=50000):
+    """
+    Computes affiliation_margins for every voxel of a (x, y, z, networks)
+    array (see calculate_metrics)
+
+    Returns:
+    margins : dict of numpy arrays (float32, shape dat_array.shape[:-1])
+            see affiliation_margins, 0 outside mask
+    """
+    return calculate_metrics(dat_array, mask, MARGINS, chunk_size)
+
+def calculate_diff_map(dat_array, mask=None):
     """
     Takes a numpy array and finds the mean difference between the max 
     value and all others across time/scans. 
 
     Input:
     dat_array : numpy array (at least 2d)
+    mask : numpy array or None
+                voxels to compute, see calculate_margins
 
     Returns:
-    meandiff_array : numpy array
+    meandiff_array : numpy array (float32)
                 The mean difference between the primary network and
                 each of the other networks
-    sumdiff_array : numpy array
-                The sum of sifferences beterrn prmaru network and 
-                each of the other networks
-    splitdiff_array : numpy array
-                The difference between the primary network and the sum
-                of all other networks
+                (see calculate_margins for the difference between the
+                primary network and the second network, or the sum of
+                all other networks)
     """
     dat_array = np.atleast_2d(dat_array)
-    n_voxels, n_nets = get_dims(dat_array)
-    dat_array2d = np.reshape(dat_array, (n_voxels, n_nets))
-    prim_net, other_nets = get_primary_net(dat_array2d) 
-    other_nets_mean = other_nets.mean(axis=1)
-    other_nets_mean = np.reshape(other_nets_mean, (other_nets_mean.shape[0],1))
-    nets_diff = prim_net - other_nets_mean
-    nets_diff_array = np.reshape(nets_diff, (dat_array.shape[:-1]))
-    return nets_diff_array
-
-def main(datafiles):
-    for subj_file in datafiles:
-        subid = gu.get_subid(subj_file, subjstr)
-        print 'Starting on subject %s'%(subid)
-        dat, aff = gu.load_nii(subj_file)
-        nets_dat = dat[:,:,:,net_idx]
-        nets_diff_array = calculate_diff_map(nets_dat)
-        nets_diff_outfile = os.path.join(outdir, ''.join(['nets_diff_',subid,'.nii.gz']))
-        gu.save_nii(nets_diff_outfile, nets_diff_array, aff)
-        
-        
+    return calculate_margins(dat_array, mask)['meandiff']
+
+def get_subid(filename, subjstr):
+    """
+    Returns the first match of regular expression subjstr in the
+    filename (eg. subject[0-9]{5}), raises ValueError if none
+    """
+    m = re.search(subjstr, os.path.split(filename)[1])
+    if m is None:
+        raise ValueError('no %s in %s'%(subjstr, filename))
+    return m.group()
+
+def load_networks(subj_file, net_idx):
+    """
+    Reads only the network volumes net_idx of a 4D (dual regression
+    stage 2) file, without loading the full 4D array (memory mapped
+    through the imgio cache)
+
+    Returns:
+    nets_dat : numpy array
+            (x, y, z, len(net_idx)) array
+    aff : numpy array
+            affine of subj_file
+    """
+    aff = imgio.load(subj_file).get_affine()
+    return imgio.read_volumes(subj_file, net_idx), aff
+
+def load_mask(mask):
+    """ boolean array from mask filename, array or None"""
+    if mask is None:
+        return None
+    if isinstance(mask, basestring):
+        mask = imgio.get_data(mask)
+    return np.asarray(mask) > 0
+
+@tracing.traced(subject=lambda callargs: get_subid(callargs['subj_file'],
+                                                  callargs['subjstr']))
+def subject_metric_maps(subj_file, net_idx, outdir,
+                        subjstr='subject[0-9]{5}', mask=None,
+                        metrics=('meandiff',)):
+    """
+    Writes affiliation metric maps (see affiliation_metrics) of the
+    selected networks of one subject, all from one read, to
+    outdir/<METRICS[metric]>_<subid>.nii.gz
+
+    Returns:
+    subid : str
+    outfiles : dict
+            {metric : outfile}
+    """
+    subid = get_subid(subj_file, subjstr)
+    nets_dat, aff = load_networks(subj_file, net_idx)
+    values = calculate_metrics(nets_dat, load_mask(mask), metrics)
+    outfiles = {}
+    for metric in metrics:
+        outfile = os.path.join(outdir, ''.join([METRICS[metric], '_', subid,
+                                                '.nii.gz']))
+        nib.Nifti1Image(values[metric], aff).to_filename(outfile)
+        outfiles[metric] = outfile
+    return subid, outfiles
+
+def subject_diff_map(subj_file, net_idx, outdir, subjstr='subject[0-9]{5}',
+                     mask=None):
+    """
+    Writes the mean difference map (see calculate_diff_map) of the
+    selected networks of one subject to outdir/nets_diff_<subid>.nii.gz
+
+    Returns:
+    subid : str
+    outfile : str
+    """
+    subid, outfiles = subject_metric_maps(subj_file, net_idx, outdir,
+                                          subjstr, mask)
+    return subid, outfiles['meandiff']
+
+def _subject_metric_maps(args):
+    return subject_metric_maps(*args)
+
+def cohort_metric_maps(datafiles, net_idx, outdir,
+                       subjstr='subject[0-9]{5}', mask=None, nproc=1,
+                       metrics=('meandiff',), cohort_names=None):
+    """
+    Affiliation metric maps of the selected networks for every subject,
+    run over nproc processes, and each metric stacked into one cohort
+    4D file
+
+    Input:
+    datafiles : list
+            4D files in which networks are concatenated over time
+            (eg. dr_stage2_subject*_Z.nii.gz)
+    net_idx : list
+            indices of networks to include, start count at 0
+    outdir : str
+            directory for subject maps and cohort files
+    subjstr : str
+            regular expression of subject id in datafiles
+    mask : str, numpy array or None
+            brain mask, maps are 0 outside (default all voxels)
+    nproc : int
+            number of processes
+    metrics : list
+            see affiliation_metrics
+    cohort_names : dict or None
+            {metric : cohort name}, default <METRICS[metric]>_cohort
+
+    Returns:
+    outfiles : dict
+            {metric : per subject maps, in the order of datafiles}
+    cohort_files : dict
+            {metric : cohort 4D file <cohort name>.nii.gz}, subject ids
+            in the order of the volumes are written to
+            <cohort name>.txt
+    """
+    mask = load_mask(mask)
+    args = [(f, net_idx, outdir, subjstr, mask, metrics) for f in datafiles]
+    if nproc > 1 and len(args) > 1:
+        pool = Pool(min(nproc, len(args)))
+        try:
+            results = pool.map(_subject_metric_maps, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_subject_metric_maps(arg) for arg in args]
+    subids = [subid for subid, _ in results]
+    outfiles, cohort_files = {}, {}
+    for metric in metrics:
+        outfiles[metric] = [files[metric] for _, files in results]
+        merged = rapid_art.make_4d_nibabel(outfiles[metric], outdir=outdir,
+                                           compress=True)
+        cohort_name = (cohort_names or {}).get(metric,
+                                               METRICS[metric] + '_cohort')
+        cohort_files[metric] = os.path.join(outdir, cohort_name + '.nii.gz')
+        os.rename(merged, cohort_files[metric])
+        with open(os.path.join(outdir, cohort_name + '.txt'), 'w+') as fid:
+            fid.write('\n'.join(subids) + '\n')
+    return outfiles, cohort_files
+
+def cohort_diff_maps(datafiles, net_idx, outdir, subjstr='subject[0-9]{5}',
+                     mask=None, nproc=1, cohort_name='nets_diff_cohort'):
+    """
+    Mean difference maps of the selected networks for every subject,
+    stacked into one cohort 4D file (see cohort_metric_maps)
+
+    Input:
+    cohort_name : str
+            cohort files are <cohort_name>.nii.gz and <cohort_name>.txt
+            (subject ids in the order of the volumes)
+
+    Returns:
+    outfiles : list
+            per subject difference maps, in the order of datafiles
+    cohort_file : str
+            cohort 4D file
+    """
+    outfiles, cohort_files = cohort_metric_maps(
+        datafiles, net_idx, outdir, subjstr, mask, nproc, ('meandiff',),
+        {'meandiff': cohort_name})
+    return outfiles['meandiff'], cohort_files['meandiff']
+
+def main(datadir, outdir, net_idx, dataglobstr='dr_stage2_subject*_Z.nii.gz',
+         subjstr='subject[0-9]{5}', mask=None, nproc=1,
+         metrics=('meandiff',)):
+    datafiles = sorted(glob(os.path.join(datadir, dataglobstr)))
+    if len(datafiles) == 0:
+        raise IOError('no %s in %s'%(dataglobstr, datadir))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    outfiles, cohort_files = cohort_metric_maps(datafiles, net_idx, outdir,
+                                                subjstr, mask, nproc, metrics)
+    for metric in metrics:
+        print 'Saved %d %s maps, cohort %s'%(len(outfiles[metric]), metric,
+                                             cohort_files[metric])
+    return outfiles, cohort_files
+
+
 if __name__ == '__main__':
-        
+
     #Path to 4D files in which networks are concatenated over time
     datadir = '/home/jagust/rsfmri_ica/data/Allsubs_YoungICA_2mm_IC30.gica/dual_regress'
     #Directory to output difference maps
     outdir = '/home/jagust/rsfmri_ica/data/Allsubs_YoungICA_2mm_IC30.gica/difference_maps'
     subjstr = 'subject[0-9]{5}'
     dataglobstr = 'dr_stage2_subject*_Z.nii.gz'
-    datafiles = glob(os.path.join(datadir, dataglobstr))
     #Indicies of networks to include. Start count at 0. 
     net_idx = [0,1,2,3,4,6,7,8,9,12,14,15,24,29] 
+    nproc = 8
+    #Affiliation metrics to compute, see affiliation_metrics
+    metrics = ['meandiff', 'winner', 'entropy', 'participation']
 
-    main(datafiles)
-
+    main(datadir, outdir, net_idx, dataglobstr, subjstr, nproc=nproc,
+         metrics=metrics)
@@ -0,0 +1,550 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Cached pipeline runner
+
+A pipeline is a list of Nodes, each a call of a stage function with
+file inputs, parameters and the results of upstream nodes. Every node
+has a key, the sha1 of its stage function name (and Node.version),
+parameters, the contents of its input files and the keys of its
+upstream nodes. It writes to its own directory <store>/<name>/<key[:16]>,
+and its result (json, usually a dict of output files) is saved there
+once it succeeds. A node is only run if no result exists for its key,
+so after a parameter or input change only the nodes that depend on it
+run again. Nodes whose upstream nodes are done run in parallel, over
+nproc processes.
+
+cohort_pipeline describes the chain QA (rapid_art confounds) -> dual
+regression (stage 1 and 2) -> template matching -> network affiliation
+for a cohort
+
+>>> nodes = cohort_pipeline(subjects, template, mask, net_idx=[0, 3])
+>>> status = run_pipeline(nodes, '/home/jagust/rsfmri/pipeline', nproc=8)
+
+python pipeline.py -store /home/jagust/rsfmri/pipeline -nproc 8 config.json
+"""
+import os, sys
+import json
+import shutil
+import hashlib
+import traceback
+import argparse
+import Queue
+from multiprocessing import Pool
+import numpy as np
+from cohort_qa import input_manifest, load_json, save_json
+import imgio
+import tracing
+
+RESULT = 'result.json'
+HASHES = 'input_hashes.json'
+
+
+class Node(object):
+    """
+    one step of a pipeline
+
+    Parameters
+    ----------
+    name : str
+        unique name of the node (eg. dr_B05-201)
+    func : function
+        module level stage function (run in worker processes), called as
+        func(outdir, **kwargs) and returning a json serializable result
+    inputs : dict
+        {argument : file or list of files}, keyed by their contents
+    params : dict
+        {argument : json serializable value}
+    upstream : dict
+        {argument : node name, (node name, field) or list of these}, the
+        argument is the result of the node (or its field)
+    version : int
+        bump to invalidate cached results of func after changing it
+    """
+    def __init__(self, name, func, inputs=None, params=None, upstream=None,
+                 version=0):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or {}
+        self.params = params or {}
+        self.upstream = upstream or {}
+        self.version = version
+
+    def __repr__(self):
+        return 'Node(%s, %s)'%(self.name, self.func.__name__)
+
+    def dependencies(self):
+        """ names of upstream nodes"""
+        deps = []
+        for ref in self.upstream.values():
+            if not isinstance(ref, list):
+                ref = [ref]
+            for item in ref:
+                if isinstance(item, (tuple, list)):
+                    item = item[0]
+                if item not in deps:
+                    deps.append(item)
+        return deps
+
+    def input_files(self):
+        files = []
+        for val in self.inputs.values():
+            if isinstance(val, basestring):
+                val = [val]
+            files.extend([os.path.abspath(f) for f in val])
+        return files
+
+
+def sort_nodes(nodes):
+    """ nodes in dependency order, raises ValueError on duplicate or
+    missing names and cycles"""
+    bynme = {}
+    for node in nodes:
+        if node.name in bynme:
+            raise ValueError('duplicate node %s'%node.name)
+        bynme[node.name] = node
+    ordered, done, visiting = [], set(), set()
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError('cycle: %s'%' -> '.join(path + [name]))
+        if name not in bynme:
+            raise ValueError('%s depends on missing node %s'%(path[-1],
+                                                              name))
+        visiting.add(name)
+        for dep in bynme[name].dependencies():
+            visit(dep, path + [name])
+        visiting.discard(name)
+        done.add(name)
+        ordered.append(bynme[name])
+    for node in nodes:
+        visit(node.name, [])
+    return ordered
+
+
+def node_key(node, keys, hashes):
+    """ sha1 of the stage function name and version, parameters, input
+    file contents (hashes {abspath : sha1}) and upstream keys of node"""
+    def content(val):
+        if isinstance(val, basestring):
+            return hashes[os.path.abspath(val)]
+        return [hashes[os.path.abspath(f)] for f in val]
+    def upstream_key(ref):
+        if isinstance(ref, list):
+            return [upstream_key(item) for item in ref]
+        if isinstance(ref, tuple):
+            return [keys[ref[0]], ref[1]]
+        return keys[ref]
+    # the function name, not its module (__main__ when run as a script)
+    desc = {'func': node.func.__name__,
+            'version': node.version,
+            'params': node.params,
+            'inputs': dict([(k, content(v))
+                            for k, v in node.inputs.items()]),
+            'upstream': dict([(k, upstream_key(v))
+                              for k, v in node.upstream.items()])}
+    return hashlib.sha1(json.dumps(desc, sort_keys=True)).hexdigest()
+
+
+def node_dir(store, node, key):
+    return os.path.join(store, node.name, key[:16])
+
+
+def _result_files(result, outdir):
+    """ strings in result that are paths within outdir"""
+    if isinstance(result, dict):
+        result = result.values()
+    if isinstance(result, basestring):
+        result = [result]
+    files = []
+    for val in result:
+        if isinstance(val, (dict, list, tuple)):
+            files.extend(_result_files(val, outdir))
+        elif isinstance(val, basestring) and \
+             os.path.abspath(val).startswith(outdir + os.sep):
+            files.append(val)
+    return files
+
+
+def cached_result(outdir):
+    """ (True, result) if outdir holds a complete result whose files all
+    exist, else (False, None)"""
+    saved = load_json(os.path.join(outdir, RESULT))
+    if saved is None:
+        return False, None
+    result = saved['result']
+    if not all([os.path.exists(f) for f in _result_files(result, outdir)]):
+        return False, None
+    return True, result
+
+
+def resolve(node, results):
+    """ arguments of node's stage function (outdir excluded), input
+    files as absolute paths (as they are hashed)"""
+    def lookup(ref):
+        if isinstance(ref, list):
+            return [lookup(item) for item in ref]
+        if isinstance(ref, tuple):
+            return results[ref[0]][ref[1]]
+        return results[ref]
+    kwargs = dict(node.params)
+    for arg, val in node.inputs.items():
+        if isinstance(val, basestring):
+            kwargs[arg] = os.path.abspath(val)
+        else:
+            kwargs[arg] = [os.path.abspath(f) for f in val]
+    for arg, ref in node.upstream.items():
+        kwargs[arg] = lookup(ref)
+    return kwargs
+
+
+def _run_node(args):
+    """ Pool worker, run one node into outdir (cleared first, a partial
+    earlier run may be there), returns (name, status, result or
+    traceback)"""
+    name, func, outdir, kwargs = args
+    try:
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(outdir)
+        with tracing.span(name, 'node'):
+            result = func(outdir, **kwargs)
+        save_json({'node': name, 'result': result},
+                  os.path.join(outdir, RESULT))
+        return name, 'ran', result
+    except Exception:
+        return name, 'failed', traceback.format_exc()
+
+
+def run_pipeline(nodes, store, nproc=1, force=()):
+    """
+    run the nodes whose results are not cached in store
+
+    Parameters
+    ----------
+    nodes : list
+        Node instances
+    store : str
+        directory holding node outputs and results
+    nproc : int
+        number of worker processes (default 1, in this process)
+    force : list
+        names of nodes to re-run even if cached
+
+    Returns
+    -------
+    status : dict
+        {name : {'status': 'ran', 'current', 'failed' or 'skipped' (an
+        upstream node failed), 'key': str, 'outdir': str, 'result':
+        result, 'error': traceback if failed}}
+    """
+    ordered = sort_nodes(nodes)
+    store = os.path.abspath(store)
+    if not os.path.isdir(store):
+        os.makedirs(store)
+    hashfile = os.path.join(store, HASHES)
+    allfiles = []
+    for node in ordered:
+        allfiles.extend(node.input_files())
+    manifest = input_manifest(sorted(set(allfiles)), load_json(hashfile))
+    save_json(manifest, hashfile)
+    hashes = dict([(f, entry['sha1']) for f, entry in manifest.items()])
+    keys, status, results = {}, {}, {}
+    for node in ordered:
+        keys[node.name] = node_key(node, keys, hashes)
+        status[node.name] = {'key': keys[node.name],
+                             'outdir': node_dir(store, node,
+                                                keys[node.name])}
+
+    finished = Queue.Queue()
+    pool = None
+    if nproc > 1:
+        pool = Pool(nproc)
+    waiting = list(ordered)
+    running = 0
+    try:
+        while waiting or running:
+            for node in list(waiting):
+                deps = node.dependencies()
+                if not all(['status' in status[d] for d in deps]):
+                    continue
+                waiting.remove(node)
+                entry = status[node.name]
+                if any([status[d]['status'] in ('failed', 'skipped')
+                        for d in deps]):
+                    entry['status'] = 'skipped'
+                    continue
+                if node.name not in force:
+                    current, result = cached_result(entry['outdir'])
+                    if current:
+                        entry.update(status='current', result=result)
+                        results[node.name] = result
+                        continue
+                args = (node.name, node.func, entry['outdir'],
+                        resolve(node, results))
+                running += 1
+                if pool is None:
+                    finished.put(_run_node(args))
+                else:
+                    pool.apply_async(_run_node, (args,),
+                                     callback=finished.put)
+            if not running:
+                continue
+            # a timeout, so KeyboardInterrupt gets through
+            name, state, result = finished.get(True, 1e6)
+            running -= 1
+            if state == 'failed':
+                status[name].update(status='failed', error=result)
+            else:
+                status[name].update(status='ran', result=result)
+                results[name] = result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return status
+
+
+def stale_nodes(nodes, store):
+    """ names of nodes that run_pipeline would run, those without a
+    cached result for their key (a node re-run with an unchanged key
+    leaves the keys of its dependents unchanged)"""
+    ordered = sort_nodes(nodes)
+    store = os.path.abspath(store)
+    previous = load_json(os.path.join(store, HASHES))
+    allfiles = []
+    for node in ordered:
+        allfiles.extend(node.input_files())
+    manifest = input_manifest(sorted(set(allfiles)), previous)
+    hashes = dict([(f, entry['sha1']) for f, entry in manifest.items()])
+    keys, stale = {}, []
+    for node in ordered:
+        keys[node.name] = node_key(node, keys, hashes)
+        current, _ = cached_result(node_dir(store, node, keys[node.name]))
+        if not current:
+            stale.append(node.name)
+    return stale
+
+
+################################################################
+# stages of the QA -> dual regression -> matching -> affiliation
+# chain, module level so they run in worker processes
+
+
+def _import_stage_modules():
+    """ dual regression and matching modules (ica/ and match/)"""
+    try:
+        from ..ica import python_dual_regress
+        from ..match import matching
+    except (ValueError, ImportError):
+        # imported as a top level module (tools/ on sys.path)
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir)
+        for sub in ('ica', 'match'):
+            if not os.path.join(root, sub) in sys.path:
+                sys.path.insert(0, os.path.join(root, sub))
+        import python_dual_regress
+        import matching
+    return python_dual_regress, matching
+
+
+def qa_stage(outdir, infile, param_file, param_source='SPM', thresh=3):
+    """
+    artifact detection (rapid_art) of one subject, saving confound
+    regressors (motion parameters and spike regressors) and the frame
+    censoring mask
+
+    Returns
+    -------
+    result : dict
+        qadir, confounds, censor
+    """
+    import rapid_art
+    import run_image_qa
+    art = rapid_art.main([infile], param_file, param_source, thresh, outdir,
+                         clobber=True)
+    mc_params = np.loadtxt(param_file)
+    outliers = np.asarray(art['outliers'], dtype=int)
+    run_image_qa.CombineRegressors(mc_params, outliers, outdir,
+                                   'confound_regressors.txt')
+    censor = run_image_qa.save_censor_mask(
+        outliers, len(mc_params), os.path.join(outdir, 'censor_mask.txt'))
+    return {'qadir': os.path.join(outdir, 'data_QA'),
+            'confounds': os.path.join(outdir, 'confound_regressors.txt'),
+            'censor': censor}
+
+
+def dual_regression_stage(outdir, infile, template, mask, confounds=None,
+                          desnorm=True):
+    """
+    dual regression stage 1 (template timeseries) and stage 2 (subject
+    spatial maps, confounds added to the design) of one subject
+
+    Returns
+    -------
+    result : dict
+        stage1, stage2, stage2_z
+    """
+    pydr, _ = _import_stage_modules()
+    if isinstance(confounds, dict):
+        confounds = confounds['confounds']
+    pth, nme, _ = imgio.split_filename(template)
+    template = os.path.join(pth, nme)
+    stage1 = pydr.template_timeseries_sub(infile, template, mask, outdir)
+    if stage1 is None:
+        raise IOError('dual regression stage 1 failed on %s'%infile)
+    stage2, stage2_z = pydr.sub_spatial_map(infile, stage1, mask, outdir,
+                                            desnorm, mvt=confounds)
+    if stage2 is None:
+        raise IOError('dual regression stage 2 failed on %s'%infile)
+    return {'stage1': stage1, 'stage2': stage2, 'stage2_z': stage2_z}
+
+
+def match_stage(outdir, networks, template, thresh=0, mask=None):
+    """
+    goodness of fit of every subject network (4D) with every template
+    network thresholded at thresh, saved as a networks X templates
+    matrix to gof.txt, the best matching network of each template to
+    best_match.txt
+
+    Returns
+    -------
+    result : dict
+        gof, best_match
+    """
+    _, matching = _import_stage_modules()
+    if isinstance(networks, dict):
+        networks = networks['stage2_z']
+    subdat = imgio.get_data(networks)
+    templates = matching.TemplateNetworks(template, thresh)
+    tdat = templates.get_volumes(range(len(templates)))
+    if mask is None:
+        maskdat = np.abs(subdat).sum(axis=3) > 0
+    else:
+        maskdat = imgio.get_data(mask) > 0
+    gof = matching.calc_gof_matrix(matching.get_masked_rows(subdat, maskdat),
+                                   matching.get_masked_rows(tdat, maskdat))
+    gof_file = os.path.join(outdir, 'gof.txt')
+    np.savetxt(gof_file, gof, fmt='%2.6f')
+    best_file = os.path.join(outdir, 'best_match.txt')
+    np.savetxt(best_file, gof.argmax(axis=0), fmt='%d')
+    return {'gof': gof_file, 'best_match': best_file}
+
+
+def affiliation_stage(outdir, datafiles, net_idx,
+                      subjstr='B[0-9]{2}-[0-9]{3}', mask=None,
+                      metrics=('meandiff',)):
+    """
+    network affiliation metric maps of every subject and their cohort
+    files (see net_affiliation.cohort_metric_maps)
+
+    Returns
+    -------
+    result : dict
+        {metric : cohort 4D file}
+    """
+    import net_affiliation
+    datafiles = [f['stage2_z'] if isinstance(f, dict) else f
+                 for f in datafiles]
+    _, cohort_files = net_affiliation.cohort_metric_maps(
+        datafiles, net_idx, outdir, subjstr, mask, metrics=metrics)
+    return cohort_files
+
+
+def cohort_pipeline(subjects, template, mask, net_idx=None, param_source='SPM',
+                    thresh=3, match_thresh=0, desnorm=True,
+                    subjstr='B[0-9]{2}-[0-9]{3}', metrics=('meandiff',)):
+    """
+    nodes of the QA -> dual regression -> matching -> affiliation chain
+
+    Parameters
+    ----------
+    subjects : list
+        (subid, infile, param_file) of each subject, infile in template
+        space, subid matching subjstr
+    template : str
+        4D template networks (eg. melodic_IC.nii.gz)
+    mask : str
+        dual regression mask
+    net_idx : list or None
+        networks of the affiliation maps (no affiliation node if None)
+    param_source, thresh : see rapid_art.main
+    match_thresh : float
+        template threshold of matching
+    desnorm : bool
+        normalise stage 2 design columns
+    subjstr, metrics : see net_affiliation.cohort_metric_maps
+
+    Returns
+    -------
+    nodes : list
+        qa_<subid>, dr_<subid>, match_<subid> per subject and one
+        affiliation node
+    """
+    nodes = []
+    for subid, infile, param_file in subjects:
+        nodes.append(Node('qa_%s'%subid, qa_stage,
+                          inputs={'infile': infile, 'param_file': param_file},
+                          params={'param_source': param_source,
+                                  'thresh': thresh}))
+        nodes.append(Node('dr_%s'%subid, dual_regression_stage,
+                          inputs={'infile': infile, 'template': template,
+                                  'mask': mask},
+                          params={'desnorm': desnorm},
+                          upstream={'confounds': 'qa_%s'%subid}))
+        nodes.append(Node('match_%s'%subid, match_stage,
+                          inputs={'template': template, 'mask': mask},
+                          params={'thresh': match_thresh},
+                          upstream={'networks': ('dr_%s'%subid,
+                                                 'stage2_z')}))
+    if net_idx is not None:
+        nodes.append(Node('affiliation', affiliation_stage,
+                          inputs={'mask': mask},
+                          params={'net_idx': list(net_idx),
+                                  'subjstr': subjstr,
+                                  'metrics': list(metrics)},
+                          upstream={'datafiles': [('dr_%s'%subid, 'stage2_z')
+                                                  for subid, _, _
+                                                  in subjects]}))
+    return nodes
+
+
+def print_status(status):
+    for name in sorted(status):
+        entry = status[name]
+        print '%-30s %-8s %s'%(name, entry['status'], entry['outdir'])
+        if entry['status'] == 'failed':
+            print entry['error']
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run the cached QA -> dual regression -> matching -> '+\
+        'affiliation pipeline for a cohort')
+    parser.add_argument('config', type=str,
+                        help="""json file of cohort_pipeline arguments,
+                        subjects is a list of [subid, infile, param_file]""")
+    parser.add_argument('-store', dest='store', required=True,
+                        help='directory holding all pipeline outputs')
+    parser.add_argument('-nproc', type=int, dest='nproc', default=1,
+                        help='number of worker processes (default 1)')
+    parser.add_argument('-force', dest='force', nargs='+', default=[],
+                        help='nodes to re-run even if up to date')
+    parser.add_argument('-dry', action='store_true', dest='dry',
+                        help='only list the nodes that would run')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+    else:
+        args = parser.parse_args()
+        config = load_json(args.config)
+        if config is None:
+            raise IOError('cannot read %s'%args.config)
+        nodes = cohort_pipeline(**config)
+        if args.dry:
+            print '\n'.join(stale_nodes(nodes, args.store))
+        else:
+            print_status(run_pipeline(nodes, args.store, args.nproc,
+                                      args.force))
@@ -0,0 +1,260 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+One pass voxelwise QA statistics for fMRI series
+
+The 4D data are read once, in chunks of volumes, and every QA map and
+trace is accumulated from that single read
+
+mean, std, min, max, tsnr : running (Welford / Chan) mean and variance
+volume_means, slice_mean_diff2, volume_mean_diff2, diff2_mean_vol,
+slice_diff2_max_vol : time point to time point slice differences
+    (as nipy.algorithms.diagnostics.time_slice_diffs)
+dvars : root mean square (over brain mask) of volume to volume change
+pca : spatial principal components of the time centred data, from a
+    single pass randomized sketch (Tropp et al. 2017, SIAM J Matrix Anal
+    Appl 38(4)), with pca_timecourses and pca_variance
+"""
+import os
+import numpy as np
+import nibabel as ni
+import artdetect
+import imgio
+import tracing
+
+
+class QAStats(object):
+    """
+    Streaming accumulator of QA statistics
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of a volume (x, y, z), slices are along z
+    mask : array or None
+        3D brain mask for dvars and pca, if None the mask is taken from
+        the first volume (voxels > mean / 8, as spm_global)
+    ncomp : int
+        number of principal components (default 10)
+    seed : int
+        seed of the random sketch matrices (default 0)
+
+    Examples
+    --------
+    >>> qa = QAStats(shape)
+    >>> for chunk in chunks:
+    ...     qa.update(chunk)
+    >>> results = qa.finalize()
+    """
+    def __init__(self, shape, mask=None, ncomp=10, seed=0):
+        self.shape = tuple(shape)
+        self.mask = mask
+        self.ncomp = ncomp
+        self.prng = np.random.RandomState(seed)
+        self.n = 0
+        self.mean = np.zeros(self.shape)
+        self.m2 = np.zeros(self.shape)
+        self.min = None
+        self.max = None
+        self.last = None
+        self.volume_means = []
+        self.slice_mean_diff2 = []
+        self.dvars = []
+        self.diff2_sum = np.zeros(self.shape)
+        self.slice_diff2_max_vol = np.zeros(self.shape)
+        self.slice_diff2_maxes = np.zeros(self.shape[2])
+        # sketch sizes, range (k) and co-range (l)
+        self.k = 2 * ncomp + 1
+        self.l = 2 * self.k + 1
+
+    def _init_mask(self, vol):
+        if self.mask is None:
+            self.mask = vol > (vol.mean() / 8.)
+        self.mask = np.asarray(self.mask) > 0
+        if not self.mask.shape == self.shape:
+            raise ValueError('dimension mismatch, mask: %s, data: %s'%(
+                self.mask.shape, self.shape))
+        nvox = self.mask.sum()
+        self.omega = self.prng.randn(nvox, self.k)
+        self.y = []
+        self.psi = []
+        self.w = np.zeros((self.l, nvox))
+
+    def update(self, chunk):
+        """ add chunk of volumes (x, y, z, nvols) to the statistics"""
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.ndim == 3:
+            chunk = chunk[..., np.newaxis]
+        if not chunk.shape[:3] == self.shape:
+            raise ValueError('dimension mismatch, chunk: %s, data: %s'%(
+                chunk.shape[:3], self.shape))
+        if self.n == 0:
+            self._init_mask(chunk[..., 0])
+        nb = chunk.shape[3]
+        # running mean and sum of squares (Chan et al. pairwise update)
+        mean_b = chunk.mean(axis=3)
+        m2_b = ((chunk - mean_b[..., np.newaxis])**2).sum(axis=3)
+        ntot = self.n + nb
+        delta = mean_b - self.mean
+        self.mean += delta * nb / float(ntot)
+        self.m2 += m2_b + delta**2 * self.n * nb / float(ntot)
+        if self.min is None:
+            self.min = chunk.min(axis=3)
+            self.max = chunk.max(axis=3)
+        else:
+            self.min = np.minimum(self.min, chunk.min(axis=3))
+            self.max = np.maximum(self.max, chunk.max(axis=3))
+        self.n = ntot
+        self.volume_means.extend(chunk.reshape((-1, nb)).mean(axis=0))
+        # time point differences, including across the chunk boundary
+        if self.last is None:
+            diffs = np.diff(chunk, axis=3)
+        else:
+            diffs = np.diff(np.concatenate((self.last[..., np.newaxis],
+                                            chunk), axis=3), axis=3)
+        self.last = chunk[..., -1].copy()
+        for t in range(diffs.shape[3]):
+            d2 = diffs[..., t]**2
+            self.diff2_sum += d2
+            slicemeans = d2.mean(axis=0).mean(axis=0)
+            self.slice_mean_diff2.append(slicemeans)
+            higher = slicemeans > self.slice_diff2_maxes
+            self.slice_diff2_maxes[higher] = slicemeans[higher]
+            self.slice_diff2_max_vol[:, :, higher] = d2[:, :, higher]
+            self.dvars.append(np.sqrt(d2[self.mask].mean()))
+        # single pass sketch of the (time X voxel) data matrix
+        masked = chunk[self.mask].T
+        psi = self.prng.randn(self.l, nb)
+        self.y.append(np.dot(masked, self.omega))
+        self.psi.append(psi)
+        self.w += np.dot(psi, masked)
+
+    def _pca(self):
+        """ principal components of time centred data from the sketch"""
+        mu = self.mean[self.mask]
+        y = np.concatenate(self.y) - np.dot(mu, self.omega)[np.newaxis, :]
+        psi = np.concatenate(self.psi, axis=1)
+        w = self.w - np.outer(psi.sum(axis=1), mu)
+        q, _ = np.linalg.qr(y)
+        b = np.linalg.lstsq(np.dot(psi, q), w, rcond=-1)[0]
+        ub, s, vt = np.linalg.svd(b, full_matrices=False)
+        ncomp = min(self.ncomp, len(s))
+        timecourses = np.dot(q, ub[:, :ncomp])
+        total = self.m2[self.mask].sum()
+        maps = np.zeros(self.shape + (ncomp,))
+        maps[self.mask] = (vt[:ncomp] * s[:ncomp, np.newaxis]).T
+        return maps, timecourses, s[:ncomp]**2 / total
+
+    def finalize(self):
+        """
+        Returns
+        -------
+        results : dict
+            mean, std, min, max, tsnr, diff2_mean_vol, slice_diff2_max_vol
+            3D arrays; volume_means, dvars (first value 0),
+            volume_mean_diff2 1D arrays; slice_mean_diff2 (T-1 X slices);
+            pca (x, y, z, ncomp), pca_timecourses (T X ncomp),
+            pca_variance (fraction of variance, per component); mask
+        """
+        if self.n < 2:
+            raise ValueError('need at least 2 volumes, got %d'%self.n)
+        res = {}
+        res['mean'] = self.mean
+        res['std'] = np.sqrt(self.m2 / self.n)
+        res['min'] = self.min
+        res['max'] = self.max
+        tsnr = np.zeros(self.shape)
+        valid = res['std'] > 1.e-3
+        tsnr[valid] = res['mean'][valid] / res['std'][valid]
+        res['tsnr'] = tsnr
+        res['volume_means'] = np.array(self.volume_means)
+        res['slice_mean_diff2'] = np.array(self.slice_mean_diff2)
+        res['volume_mean_diff2'] = res['slice_mean_diff2'].mean(axis=1)
+        res['diff2_mean_vol'] = self.diff2_sum / (self.n - 1)
+        res['slice_diff2_max_vol'] = self.slice_diff2_max_vol
+        res['dvars'] = np.concatenate(([0], self.dvars))
+        res['pca'], res['pca_timecourses'], res['pca_variance'] = self._pca()
+        res['mask'] = self.mask
+        return res
+
+
+def iter_chunks(infiles, chunk_size=20):
+    """ yield (x, y, z, n <= chunk_size) arrays of consecutive volumes
+    of a 4D file or list of 3D files (see artdetect.iter_volumes)"""
+    chunk = []
+    for vol in artdetect.iter_volumes(infiles):
+        chunk.append(vol)
+        if len(chunk) == chunk_size:
+            yield np.concatenate([x[..., np.newaxis] for x in chunk], axis=3)
+            chunk = []
+    if chunk:
+        yield np.concatenate([x[..., np.newaxis] for x in chunk], axis=3)
+
+
+@tracing.traced()
+def qa_stats(infiles, mask=None, ncomp=10, chunk_size=20, seed=0,
+             gsignal=None):
+    """
+    compute all QA statistics of a 4D file (or list of 3D files) in one
+    chunked read, see QAStats
+
+    Parameters
+    ----------
+    infiles : str or list
+        4D file or list of 3D files
+    mask : str or array or None
+        brain mask for dvars and pca (default None, from first volume)
+    ncomp : int
+        number of principal components (default 10)
+    chunk_size : int
+        number of volumes held in memory at a time (default 20)
+    gsignal : artdetect.GlobalSignal or None
+        also updated with every volume, so artifact detection needs no
+        read of its own
+
+    Returns
+    -------
+    results : dict
+        see QAStats.finalize
+    """
+    if isinstance(mask, basestring):
+        mask = imgio.get_data(mask)
+    qa = None
+    for chunk in iter_chunks(infiles, chunk_size):
+        if qa is None:
+            qa = QAStats(chunk.shape[:3], mask=mask, ncomp=ncomp, seed=seed)
+        qa.update(chunk)
+        if gsignal is not None:
+            for i in range(chunk.shape[3]):
+                gsignal.update(chunk[..., i])
+    return qa.finalize()
+
+
+def save_qa_stats(results, affine, outdir, name):
+    """
+    save QA maps (QA-<MAP>_<name>.nii.gz) and traces
+    (QA-<TRACE>_<name>.txt) in outdir
+
+    Returns
+    -------
+    outfiles : dict
+        {key of results : file}
+    """
+    maps = {'mean': 'MEAN', 'std': 'STD', 'tsnr': 'TSNR', 'pca': 'PCA',
+            'diff2_mean_vol': 'DIFF2MEAN',
+            'slice_diff2_max_vol': 'SLICEDIFF2MAX'}
+    traces = {'dvars': 'DVARS', 'volume_means': 'VOLMEAN',
+              'volume_mean_diff2': 'VOLDIFF2',
+              'slice_mean_diff2': 'SLICEDIFF2',
+              'pca_timecourses': 'PCA-TS', 'pca_variance': 'PCA-VAR'}
+    outfiles = {}
+    for key, label in maps.items():
+        outf = os.path.join(outdir, 'QA-%s_%s.nii.gz'%(label, name))
+        newimg = ni.Nifti1Image(results[key].astype(np.float32), affine)
+        newimg.to_filename(outf)
+        outfiles[key] = outf
+    for key, label in traces.items():
+        outf = os.path.join(outdir, 'QA-%s_%s.txt'%(label, name))
+        np.savetxt(outf, results[key], fmt='%2.6f')
+        outfiles[key] = outf
+    return outfiles
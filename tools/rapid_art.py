@@ -1,69 +1,184 @@
 import os, sys
 import numpy as np
 import nibabel as ni
-import nipype.algorithms.rapidart as rapidart
 from glob import glob
-import nipype.interfaces.fsl as fsl
-import nipype.algorithms.misc as misc
 import json
-import nipy
-import nipy.algorithms.diagnostics as diag
-from nipype.utils.filemanip import fname_presuffix
+import time
+from multiprocessing.pool import ThreadPool
 import shutil
 import argparse
+import artdetect
+import qa_stats
+import imgio
+import tracing
 
-def make_4d_nibabel(infiles,outdir=None):
-    shape = ni.load(infiles[0]).get_shape()
-    finalshape = tuple([x for x in shape]+[len(infiles)])
-    dat4d = np.empty(finalshape)
-    for val, f in enumerate(infiles):
-        tmpdat = ni.load(f).get_data()
-        tmpdat[np.isnan(tmpdat)] =  0
-        dat4d[:,:,:,val] = tmpdat
-    newimg = ni.Nifti1Image(dat4d, ni.load(infiles[0]).get_affine())
-    if outdir is None:
-        outf = fname_presuffix(infiles[0], prefix='data4d_')
+def _read_merge_volume(infile):
+    """ read 3D volume for make_4d_nibabel, unscaled if the file has no
+    scaling, float32 otherwise, with NaNs set to 0"""
+    img = ni.load(infile)
+    proxy = img.dataobj
+    if proxy.slope == 1 and proxy.inter == 0:
+        dat = np.asarray(proxy.get_unscaled())
     else:
-        outf = fname_presuffix(infiles[0], prefix='data4d_',newpath = outdir)
-    newimg.to_filename(outf)
+        dat = np.asarray(proxy, dtype=np.float32)
+    dat = dat.reshape(img.shape[:3])
+    if dat.dtype.kind == 'f':
+        dat = np.where(np.isnan(dat), 0, dat).astype(dat.dtype)
+    return dat
+
+
+@tracing.traced()
+def make_4d_nibabel(infiles, outdir=None, compress=False, nproc=1,
+                    compresslevel=None, nthreads=None):
+    """
+    merge 3D files into a 4D file, streaming one volume at a time
+    (NaNs are set to 0)
+
+    Parameters
+    ----------
+    infiles : list
+        list of 3D files, in time order
+    outdir : str
+        directory of merged file (default directory of infiles[0])
+    compress : bool
+        write gzipped data4d_<name>.nii.gz, else uncompressed (memory
+        mappable) data4d_<name>.nii (default False)
+    nproc : int
+        number of volumes read concurrently, useful when infiles are on
+        slow storage (default 1, peak memory is nproc volumes)
+    compresslevel, nthreads : int or None
+        gzip level and compression threads when compress (see
+        imgio.open_writer)
+
+    Returns
+    -------
+    outf : str
+        merged 4D file, in the data type all inputs promote to
+        (numpy.result_type, with float32 if any input is scaled)
+    """
+    imgs = [ni.load(f) for f in infiles]
+    shape = imgs[0].shape[:3]
+    for f, img in zip(infiles, imgs):
+        if not img.shape[:3] == shape or np.prod(img.shape[3:]) > 1:
+            raise ValueError('%s is not a 3D volume of shape %s'%(f, shape))
+    scaled = [not (img.dataobj.slope == 1 and img.dataobj.inter == 0)
+              for img in imgs]
+    # a common type, so no input is truncated to the type of infiles[0]
+    dtypes = [img.get_data_dtype() for img in imgs]
+    if any(scaled):
+        dtypes.append(np.float32)
+    hdr = ni.Nifti1Header.from_header(imgs[0].get_header())
+    hdr.set_data_shape(shape + (len(infiles),))
+    hdr.set_data_dtype(np.result_type(*dtypes))
+    hdr.set_slope_inter(1, 0)
+    hdr.set_data_offset(0)
+    dtype = hdr.get_data_dtype()
+    del imgs
+
+    ext = '.nii.gz' if compress else '.nii'
+    pth, nme, _ = imgio.split_filename(infiles[0])
+    if outdir is None:
+        outdir = pth
+    outf = os.path.join(outdir, 'data4d_' + nme + ext)
+    pool = None
+    if nproc > 1:
+        pool = ThreadPool(nproc)
+    try:
+        with imgio.open_writer(outf, compresslevel, nthreads) as fobj:
+            hdr.write_to(fobj)
+            fobj.write(b'\x00' * (hdr.get_data_offset() - fobj.tell()))
+            for start in range(0, len(infiles), nproc):
+                batch = infiles[start:start + nproc]
+                if pool is not None:
+                    vols = pool.map(_read_merge_volume, batch)
+                else:
+                    vols = [_read_merge_volume(batch[0])]
+                for vol in vols:
+                    fobj.write(vol.astype(dtype).tostring(order='F'))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     return outf
 
         
 def make_4d(infiles):
+    import nipype.interfaces.fsl as fsl
     merge = fsl.utils.Merge()
     merge.inputs.in_files = infiles
     merge.inputs.dimension = 't'
-    mrgout = merge.run()
+    mrgout = tracing.run_command(merge)
     return mrgout.outputs.merged_file
     
+def _load_outlier_voxels(outliers):
+    """ unique flat voxel indices listed in outliers file"""
+    return np.unique(np.atleast_1d(np.loadtxt(outliers, dtype=int)))
+
 def outlier_vol_fromfile(mean, outliers, fname = None):
-    _, filename = os.path.split(mean)
-    vox = np.loadtxt(outliers).astype(int)
+    """ save image (same space as mean) with value 100 at the voxels
+    (flat indices) listed in outliers file (int16), to fname (default
+    mean filename with mean replaced by outliers), returns fname"""
+    pth, filename = os.path.split(mean)
+    vox = _load_outlier_voxels(outliers)
     img = ni.load(mean)
-    newdat = np.zeros(img.get_shape()).flatten()
+    newdat = np.zeros(img.get_shape(), dtype=np.int16).flatten()
     newdat[vox] = 100
     newdat.shape = img.get_shape()
-    newimg = ni.Nifti1Image(newdat, img.get_affine())
     if fname is None:
-        newfile = filename.replace('mean', 'outliers')
-    newfile = fname
-    newimg.to_filename(newfile)
-    print os.path.abspath(newfile)
-
-def gen_sig2noise_img(in4d, outdir):
-    startdir = os.getcwd()
-    os.chdir(outdir)
-    tsnr = misc.TSNR()
-    tsnr.inputs.in_file = in4d
-    tsnrout = tsnr.run()
-    ## there is no valid return code for tsnr 
-    #if tsnrout.runtime.returncode == 0:
-    #    return tsnrout.outputs.tsnr_file
-    #else:
-    #    print tsnrout.runtime.stderr
-    #    return None
-    os.chdir(startdir)
-    return tsnrout.outputs.tsnr_file
+        fname = os.path.join(pth, filename.replace('mean', 'outliers'))
+    imgio.save(newdat, img.get_affine(), fname, dtype=np.int16)
+    return os.path.abspath(fname)
+
+def cohort_outlier_map(template, outlier_files, outfile):
+    """
+    voxelwise outlier frequency across subjects
+
+    Parameters
+    ----------
+    template : str
+        image defining the space (eg. a mean image) of the flat voxel
+        indices in outlier_files
+    outlier_files : list
+        one outliers file (see outlier_vol_fromfile) per subject
+    outfile : str
+        output 4D image (float32, written with imgio.save), volume 0 is
+        the number of subjects with an outlier at each voxel, volume 1
+        the fraction of subjects
+
+    Returns
+    -------
+    outfile : str
+    """
+    img = ni.load(template)
+    shape = img.get_shape()[:3]
+    nvox = int(np.prod(shape))
+    counts = np.zeros(nvox, dtype=np.int64)
+    for outliers in outlier_files:
+        vox = _load_outlier_voxels(outliers)
+        if len(vox) and (vox.max() >= nvox or vox.min() < 0):
+            raise IndexError('%s: voxel index out of range for %s'%(
+                outliers, shape))
+        # vox is unique, so one increment per subject and voxel without
+        # a full volume bincount per subject
+        counts[vox] += 1
+    out = np.empty(shape + (2,), dtype=np.float32)
+    out[..., 0] = counts.reshape(shape)
+    out[..., 1] = out[..., 0] / max(len(outlier_files), 1)
+    imgio.save(out, img.get_affine(), outfile, dtype=np.float32)
+    return os.path.abspath(outfile)
+
+def gen_sig2noise_img(in4d, outdir, qa=None):
+    """ save temporal signal to noise image (mean / std over time) of
+    in4d to <outdir>/<name>_tsnr.nii.gz
+    qa : results of qa_stats.qa_stats(in4d), computed if None"""
+    if qa is None:
+        qa = qa_stats.qa_stats(in4d)
+    _, nme = os.path.split(in4d)
+    outf = os.path.join(outdir, '%s_tsnr.nii.gz'%(nme.split('.')[0]))
+    newimg = ni.Nifti1Image(qa['tsnr'].astype(np.float32),
+                            ni.load(in4d).get_affine())
+    newimg.to_filename(outf)
+    return outf
 
 def make_qa_dir(inroot, name='data_QA'):
     qadir = os.path.join(inroot, name)
@@ -73,91 +188,104 @@ def make_qa_dir(inroot, name='data_QA'):
         os.mkdir(qadir)
         return qadir, False
 
-def run_artdetect(file4d, param_file, thresh = 4, param_source='SPM'):
-    startdir = os.getcwd()
-    pth, _ = os.path.split(param_file)
-    os.chdir(pth)
-    ad = rapidart.ArtifactDetect()
-    ad.inputs.realigned_files = file4d
-    ad.inputs.realignment_parameters = param_file
-    ad.inputs.parameter_source = param_source
-    ad.inputs.norm_threshold = 1
-    ad.inputs.mask_type = 'spm_global'
-    ad.inputs.use_differences = [True, False]
-    ad.inputs.zintensity_threshold = thresh
-    adout = ad.run()
-    os.chdir(startdir)
-    return adout
-
-def screen_data_dirnme(in4d, outdir):
-    """uses nipy diagnostic code to screen the data for
-    outlier values and saves results to three images
-    mean, std, pca, in same dir as original file(s)"""
-    img = nipy.load_image(in4d)
-    result = diag.screen(img)
-    # save mean, std, pca
-    pth, nme = os.path.split(in4d)
-    stripnme = nme.split('.')[0]
-    
-    pcafile = os.path.join(outdir,
-                           'QA-PCA_%s.nii.gz'%(nme))
-    meanfile = os.path.join(outdir,
-                            'QA-MEAN_%s.nii.gz'%(nme))
-    stdfile = os.path.join(outdir,
-                           'QA-STD_%s.nii.gz'%(nme))
-    nipy.save_image(result['mean'], meanfile)
-    nipy.save_image(result['std'], stdfile)
-    nipy.save_image(result['pca'], pcafile)
-    print 'saved: %s\n \t%s\n \t%s\n'%(pcafile, meanfile, stdfile)
-
-def save_qa_img_dirnme(in4d, outdir):
-    pth, nme = os.path.split(in4d)
-    img = nipy.load_image(in4d)
-    diag.plot_tsdiffs(diag.time_slice_diffs(img))
+def run_artdetect(infiles, param_file, thresh = 4, param_source='SPM',
+                  g=None):
+    """ find intensity (z > thresh) and motion (composite norm > 1mm)
+    outliers in 4D file, or list of 3D files, infiles
+    g : global signal of infiles, read from infiles if None
+    see artdetect.detect_artifacts"""
+    return artdetect.detect_artifacts(infiles, param_file,
+                                      param_source = param_source,
+                                      norm_threshold = 1,
+                                      zintensity_threshold = thresh,
+                                      use_differences = (True, False),
+                                      g = g)
+
+def screen_data_dirnme(in4d, outdir, qa=None):
+    """screen the data for outlier values and saves results to three
+    images mean, std, pca, in outdir
+    qa : results of qa_stats.qa_stats(in4d), computed if None"""
+    if qa is None:
+        qa = qa_stats.qa_stats(in4d)
+    _, nme, _ = imgio.split_filename(in4d)
+    affine = ni.load(in4d).get_affine()
+    outfiles = []
+    for key, label in [('pca', 'PCA'), ('mean', 'MEAN'), ('std', 'STD')]:
+        outf = os.path.join(outdir, 'QA-%s_%s.nii.gz'%(label, nme))
+        ni.Nifti1Image(qa[key].astype(np.float32), affine).to_filename(outf)
+        outfiles.append(outf)
+    print 'saved: %s\n \t%s\n \t%s\n'%tuple(outfiles)
+    return outfiles
+
+def save_qa_img_dirnme(in4d, outdir, qa=None):
+    """ plot time point to time point slice differences of in4d
+    to <outdir>/QA_<name>_<time>.png
+    qa : results of qa_stats.qa_stats(in4d), computed if None"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import nipy.algorithms.diagnostics as diag
+    if qa is None:
+        qa = qa_stats.qa_stats(in4d)
+    _, nme, _ = imgio.split_filename(in4d)
+    diag.plot_tsdiffs(qa)
     cleantime = time.asctime().replace(' ','-').replace(':', '_')
     figfile = os.path.join(outdir, 'QA_%s_%s.png'%(nme, cleantime))
-    pylab.savefig(figfile)
+    plt.savefig(figfile)
+    plt.close()
+    return figfile
 
+def run_qa(in4d, outdir, mask=None, ncomp=10):
+    """ one pass over in4d computing all QA maps and traces
+    (see qa_stats), saved in outdir with the slice difference plot
 
-def main(infile, param_file, param_source, thresh, outdir=None):
+    Returns
+    -------
+    qa : dict
+        results of qa_stats.qa_stats
+    outfiles : dict
+        {name : file} of saved maps, traces and plot
+    """
+    qa = qa_stats.qa_stats(in4d, mask=mask, ncomp=ncomp)
+    _, nme, _ = imgio.split_filename(in4d)
+    outfiles = qa_stats.save_qa_stats(qa, ni.load(in4d).get_affine(),
+                                      outdir, nme)
+    outfiles['plot'] = save_qa_img_dirnme(in4d, outdir, qa)
+    return qa, outfiles
 
-    
-    if len(infile) > 1:
-        # input is list, need to merge
-        if outdir is None:
-            outdir, _ = os.path.split(infile[0])
-        qadir, exists = make_qa_dir(outdir)
-        if exists:
-            print '%s exists, remove to re-run'%qadir
-            return None
-        merged = make_4d_nibabel(infile,outdir=qadir)
-    else:
-        merged = infile[0]
-        if outdir is None:
-            outdir, _ = os.path.split(merged)
-        qadir, exists = make_qa_dir(outdir)
-        if exists:
-            print '%s exists, remove to re-run'%qadir
-            return None
-    param_file = shutil.copyfile(param_file, qadir)
-    artout = run_artdetect(merged, param_file, thresh, param_source)
-
-    vox_outliers =  artout.outputs.outlier_files
-
-    statd = json.load(open(artout.outputs.statistic_files))
-    mot = statd[1]['motion_outliers']
-    intensity = statd[1]['intensity_outliers']
-    if mot > 0:
-        try:
-            tmp = np.loadtxt(artout.outputs.outlier_files)[:mot]
-        except:
-            tmp = np.loadtxt(artout.outputs.outlier_files)
-	tmp.tofile(os.path.join(qadir,'bad_movement_frames.txt'), 
-                   sep='\n')
+
+@tracing.traced()
+def main(infile, param_file, param_source, thresh, outdir=None,
+         clobber=False, g=None):
+    """ run artifact detection on infile (list of files), writing
+    results to <outdir>/data_QA, if data_QA exists it is only
+    overwritten if clobber (see cohort_qa for up to date checks)
+    g : global signal of infile (see artdetect.GlobalSignal), if
+    already computed, read from infile if None"""
+    if outdir is None:
+        outdir, _ = os.path.split(infile[0])
+    qadir, exists = make_qa_dir(outdir)
+    if exists and not clobber:
+        print '%s exists, remove to re-run'%qadir
+        return None
+    shutil.copy(param_file, qadir)
+    # outputs are named after the (first) input file
+    art = run_artdetect(infile, param_file, thresh, param_source, g)
+    artdetect.save_artifacts(art, infile[0], qadir)
+
+    mot = art['stats']['motion_outliers']
+    intensity = art['stats']['intensity_outliers']
+    badfile = os.path.join(qadir,'bad_movement_frames.txt')
+    if len(art['motion_outliers']) > 0:
+        np.savetxt(badfile, art['motion_outliers'], fmt='%d')
+    elif os.path.isfile(badfile):
+        # stale, from an earlier run
+        os.remove(badfile)
     np.array([mot,intensity]).tofile(os.path.join(qadir,
                                                   'motion_intensity_outliers'),
                                      sep = '\n')
     print 'QA written to %s'%(qadir)
+    return art
         
 
 if __name__ == '__main__':
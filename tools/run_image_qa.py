@@ -27,11 +27,16 @@ outdir = str
     directory to output confound regressor text file
 confound_outname = str
     name of confound regressor text file
+censor_outname = str
+    name of frame censoring mask text file
 
 Outputs: 
 ------------------
 File output: <outdir>/<confound_outname>
     text file containing confound regressors for use in FSL or SPM model
+    (motion parameters, then one spike regressor per outlier volume)
+File output: <outdir>/<censor_outname>
+    text file with one value per volume, 1 = keep, 0 = outlier volume
 
 Notes
 -------------------
@@ -43,9 +48,60 @@ further processing when using confound regressor file.
 """
 
 
+def load_outliers(funcdir, art_output):
+    """ sorted unique outlier volume indices listed in
+    <funcdir>/data_QA/<art_output> (rapid_art.py output)"""
+    qa_file = os.path.join(funcdir,'data_QA',art_output)
+    outliers = np.atleast_1d(np.loadtxt(qa_file, dtype=int))
+    return np.unique(outliers)
+
+
+def spike_regressors(outliers, num_vols, dtype=np.int8):
+    """ expand outlier indices to a dense num_vols X n_outliers
+    array, one spike (1 at the outlier volume) regressor per outlier
+
+    Parameters
+    -----------
+    outliers : array
+        outlier volume indices
+    num_vols : int
+        number of volumes in pre-processed functional file
+    dtype : numpy dtype
+        type of the regressors (default int8)
+
+    Returns
+    ----------
+    spikes : numpy array
+        num_vols X n_outliers array, with value 1 for each outlier vol
+    """
+    outliers = np.asarray(outliers, dtype=int)
+    if np.any(outliers >= num_vols) or np.any(outliers < 0):
+        raise IndexError('outlier index out of range (%d volumes): %s'%(
+            num_vols, outliers))
+    spikes = np.zeros((num_vols, len(outliers)), dtype=dtype)
+    spikes[outliers, np.arange(len(outliers))] = 1
+    return spikes
+
+
+def censor_mask(outliers, num_vols):
+    """ frame censoring mask, 1 for volumes to keep and 0 for
+    outlier volumes (num_vols array of uint8)"""
+    mask = np.ones(num_vols, dtype=np.uint8)
+    mask[np.asarray(outliers, dtype=int)] = 0
+    return mask
+
+
+def save_censor_mask(outliers, num_vols, outfile):
+    """ write censor_mask(outliers, num_vols) to outfile, one 0/1
+    value per volume"""
+    np.savetxt(outfile, censor_mask(outliers, num_vols), fmt='%d')
+    print 'Saved %s'%outfile
+    return outfile
+
+
 def CreateRegressors(funcdir, art_output, num_vols):
     """ takes list of outlier volumes output by rapid_art.py
-    converts to array of same length as functional volume for use
+    and saves spike regressors (num_vols X n_outliers) for use
     in FSL or SPM model
 
     Parameters
@@ -63,47 +119,33 @@ def CreateRegressors(funcdir, art_output, num_vols):
     exists : bool
         indicates whether outliers exist or if only mc parameters should
         be used as confounds
-    outlier_array : numpy array
-        array with value 1 for each outlier vol to be regressed out
+    outliers : numpy array
+        sorted indices of outlier vols to be regressed out
+        (see spike_regressors for the dense array)
 
     """
-    exists = False
-    qa_file = os.path.join(funcdir,'data_QA',art_output)
-    outliers = np.loadtxt(qa_file, dtype=int)
-    outliers = np.atleast_1d(outliers)
-    if len(outliers) > 1:
-        exists = True
-        outlier_array = np.zeros((num_vols,len(outliers)),dtype=float)
-        for i in range(len(outliers)):
-            outlier_array[outliers[i],i]=1
-        outfile = os.path.join(funcdir, 'data_QA', 'outliers_for_fsl.txt')
-        outlier_array.tofile(outfile)
-        np.savetxt(outfile, outlier_array, fmt='%i', delimiter=u'\t')
-        print 'Saved %s'%outfile
-    elif len(outliers) == 1:
-        exists = True
-        outlier_array = np.zeros((num_vols,len(outliers)),dtype=float)
-        outlier_array[outliers[0],0] = 1
+    outliers = load_outliers(funcdir, art_output)
+    exists = len(outliers) > 0
+    if exists:
         outfile = os.path.join(funcdir, 'data_QA', 'outliers_for_fsl.txt')
-        outlier_array.tofile(outfile)
-        np.savetxt(outfile, outlier_array, fmt='%i', delimiter=u'\t')
+        np.savetxt(outfile, spike_regressors(outliers, num_vols),
+                   fmt='%i', delimiter=u'\t')
         print 'Saved %s'%outfile
     else:
-        outlier_array = np.array([])
         print 'No outliers, only mc parameters will be used'
-    return exists, outlier_array
+    return exists, outliers
 
 
-def CombineRegressors(mc_params, outlier_array, outdir, confound_outname):
-    """ combines array of motion parameters and spike regressor
+def CombineRegressors(mc_params, outliers, outdir, confound_outname):
+    """ combines array of motion parameters and spike regressors
     to be used as confound file in SPM or FSL model
 
     Parameters
     -----------
     mc_params : numpy array
         array containing motion correction parameters for each volume
-    outlier_array : numpy array
-        array of spike regressors corresponding to outlier volumes
+    outliers : numpy array
+        outlier volume indices, expanded to one spike regressor each
     confound_outname : str
         name of file to save confound regressors to
 
@@ -114,14 +156,13 @@ def CombineRegressors(mc_params, outlier_array, outdir, confound_outname):
         columns of confound regressors with one row per timepoint
 
     """
-    if outlier_array.ndim > 1:
-        combined = np.hstack((mc_params, outlier_array))
-        outfile = os.path.join(outdir, confound_outname)
-        np.savetxt(outfile, combined, delimiter=u'\t')
-    elif outlier_array.ndim == 1:
-        combined = np.hstack((mc_params, np.atleast_2d(outlier_array).T))
-        outfile = os.path.join(outdir, confound_outname)
-        np.savetxt(outfile, combined, delimiter=u'\t')
+    mc_params = np.atleast_2d(mc_params)
+    spikes = spike_regressors(outliers, mc_params.shape[0])
+    combined = np.hstack((mc_params, spikes))
+    # spikes written as integers, keeps design files small
+    fmt = ['%.10g'] * mc_params.shape[1] + ['%d'] * spikes.shape[1]
+    outfile = os.path.join(outdir, confound_outname)
+    np.savetxt(outfile, combined, fmt=fmt, delimiter=u'\t')
     print 'Saved %s'%outfile
     return combined
 
@@ -152,6 +193,7 @@ if __name__ == '__main__':
         thresh = 3
         outdir = funcdir
         confound_outname = 'confound_regressors_6mm.txt'
+        censor_outname = 'censor_mask_6mm.txt'
         ######################################################
         
         #Run artdetect and create QA directory
@@ -162,13 +204,10 @@ if __name__ == '__main__':
         #Save combined confound regressors to run directory.
         mc_params = np.loadtxt(param_file)
         num_vols = len(mc_params)
-        exists, outlier_array = CreateRegressors(funcdir, art_output, num_vols)
-        if exists:
-            confound_regressors = CombineRegressors(mc_params, 
-                                                    outlier_array, 
-                                                    outdir, confound_outname) 
-        elif not exists:
-            outfile = os.path.join(outdir, confound_outname)
-            np.savetxt(outfile, mc_params, delimiter=u'\t')
-            print 'Saved %s'%outfile
+        exists, outliers = CreateRegressors(funcdir, art_output, num_vols)
+        confound_regressors = CombineRegressors(mc_params, outliers,
+                                                outdir, confound_outname)
+        #Save frame censoring mask (1 = keep, 0 = outlier) to run directory.
+        save_censor_mask(outliers, num_vols,
+                         os.path.join(outdir, censor_outname))
 
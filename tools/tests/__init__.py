@@ -0,0 +1,15 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+The tests (and the worker processes and commands they start) use a
+temporary image cache (see imgio.cache_dir), removed at exit, not the
+cache of the user
+"""
+import os
+import shutil
+import atexit
+from tempfile import mkdtemp
+
+CACHE_DIR = mkdtemp(prefix='connectivity_cache_')
+os.environ['CONNECTIVITY_CACHE'] = CACHE_DIR
+atexit.register(shutil.rmtree, CACHE_DIR, True)
@@ -0,0 +1,135 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import nibabel as ni
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import artdetect as art
+
+
+class TestArtDetect(TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.outdir = mkdtemp()
+        dat = (prng.rand(8, 9, 10, 30) * 50 + 500).astype(np.int16)
+        dat[:2] = 5 # background
+        dat[..., 12] += 300 # intensity spike
+        self.dat = dat
+        self.file4d = join(self.outdir, 'func.nii.gz')
+        ni.Nifti1Image(dat, np.eye(4)).to_filename(self.file4d)
+        self.files3d = []
+        for i in range(dat.shape[3]):
+            f = join(self.outdir, 'vol%03d.nii'%i)
+            ni.Nifti1Image(dat[..., i], np.eye(4)).to_filename(f)
+            self.files3d.append(f)
+        params = prng.randn(30, 6) * .0001
+        params[20, :3] += 2 # 2mm jump in translation
+        self.params = params
+        self.param_file = join(self.outdir, 'rp_func.txt')
+        np.savetxt(self.param_file, params)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_iter_volumes(self):
+        vols = list(art.iter_volumes(self.file4d))
+        assert_equal(len(vols), 30)
+        assert_equal(vols[12], self.dat[..., 12])
+        vols = list(art.iter_volumes(self.files3d[:3]))
+        assert_equal(vols[2], self.dat[..., 2])
+        # scaled data
+        img = ni.Nifti1Image(self.dat[..., :2], np.eye(4))
+        img.get_header().set_slope_inter(2, 1)
+        f = join(self.outdir, 'scaled.nii')
+        img.to_filename(f)
+        vols = list(art.iter_volumes(f))
+        assert_almost_equal(vols[1], ni.load(f).get_data()[..., 1])
+
+    def test_global_signal(self):
+        dat = self.dat.copy()
+        dat[4, 4, 4, 3] = 0 # out of the mask of one volume only
+        f = join(self.outdir, 'dropout.nii.gz')
+        ni.Nifti1Image(dat, np.eye(4)).to_filename(f)
+        # mask intersected over volumes, as rapidart
+        g = art.global_signal(f)
+        fdat = dat.astype(float)
+        mask = np.all([fdat[..., i] > fdat[..., i].mean() / 8.
+                       for i in range(dat.shape[3])], axis=0)
+        assert_equal(mask[4, 4, 4], False)
+        assert_almost_equal(g, [fdat[..., i][mask].mean()
+                                for i in range(dat.shape[3])])
+        # streamed, the dropped voxel is subtracted on a second read
+        gs = art.GlobalSignal()
+        for vol in art.iter_volumes(f):
+            gs.update(vol)
+        assert_raises(ValueError, gs.finalize)
+        assert_almost_equal(gs.finalize(f), g)
+        assert_raises(ValueError, gs.finalize, self.files3d[:2])
+        # each volume its own mask
+        g = art.global_signal(f, intersect_mask=False)
+        vol = fdat[..., 0]
+        assert_almost_equal(g[0], vol[vol > vol.mean() / 8.].mean())
+        g = art.global_signal(self.file4d)
+        assert_almost_equal(art.global_signal(self.files3d), g)
+        # intersection below 1/10 of the volume falls back to spm_global
+        dat[2:, ..., 5] = 0
+        dat[2, 0, 0, 5] = 1000
+        ni.Nifti1Image(dat, np.eye(4)).to_filename(f)
+        assert_almost_equal(art.global_signal(f),
+                            art.global_signal(f, intersect_mask=False))
+
+    def test_load_motion_params(self):
+        fsl = self.params[:, [3, 4, 5, 0, 1, 2]]
+        assert_almost_equal(art.load_motion_params(fsl, 'FSL'), self.params)
+        assert_almost_equal(art.load_motion_params(self.param_file),
+                            self.params)
+        assert_raises(ValueError, art.load_motion_params, fsl, 'AFNI')
+
+    def test_motion_affines(self):
+        params = np.array([[1., 2, 3, 0, 0, np.pi / 2]])
+        aff = art.motion_affines(params)[0]
+        assert_almost_equal(aff[:3, 3], [1, 2, 3])
+        # rotation about z maps x onto -y
+        assert_almost_equal(np.dot(aff[:3, :3], [1, 0, 0]), [0, -1, 0])
+
+    def test_composite_norm(self):
+        params = np.zeros((3, 6))
+        params[1, 0] = 2
+        norm = art.composite_norm(params)
+        assert_almost_equal(norm, [0, 2, 2])
+        norm = art.composite_norm(params, use_differences=False)
+        assert_almost_equal(norm[0], np.sqrt((2 / 3.)**2 / 3.))
+
+    def test_framewise_displacement(self):
+        params = np.zeros((3, 6))
+        params[1, 0] = 1
+        params[2, 3] = .01
+        fd = art.framewise_displacement(params)
+        assert_almost_equal(fd, [0, 1, 1.5])
+
+    def test_detect_artifacts(self):
+        res = art.detect_artifacts(self.file4d, self.param_file,
+                                   zintensity_threshold=3)
+        assert_equal(res['intensity_outliers'], [12])
+        assert_equal(res['motion_outliers'], [20, 21])
+        assert_equal(res['outliers'], [12, 20, 21])
+        assert_equal(res['stats']['intensity_outliers'], 1)
+        assert_equal(res['stats']['motion_outliers'], 2)
+        res3d = art.detect_artifacts(self.files3d, self.param_file,
+                                     zintensity_threshold=3)
+        assert_equal(res3d['outliers'], res['outliers'])
+        assert_raises(IndexError, art.detect_artifacts, self.files3d[:10],
+                      self.param_file)
+        outfiles = art.save_artifacts(res, self.file4d, self.outdir)
+        assert_equal(os.path.split(outfiles['outliers'])[1],
+                     'art.func.nii_outliers.txt')
+        assert_equal(np.loadtxt(outfiles['outliers']), [12, 20, 21])
+
+    def test_read_volumes(self):
+        dat = art.read_volumes(self.file4d, [20, 3, 12])
+        assert_equal(dat, self.dat[..., [20, 3, 12]])
+        assert_raises(IndexError, art.read_volumes, self.file4d, [30])
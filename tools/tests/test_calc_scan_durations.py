@@ -8,6 +8,7 @@ from unittest import TestCase, skipIf, skipUnless
 from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
 from numpy import (loadtxt, array, concatenate)
 from numpy import random
+import numpy as np
 
 from .. import calc_scan_durations as csd
 
@@ -23,3 +24,76 @@ class TestCalcScanDurations(TestCase):
 
 
 
+
+    def test_demean_rows(self):
+        data = self.data.reshape((4, 25))
+        demeaned = csd.demean(data)
+        assert_almost_equal(demeaned.mean(axis=1), 0)
+        assert_almost_equal(demeaned[1], csd.demean(data[1]))
+
+    def test_drift_basis(self):
+        poly = csd.drift_basis(100, 'poly', order=3)
+        assert_equal(poly.shape, (100, 4))
+        spline = csd.spline_basis(100, knot_spacing=20)
+        assert_almost_equal(spline.sum(axis=1), 1)
+        cos = csd.cosine_basis(100, tr=2, cutoff=100.)
+        assert_equal(cos.shape, (100, 5))
+        # combined bases share the constant
+        combined = csd.drift_basis(100, ['poly', 'cosine'], tr=2,
+                                   order=1, cutoff=100.)
+        assert_equal(combined.shape, (100, 6))
+        assert_raises(ValueError, csd.drift_basis, 100, 'wavelet')
+
+    def test_detrend(self):
+        prng = random.RandomState(0)
+        t = np.arange(100.)
+        data = prng.randn(50, 100)
+        drift = np.outer(prng.randn(50), t) + np.outer(prng.randn(50), t**2)
+        basis = csd.drift_basis(100, 'poly', order=2)
+        res = csd.detrend(data + drift, basis)
+        # same as per voxel least squares fit
+        beta = np.linalg.lstsq(basis, (data + drift).T, rcond=-1)[0]
+        assert_almost_equal(res, (data + drift) - np.dot(basis, beta).T)
+        assert_almost_equal(csd.detrend(data + drift, basis)[3],
+                            csd.detrend((data + drift)[3], basis))
+        kept = csd.detrend(data + 10, basis, keep_mean=True)
+        assert_almost_equal(kept.mean(axis=1), (data + 10).mean(axis=1))
+        assert_raises(ValueError, csd.detrend, data[:, :50], basis)
+        res = csd.spline_dtrend(self.data, tr=20)
+        assert_equal(res.shape, self.data.shape)
+        assert_almost_equal(res.mean(), 0)
+
+    def test_bandpass(self):
+        tr = 2.
+        t = np.arange(200) * tr
+        slow = np.sin(2 * np.pi * .005 * t)
+        mid = np.sin(2 * np.pi * .05 * t)
+        fast = np.sin(2 * np.pi * .2 * t)
+        filtered = csd.bandpass(slow + mid + fast + 3, tr, .01, .1)
+        assert_almost_equal(filtered, mid)
+        data = np.array([slow + mid, mid + fast])
+        res = csd.filter_timeseries(data, tr, highpass=.01, lowpass=.1,
+                                    chunk_size=1, nproc=2)
+        assert_almost_equal(res, [mid, mid])
+        basis = csd.drift_basis(200, 'poly', order=1)
+        res = csd.filter_timeseries(data + t, tr, basis, keep_mean=True)
+        assert_almost_equal(res, csd.detrend(data + t, basis, True))
+
+    def test_filter_image(self):
+        import nibabel as ni
+        outdir = mkdtemp()
+        prng = random.RandomState(0)
+        dat = prng.randn(3, 4, 5, 60) + np.arange(60) * .5 + 100
+        dat[0] = 0
+        infile = join(outdir, 'func.nii.gz')
+        img = ni.Nifti1Image(dat, np.eye(4))
+        img.get_header().set_zooms((1, 1, 1, 2))
+        img.to_filename(infile)
+        outfile = csd.filter_image(infile, join(outdir, 'filt.nii.gz'),
+                                   kind='poly', order=1)
+        res = ni.load(outfile).get_data()
+        assert_equal(res[0], 0)
+        basis = csd.drift_basis(60, 'poly', order=1)
+        assert_almost_equal(res[1:], csd.detrend(dat[1:], basis, True),
+                            decimal=4)
+        os.system('rm -rf %s'%outdir)
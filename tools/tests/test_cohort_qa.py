@@ -0,0 +1,104 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join, exists
+from tempfile import mkdtemp
+import nibabel as ni
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_equal, assert_almost_equal)
+
+from .. import cohort_qa
+from .. import artdetect
+
+
+class TestCohortQA(TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.datapath = mkdtemp()
+        self.subjects = ['B01-001', 'B01-002']
+        for subj in self.subjects:
+            funcdir = join(self.datapath, subj, 'func')
+            os.makedirs(funcdir)
+            dat = (prng.rand(6, 7, 8, 20) * 50 + 500).astype(np.int16)
+            dat[..., 5] += 300
+            ni.Nifti1Image(dat, np.eye(4)).to_filename(join(funcdir,
+                                                           'func.nii.gz'))
+            params = prng.randn(20, 6) * .0001
+            params[10, :3] += 2
+            np.savetxt(join(funcdir, 'rp_func.txt'), params)
+        self.jobs = cohort_qa.make_jobs(self.subjects, self.datapath,
+                                        '{subj}/func/func.nii.gz',
+                                        '{subj}/func/rp_func.txt')
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.datapath)
+
+    def test_input_manifest(self):
+        infile = self.jobs[0][2]
+        manifest = cohort_qa.input_manifest([infile])
+        entry = manifest[os.path.abspath(infile)]
+        assert_equal(entry['sha1'], cohort_qa.file_hash(infile))
+        # unchanged size and mtime reuse the previous hash
+        entry['sha1'] = 'previous'
+        new = cohort_qa.input_manifest([infile], manifest)
+        assert_equal(new[os.path.abspath(infile)]['sha1'], 'previous')
+
+    def test_cohort_qa(self):
+        summaries = cohort_qa.cohort_qa(self.jobs, thresh=3, ncomp=2,
+                                        nproc=2)
+        assert_equal([s['status'] for s in summaries], ['ran', 'ran'])
+        assert_equal([s['subject'] for s in summaries], self.subjects)
+        assert_equal(summaries[0]['nvols'], 20)
+        assert_equal(summaries[0]['n_intensity_outliers'], 1)
+        assert_equal(summaries[0]['n_motion_outliers'], 2)
+        qadir = summaries[0]['qadir']
+        assert_equal(exists(join(qadir, 'QA-TSNR_func.nii.gz')), True)
+        # up to date, not re-run
+        summaries = cohort_qa.cohort_qa(self.jobs, thresh=3, ncomp=2)
+        assert_equal([s['status'] for s in summaries], ['current', 'current'])
+        # changed setting or input re-runs
+        summaries = cohort_qa.cohort_qa(self.jobs[:1], thresh=4, ncomp=2)
+        assert_equal(summaries[0]['status'], 'ran')
+        params = np.loadtxt(self.jobs[1][2])
+        params[10, :3] = 0
+        np.savetxt(self.jobs[1][2], params)
+        summaries = cohort_qa.cohort_qa(self.jobs, thresh=4, ncomp=2)
+        assert_equal([s['status'] for s in summaries], ['current', 'ran'])
+        assert_equal(summaries[1]['n_motion_outliers'], 0)
+        # failures are reported, not raised
+        jobs = self.jobs + [('B01-003', ['missing.nii.gz'], 'missing.txt',
+                             self.datapath)]
+        summaries = cohort_qa.cohort_qa(jobs, thresh=4, ncomp=2)
+        assert_equal(summaries[2]['status'], 'failed')
+        outfile = cohort_qa.save_cohort_index(
+            summaries, join(self.datapath, 'index.txt'))
+        lines = [l.split('\t') for l in open(outfile).read().splitlines()]
+        assert_equal(lines[0], cohort_qa.INDEX_COLUMNS)
+        assert_equal(len(lines), 4)
+        assert_equal(lines[3][:3], ['B01-003', 'failed', 'NA'])
+        assert_almost_equal(float(lines[1][-3]), summaries[0]['tsnr_mean'],
+                            decimal=4)
+
+    def test_single_read(self):
+        subj, infiles, param_file, outdir = self.jobs[0]
+        reads = []
+        iter_volumes = artdetect.iter_volumes
+        def counted(infiles):
+            reads.append(infiles)
+            return iter_volumes(infiles)
+        artdetect.iter_volumes = counted
+        try:
+            summary = cohort_qa.subject_qa(subj, infiles, param_file,
+                                           thresh=3, ncomp=2,
+                                           save_maps=False)
+        finally:
+            artdetect.iter_volumes = iter_volumes
+        assert_equal(len(reads), 1)
+        # same outliers as artifact detection reading the data itself
+        art = artdetect.detect_artifacts(infiles, param_file,
+                                         zintensity_threshold=3)
+        assert_equal(summary['n_intensity_outliers'],
+                     len(art['intensity_outliers']))
+        assert_equal(summary['n_motion_outliers'],
+                     len(art['motion_outliers']))
@@ -0,0 +1,76 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+from scipy import stats
+
+from .. import diagnotics as diag
+from .. import artdetect
+
+
+def make_params(prng, nsub=10, nvols=50, scale=.05):
+    return [np.cumsum(prng.randn(nvols - i, 6) * scale, axis=0)
+            for i in range(nsub)]
+
+
+def test_load_cohort_motion():
+    prng = np.random.RandomState(0)
+    allparams = make_params(prng, 4)
+    outdir = mkdtemp()
+    files = []
+    for i, p in enumerate(allparams):
+        files.append(join(outdir, 'sub%d.par'%i))
+        # FSL order, rotations first
+        np.savetxt(files[-1], p[:, [3, 4, 5, 0, 1, 2]])
+    params, nvols = diag.load_cohort_motion(files, 'FSL', nproc=2)
+    assert_equal(nvols, [50, 49, 48, 47])
+    assert_equal(params.shape, (4, 50, 6))
+    assert_almost_equal(params[2, :48], allparams[2])
+    assert_equal(np.isnan(params[2, 48:]).all(), True)
+    os.system('rm -rf %s'%outdir)
+
+
+def test_motion_summary():
+    prng = np.random.RandomState(1)
+    allparams = make_params(prng, 3)
+    params = np.empty((3, 50, 6))
+    params.fill(np.nan)
+    for i, p in enumerate(allparams):
+        params[i, :len(p)] = p
+    summary = diag.motion_summary(params, fd_thresh=.3)
+    for i, p in enumerate(allparams):
+        fd = artdetect.framewise_displacement(p)
+        assert_almost_equal(summary['fd_mean'][i], fd[1:].mean())
+        assert_almost_equal(summary['fd_max'][i], fd.max())
+        assert_equal(summary['n_supra'][i], (fd > .3).sum())
+        disp = np.sqrt(((p[:, :3] - p[0, :3])**2).sum(axis=1))
+        assert_almost_equal(summary['disp_max'][i], disp.max())
+    assert_equal(summary['nvols'], [50, 49, 48])
+
+
+def test_group_and_covariate():
+    prng = np.random.RandomState(2)
+    allparams = make_params(prng, 20, scale=.002)
+    # second group moves more
+    allparams[10:] = [p * 3 for p in allparams[10:]]
+    params = np.empty((20, 50, 6))
+    params.fill(np.nan)
+    for i, p in enumerate(allparams):
+        params[i, :len(p)] = p
+    summary = diag.motion_summary(params, fd_thresh=.5)
+    groups = np.array([0] * 10 + [1] * 10)
+    res = diag.chi_sq_movement(summary, groups == 0, groups == 1)
+    assert_equal(res['table'].sum(), (summary['nvols'] - 1).sum())
+    assert_equal(res['p'] < .001, True)
+    assert_equal(res['t_p'][0] < .001, True)
+    x = np.array([summary['fd_mean'] * 2 + 1, prng.randn(20)]).T
+    r, p = diag.movement_withx(summary, x)
+    assert_equal(r.shape, (len(diag.MOTION_METRICS), 2))
+    assert_almost_equal(r[0, 0], 1)
+    expected = stats.pearsonr(summary['disp_max'], x[:, 1])
+    assert_almost_equal(r[3, 1], expected[0])
+    assert_almost_equal(p[3, 1], expected[1])
+    assert_raises(ValueError, diag.movement_withx, summary, x[:5])
@@ -0,0 +1,69 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+import time
+from os.path import join, exists
+from tempfile import mkdtemp
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal)
+
+from .. import executor
+
+
+class TestExecutor(TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.executor = executor.CommandExecutor(max_jobs=4,
+                                                 retry_delay=.01)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_run(self):
+        startdir = os.getcwd()
+        res = self.executor.run('pwd', cwd=self.outdir)
+        assert_equal(res.ok, True)
+        assert_equal(os.path.realpath(res.stdout.strip()),
+                     os.path.realpath(self.outdir))
+        assert_equal(os.getcwd(), startdir)
+        assert_equal(res.attempts, 1)
+        # quoted arguments, no shell
+        res = self.executor.run('sh -c "echo a b >&2; exit 3"')
+        assert_equal((res.returncode, res.stderr), (3, 'a b\n'))
+        res = self.executor.run(['no_such_command_xyz', '-h'])
+        assert_equal(res.returncode, executor.NOT_FOUND)
+        assert_raises(IOError, self.executor.run, 'pwd',
+                      join(self.outdir, 'missing'))
+
+    def test_retry_timeout(self):
+        counter = join(self.outdir, 'count')
+        cmd = ['sh', '-c', 'echo x >> %s; test $(wc -l < %s) -ge 3'%(
+            counter, counter)]
+        res = self.executor.run(cmd, retries=1)
+        assert_equal((res.ok, res.attempts), (False, 2))
+        res = self.executor.run(cmd, retries=1)
+        assert_equal((res.ok, res.attempts), (True, 1))
+        res = self.executor.run('sleep 5', timeout=.2)
+        assert_equal((res.timed_out, res.returncode), (True, None))
+        assert_equal(res.duration < 4, True)
+
+    def test_limits(self):
+        self.executor.set_limit('sleep', 1)
+        start = time.time()
+        jobs = [self.executor.submit('sleep .2') for i in range(3)]
+        assert_equal(jobs[0].wait(.01), None)
+        results = [job.wait() for job in jobs]
+        assert_equal(time.time() - start >= .6, True)
+        assert_equal([res.ok for res in results], [True] * 3)
+        # other tools are not held up
+        self.executor.set_limit('sleep', 3)
+        start = time.time()
+        results = self.executor.map(['sleep .3'] * 3 + ['true'])
+        assert_equal(time.time() - start < .85, True)
+        assert_equal([res.ok for res in results], [True] * 4)
+
+    def test_parse_limits(self):
+        assert_equal(executor.parse_limits('randomise=2, fsl_glm=8'),
+                     {'randomise': 2, 'fsl_glm': 8})
+        assert_equal(executor.parse_limits(''), {})
+        assert_raises(ValueError, executor.parse_limits, 'randomise')
@@ -0,0 +1,136 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join, exists
+from tempfile import mkdtemp
+import nibabel as ni
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import imgio
+
+
+class TestImgIO(TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.outdir = mkdtemp()
+        self.cachedir = join(self.outdir, 'cache')
+        self.environ = dict(os.environ)
+        os.environ['CONNECTIVITY_CACHE'] = self.cachedir
+        os.environ.pop('CONNECTIVITY_NOCACHE', None)
+        self.dat = prng.randn(6, 7, 8, 10).astype(np.float32)
+        self.infile = join(self.outdir, 'func.nii.gz')
+        ni.Nifti1Image(self.dat, np.eye(4)).to_filename(self.infile)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_cached(self):
+        cachefile = imgio.cached(self.infile)
+        assert_equal(cachefile.startswith(self.cachedir), True)
+        assert_equal(cachefile.endswith('_func.nii'), True)
+        assert_equal(imgio.cached(self.infile), cachefile)
+        # readable by other users of a shared cache
+        assert_equal(os.stat(cachefile).st_mode & 0777, 0644)
+        img = imgio.load(self.infile)
+        assert_equal(img.get_data(), self.dat)
+        assert_equal(isinstance(img.get_data(), np.memmap), True)
+        # uncompressed files are used directly
+        plain = join(self.outdir, 'func.nii')
+        ni.Nifti1Image(self.dat, np.eye(4)).to_filename(plain)
+        assert_equal(imgio.cached(plain), plain)
+        # changed source is a cache miss
+        os.utime(self.infile, (1, 1))
+        assert_equal(imgio.cached(self.infile) == cachefile, False)
+        os.environ['CONNECTIVITY_NOCACHE'] = '1'
+        assert_equal(imgio.cached(self.infile), self.infile)
+
+    def test_evict(self):
+        files = []
+        for i in range(3):
+            f = join(self.outdir, 'func%d.nii.gz'%i)
+            ni.Nifti1Image(self.dat, np.eye(4)).to_filename(f)
+            files.append(f)
+        cachefiles = imgio.prefetch(files, nproc=3)
+        for i, f in enumerate(cachefiles):
+            os.utime(f, (1000 + i, 1000 + i))
+        size = os.path.getsize(cachefiles[0])
+        # least recently used is removed first
+        imgio.evict(limit=2 * size)
+        assert_equal([exists(f) for f in cachefiles], [False, True, True])
+        imgio.evict(limit=0, keep=cachefiles[2:])
+        assert_equal([exists(f) for f in cachefiles], [False, False, True])
+
+    def test_lazy_access(self):
+        assert_equal(imgio.get_volume(self.infile, 3), self.dat[..., 3])
+        assert_equal(imgio.get_volume(self.infile, -1), self.dat[..., -1])
+        assert_raises(IndexError, imgio.get_volume, self.infile, 10)
+        assert_equal(imgio.read_volumes(self.infile, [7, 2, -1]),
+                     self.dat[..., [7, 2, -1]])
+        assert_raises(IndexError, imgio.read_volumes, self.infile, [1, 10])
+        # one open, sorted seeks, also on the gzipped file itself
+        os.environ['CONNECTIVITY_NOCACHE'] = '1'
+        loads = []
+        load = imgio.load
+        def counted(filename):
+            loads.append(filename)
+            return load(filename)
+        imgio.load = counted
+        try:
+            dat = imgio.read_volumes(self.infile, [9, 0, 4, 0])
+        finally:
+            imgio.load = load
+        assert_equal(dat, self.dat[..., [9, 0, 4, 0]])
+        assert_equal(loads, [self.infile])
+        # scaled data
+        img = ni.Nifti1Image(self.dat[..., :3].astype(np.int16), np.eye(4))
+        img.get_header().set_slope_inter(2, 1)
+        scaled = join(self.outdir, 'scaled.nii')
+        img.to_filename(scaled)
+        assert_almost_equal(imgio.read_volumes(scaled, [2, 0]),
+                            ni.load(scaled).get_data()[..., [2, 0]])
+        assert_equal(imgio.get_slab(self.infile, 2, 5), self.dat[:, :, 2:5])
+        chunks = list(imgio.iter_volumes(self.infile, 4))
+        assert_equal([c.shape[3] for c in chunks], [4, 4, 2])
+        assert_equal(np.concatenate(chunks, axis=3), self.dat)
+
+    def test_save(self):
+        outfile = join(self.outdir, 'out.nii.gz')
+        assert_equal(imgio.save(self.dat, np.eye(4), outfile), outfile)
+        img = ni.load(outfile)
+        assert_equal(img.get_data_dtype(), np.float32)
+        assert_equal(img.get_data(), self.dat)
+        # scaled int16
+        imgio.save(self.dat, np.diag([2, 2, 2, 1]), outfile, dtype=np.int16,
+                   compresslevel=6, nthreads=2)
+        img = ni.load(outfile)
+        assert_equal(img.get_data_dtype(), np.int16)
+        assert_equal(img.get_affine(), np.diag([2, 2, 2, 1]))
+        step = np.ptp(self.dat) / 2**16
+        assert_equal(np.abs(img.get_data() - self.dat).max() < step, True)
+        outfile = join(self.outdir, 'out.nii')
+        imgio.save(self.dat, np.eye(4), outfile, dtype=None)
+        assert_equal(ni.load(outfile).get_data(), self.dat)
+
+    def test_block_writer(self):
+        import gzip
+        data = np.arange(10000, dtype=np.int32).tostring()
+        outfile = join(self.outdir, 'blocks.gz')
+        with imgio.BlockGzipWriter(outfile, 1, 3, blocksize=1000) as fobj:
+            fobj.write(data[:2500])
+            fobj.write(data[2500:])
+            assert_equal(fobj.tell(), len(data))
+        assert_equal(gzip.open(outfile).read(), data)
+
+    def test_output_filename(self):
+        os.environ.pop('FSLOUTPUTTYPE', None)
+        assert_equal(imgio.output_filename('mask'), 'mask.nii.gz')
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI'
+        assert_equal(imgio.output_filename('/a/mask.nii.gz'), '/a/mask.nii')
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI_PAIR_GZ'
+        assert_equal(imgio.output_filename('mask.img'), 'mask.img.gz')
+        os.environ['FSLOUTPUTTYPE'] = 'ANALYZE'
+        assert_raises(ValueError, imgio.output_filename, 'mask')
@@ -0,0 +1,50 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os, sys
+import json
+import subprocess
+from unittest import TestCase
+from numpy.testing import assert_equal
+
+# command line modules, imported as the scripts do (their directory on
+# sys.path)
+MODULES = ['rapid_art', 'artdetect', 'qa_stats', 'cohort_qa', 'run_image_qa',
+           'net_affiliation', 'calc_scan_durations', 'diagnotics',
+           'pipeline', 'python_dual_regress', 'resample', 'rest_2_3mm',
+           'matching', 'reproducibility', 'cohort_rsfc']
+# only imported by the functions that use them
+HEAVY = ['nipype', 'nipy', 'pandas', 'matplotlib', 'scipy.stats',
+         'scipy.signal', 'scipy.optimize', 'scipy.ndimage',
+         'scipy.interpolate']
+
+SCRIPT = """
+import sys, time, json
+start = time.time()
+for mod in %r:
+    __import__(mod)
+elapsed = time.time() - start
+heavy = sorted([m for m in sys.modules if sys.modules[m] is not None and
+                [h for h in %r if m == h or m.startswith(h + '.')]])
+print json.dumps({'elapsed': elapsed, 'heavy': heavy})
+"""
+
+
+class TestImports(TestCase):
+    def setUp(self):
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, os.pardir)
+        paths = [os.path.join(root, d)
+                 for d in ('tools', 'ica', 'match', 'seed')]
+        self.env = os.environ.copy()
+        self.env['PYTHONPATH'] = os.pathsep.join(
+            paths + [p for p in [self.env.get('PYTHONPATH')] if p])
+        # seconds, generous for a cold cache
+        self.budget = float(os.environ.get('CONNECTIVITY_IMPORT_BUDGET', 2.))
+
+    def test_startup(self):
+        out = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT%(MODULES, HEAVY)], env=self.env)
+        res = json.loads(out.strip().splitlines()[-1])
+        assert_equal(res['heavy'], [])
+        assert res['elapsed'] < self.budget, \
+            'imports took %.2fs (budget %.2fs)'%(res['elapsed'], self.budget)
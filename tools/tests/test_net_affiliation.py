@@ -0,0 +1,130 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as nib
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import net_affiliation as na
+
+
+def masked_margins(dat2d):
+    """ reference margins from a masked array of the non primary
+    networks (the implementation affiliation_margins replaced)"""
+    prim_net = dat2d.max(axis=1)
+    other_nets = np.ma.array(dat2d, mask=False)
+    other_nets.mask[np.arange(len(dat2d)), dat2d.argmax(axis=1)] = True
+    meandiff = prim_net - other_nets.mean(axis=1)
+    seconddiff = prim_net - other_nets.max(axis=1)
+    splitdiff = prim_net - other_nets.sum(axis=1)
+    return meandiff, seconddiff, splitdiff
+
+
+def test_affiliation_margins():
+    prng = np.random.RandomState(42)
+    dat = prng.randn(500, 14)
+    margins = na.affiliation_margins(dat)
+    expected = masked_margins(dat)
+    for key, exp in zip(['meandiff', 'seconddiff', 'splitdiff'], expected):
+        assert_equal(margins[key].dtype, np.float32)
+        assert_almost_equal(margins[key], exp, decimal=5)
+    margins = na.affiliation_margins(dat[:, :1])
+    assert_equal(margins['seconddiff'], 0)
+
+
+def test_calculate_margins():
+    prng = np.random.RandomState(42)
+    dat = prng.randn(6, 7, 8, 10)
+    mask = prng.rand(6, 7, 8) > .5
+    margins = na.calculate_margins(dat, mask, chunk_size=17)
+    expected = masked_margins(dat[mask])
+    assert_almost_equal(margins['meandiff'][mask], expected[0], decimal=5)
+    assert_almost_equal(margins['seconddiff'][mask], expected[1], decimal=5)
+    assert_equal(margins['splitdiff'][~mask], 0)
+    diff = na.calculate_diff_map(dat)
+    assert_equal(diff.shape, (6, 7, 8))
+    assert_almost_equal(diff[mask], expected[0], decimal=5)
+    assert_raises(ValueError, na.calculate_margins, dat, mask[:2])
+
+
+def test_cohort_diff_maps():
+    prng = np.random.RandomState(0)
+    datadir = mkdtemp()
+    datafiles = []
+    dats = []
+    for sub in [10001, 10002, 10003]:
+        dat = prng.randn(5, 6, 7, 12).astype(np.float32)
+        dats.append(dat)
+        f = join(datadir, 'dr_stage2_subject%05d_Z.nii.gz'%sub)
+        nib.Nifti1Image(dat, np.eye(4)).to_filename(f)
+        datafiles.append(f)
+    net_idx = [7, 0, 3, 11]
+    nets_dat, aff = na.load_networks(datafiles[1], net_idx)
+    assert_almost_equal(nets_dat, dats[1][..., net_idx])
+    assert_equal(na.get_subid(datafiles[2], 'subject[0-9]{5}'),
+                 'subject10003')
+    outdir = join(datadir, 'difference_maps')
+    os.mkdir(outdir)
+    outfiles, cohort_file = na.cohort_diff_maps(datafiles, net_idx, outdir,
+                                                nproc=2)
+    assert_equal(os.path.split(outfiles[0])[1], 'nets_diff_subject10001.nii.gz')
+    cohort = nib.load(cohort_file).get_data()
+    assert_equal(cohort.shape, (5, 6, 7, 3))
+    for i, dat in enumerate(dats):
+        expected = na.calculate_diff_map(dat[..., net_idx])
+        assert_almost_equal(cohort[..., i], expected, decimal=5)
+    subids = open(join(outdir, 'nets_diff_cohort.txt')).read().split()
+    assert_equal(subids, ['subject10001', 'subject10002', 'subject10003'])
+    _, cohort_file = na.cohort_diff_maps(datafiles[:2], net_idx, outdir,
+                                         cohort_name='pair')
+    assert_equal(cohort_file, join(outdir, 'pair.nii.gz'))
+    subids = open(join(outdir, 'pair.txt')).read().split()
+    assert_equal(subids, ['subject10001', 'subject10002'])
+
+    # all metrics from one read
+    metrics = ['meandiff', 'winner', 'entropy', 'participation']
+    outfiles, cohort_files = na.main(datadir, outdir, net_idx,
+                                     metrics=metrics)
+    winners = nib.load(cohort_files['winner']).get_data()
+    expected = dats[2][..., net_idx].argmax(axis=3) + 1
+    assert_equal(winners[..., 2], expected)
+    assert_equal(len(outfiles['entropy']), 3)
+    os.system('rm -rf %s'%datadir)
+
+
+def test_affiliation_metrics():
+    dat = np.array([[1., 0, 0, 0],
+                    [1, 1, 1, 1],
+                    [-1, -2, 3, 1],
+                    [-1, -1, -1, -1]])
+    values = na.affiliation_metrics(dat, ['winner', 'entropy',
+                                          'participation', 'meandiff'])
+    assert_equal(values['winner'], [1, 1, 3, 1])
+    assert_equal(values['winner'].dtype, np.int16)
+    p = np.array([.75, .25])
+    assert_almost_equal(values['entropy'],
+                        [0, 1, -(p * np.log(p)).sum() / np.log(4), 0])
+    assert_almost_equal(values['participation'],
+                        [0, 1, (1 - (p**2).sum()) * 4 / 3., 0])
+    assert_almost_equal(values['meandiff'], [1, 0, 3 - (-2 / 3.), 0])
+    assert_raises(ValueError, na.affiliation_metrics, dat, ['modularity'])
+    prng = np.random.RandomState(1)
+    dat4d = prng.randn(4, 5, 6, 8)
+    mask = prng.rand(4, 5, 6) > .5
+    values = na.calculate_metrics(dat4d, mask, ['entropy', 'winner'],
+                                  chunk_size=7)
+    expected = na.affiliation_metrics(dat4d[mask], ['entropy', 'winner'])
+    assert_almost_equal(values['entropy'][mask], expected['entropy'])
+    assert_equal(values['winner'][~mask], 0)
+    # proxy of an image, read chunk by chunk
+    outdir = mkdtemp()
+    f = join(outdir, 'nets.nii.gz')
+    nib.Nifti1Image(dat4d.astype(np.float32), np.eye(4)).to_filename(f)
+    proxy_values = na.calculate_metrics(nib.load(f).dataobj, mask,
+                                        ['entropy', 'winner'], chunk_size=7)
+    assert_almost_equal(proxy_values['entropy'], values['entropy'],
+                        decimal=5)
+    assert_equal(proxy_values['winner'], values['winner'])
+    os.system('rm -rf %s'%outdir)
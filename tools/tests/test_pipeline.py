@@ -0,0 +1,207 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join, exists
+from tempfile import mkdtemp
+import numpy as np
+import nibabel as nib
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import pipeline
+from .. import net_affiliation
+
+
+def scale_stage(outdir, infile, factor=1):
+    outfile = join(outdir, 'scaled.txt')
+    np.savetxt(outfile, np.loadtxt(infile) * factor)
+    return {'scaled': outfile}
+
+
+def sum_stage(outdir, infiles, offset=0):
+    outfile = join(outdir, 'sum.txt')
+    np.savetxt(outfile, [sum([np.loadtxt(f).sum() for f in infiles]) +
+                         offset])
+    return outfile
+
+
+def fail_stage(outdir, infile):
+    raise IOError('failed on %s'%infile)
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.store = join(self.outdir, 'store')
+        self.infiles = []
+        for i in range(3):
+            self.infiles.append(join(self.outdir, 'in%d.txt'%i))
+            np.savetxt(self.infiles[-1], np.arange(4) + i)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def make_nodes(self, factor=2, offset=0):
+        nodes = [pipeline.Node('scale%d'%i, scale_stage,
+                               inputs={'infile': f},
+                               params={'factor': factor})
+                 for i, f in enumerate(self.infiles)]
+        nodes.append(pipeline.Node('sum', sum_stage,
+                                   params={'offset': offset},
+                                   upstream={'infiles': [
+                                       ('scale%d'%i, 'scaled')
+                                       for i in range(3)]}))
+        # dependency order is not required
+        return nodes[::-1]
+
+    def test_sort_nodes(self):
+        nodes = self.make_nodes()
+        ordered = [node.name for node in pipeline.sort_nodes(nodes)]
+        assert_equal(ordered[-1], 'sum')
+        assert_raises(ValueError, pipeline.sort_nodes, nodes + nodes[:1])
+        assert_raises(ValueError, pipeline.sort_nodes, nodes[:1])
+        cycle = [pipeline.Node('a', sum_stage, upstream={'infiles': 'b'}),
+                 pipeline.Node('b', sum_stage, upstream={'infiles': 'a'})]
+        assert_raises(ValueError, pipeline.sort_nodes, cycle)
+
+    def test_run_pipeline(self):
+        status = pipeline.run_pipeline(self.make_nodes(), self.store,
+                                       nproc=2)
+        assert_equal(set([s['status'] for s in status.values()]),
+                     set(['ran']))
+        assert_equal(np.loadtxt(status['sum']['result']), 60)
+        assert_equal(status['scale0']['outdir'].startswith(self.store), True)
+        # all current
+        status = pipeline.run_pipeline(self.make_nodes(), self.store)
+        assert_equal(set([s['status'] for s in status.values()]),
+                     set(['current']))
+        # a parameter of the last node only re-runs that node
+        nodes = self.make_nodes(offset=1)
+        assert_equal(pipeline.stale_nodes(nodes, self.store), ['sum'])
+        status = pipeline.run_pipeline(nodes, self.store)
+        assert_equal(status['sum']['status'], 'ran')
+        assert_equal(status['scale1']['status'], 'current')
+        assert_equal(np.loadtxt(status['sum']['result']), 61)
+        # changed input contents re-run the node and its dependents
+        np.savetxt(self.infiles[1], np.zeros(4))
+        status = pipeline.run_pipeline(self.make_nodes(offset=1), self.store)
+        assert_equal([status[n]['status'] for n in
+                      ('scale0', 'scale1', 'scale2', 'sum')],
+                     ['current', 'ran', 'current', 'ran'])
+        assert_equal(np.loadtxt(status['sum']['result']), 41)
+        # a missing output file is a cache miss
+        os.remove(status['scale2']['result']['scaled'])
+        # (its key is unchanged, so dependents stay current)
+        assert_equal(pipeline.stale_nodes(self.make_nodes(offset=1),
+                                          self.store), ['scale2'])
+        status = pipeline.run_pipeline(self.make_nodes(offset=1), self.store,
+                                       force=['scale0'])
+        assert_equal([status[n]['status'] for n in
+                      ('scale0', 'scale1', 'scale2', 'sum')],
+                     ['ran', 'current', 'ran', 'current'])
+        assert_equal(exists(status['scale2']['result']['scaled']), True)
+
+    def test_node_key(self):
+        nodes = self.make_nodes()
+        hashes = dict([(os.path.abspath(f), 'sha1') for f in self.infiles])
+        key = pipeline.node_key(nodes[-1], {}, hashes)
+        # the module of the stage function (__main__ when run as a script)
+        # is not part of the key
+        func = lambda outdir, infile, factor: None
+        func.__name__ = 'scale_stage'
+        func.__module__ = '__main__'
+        node = pipeline.Node(nodes[-1].name, func, nodes[-1].inputs,
+                             nodes[-1].params)
+        assert_equal(pipeline.node_key(node, {}, hashes), key)
+        node.version = 1
+        assert_equal(pipeline.node_key(node, {}, hashes) == key, False)
+        # inputs are passed as absolute paths, as they are hashed
+        startdir = os.getcwd()
+        os.chdir(self.outdir)
+        try:
+            node = pipeline.Node('rel', scale_stage,
+                                 inputs={'infile': 'in0.txt',
+                                         'infiles': ['in1.txt']})
+            kwargs = pipeline.resolve(node, {})
+        finally:
+            os.chdir(startdir)
+        assert_equal(kwargs['infile'], os.path.abspath(self.infiles[0]))
+        assert_equal(kwargs['infiles'], [os.path.abspath(self.infiles[1])])
+
+    def test_failure(self):
+        nodes = self.make_nodes()
+        nodes[-1] = pipeline.Node('scale0', fail_stage,
+                                  inputs={'infile': self.infiles[0]})
+        status = pipeline.run_pipeline(nodes, self.store)
+        assert_equal(status['scale0']['status'], 'failed')
+        assert_equal('IOError' in status['scale0']['error'], True)
+        assert_equal(status['scale1']['status'], 'ran')
+        assert_equal(status['sum']['status'], 'skipped')
+
+    def test_cohort_pipeline(self):
+        subjects = [('B01-001', self.infiles[0], self.infiles[1]),
+                    ('B01-002', self.infiles[1], self.infiles[2])]
+        nodes = pipeline.cohort_pipeline(subjects, self.infiles[2],
+                                         self.infiles[0], net_idx=[0, 1])
+        ordered = [node.name for node in pipeline.sort_nodes(nodes)]
+        assert_equal(len(ordered), 7)
+        assert_equal(ordered[-1], 'affiliation')
+        assert_equal(ordered.index('qa_B01-001') <
+                     ordered.index('dr_B01-001') <
+                     ordered.index('match_B01-001'), True)
+        assert_equal(len(pipeline.stale_nodes(nodes, self.store)), 7)
+
+
+class TestStages(TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        prng = np.random.RandomState(0)
+        shape = (6, 6, 4)
+        # template networks, one block each
+        tdat = np.zeros(shape + (3,), dtype=np.float32)
+        for k in range(3):
+            tdat[2 * k:2 * k + 2, :, :, k] = 1
+        self.template = join(self.outdir, 'templates.nii.gz')
+        nib.Nifti1Image(tdat, np.eye(4)).to_filename(self.template)
+        self.mask = join(self.outdir, 'mask.nii.gz')
+        nib.Nifti1Image(np.ones(shape, dtype=np.int16),
+                        np.eye(4)).to_filename(self.mask)
+        # subject networks, the templates in another order plus noise
+        self.perm = [2, 0, 1]
+        self.datafiles = []
+        for subid in ['B01-001', 'B01-002']:
+            dat = tdat[..., self.perm] * 3 + prng.randn(*(shape + (3,)))
+            self.datafiles.append(join(self.outdir,
+                                       'dr_stage2_%s_Z.nii.gz'%subid))
+            nib.Nifti1Image(dat.astype(np.float32),
+                            np.eye(4)).to_filename(self.datafiles[-1])
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_match_affiliation(self):
+        store = join(self.outdir, 'store')
+        nodes = [pipeline.Node('match', pipeline.match_stage,
+                               inputs={'networks': self.datafiles[0],
+                                       'template': self.template,
+                                       'mask': self.mask}),
+                 pipeline.Node('affiliation', pipeline.affiliation_stage,
+                               inputs={'datafiles': self.datafiles,
+                                       'mask': self.mask},
+                               params={'net_idx': [0, 1]})]
+        status = pipeline.run_pipeline(nodes, store)
+        assert_equal([status[n]['status'] for n in ('match', 'affiliation')],
+                     ['ran', 'ran'])
+        result = status['match']['result']
+        gof = np.loadtxt(result['gof'])
+        assert_equal(gof.shape, (3, 3))
+        # template k is best matched by the subject network holding it
+        assert_equal(np.loadtxt(result['best_match']).astype(int),
+                     [self.perm.index(k) for k in range(3)])
+        cohort = nib.load(status['affiliation']['result']['meandiff'])
+        assert_equal(cohort.shape, (6, 6, 4, 2))
+        for i, f in enumerate(self.datafiles):
+            dat = nib.load(f).get_data()[..., [0, 1]]
+            expected = net_affiliation.calculate_metrics(dat)['meandiff']
+            assert_almost_equal(cohort.get_data()[..., i], expected,
+                                decimal=5)
@@ -0,0 +1,92 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join, exists
+from tempfile import mkdtemp
+import nibabel as ni
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import qa_stats as qas
+
+
+class TestQAStats(TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.outdir = mkdtemp()
+        shape = (6, 7, 5)
+        # rank 3 signal plus a little noise
+        maps = prng.randn(np.prod(shape), 3)
+        ts = prng.randn(3, 47) * np.array([[10], [5], [2]])
+        dat = np.dot(maps, ts).reshape(shape + (47,)) + 100
+        dat += .001 * prng.randn(*dat.shape)
+        self.dat = dat
+        self.mask = np.ones(shape, dtype=bool)
+        self.infile = join(self.outdir, 'func.nii.gz')
+        ni.Nifti1Image(dat, np.eye(4)).to_filename(self.infile)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_qa_stats(self):
+        res = qas.qa_stats(self.infile, mask=self.mask, ncomp=3,
+                           chunk_size=10)
+        dat = self.dat
+        assert_almost_equal(res['mean'], dat.mean(3))
+        assert_almost_equal(res['std'], dat.std(3))
+        assert_almost_equal(res['min'], dat.min(3))
+        assert_almost_equal(res['max'], dat.max(3))
+        assert_almost_equal(res['tsnr'], dat.mean(3) / dat.std(3))
+        assert_almost_equal(res['volume_means'], dat.reshape((-1, 47)).mean(0))
+        d2 = np.diff(dat, axis=3)**2
+        sliced = d2.mean(0).mean(0).T
+        assert_almost_equal(res['slice_mean_diff2'], sliced)
+        assert_almost_equal(res['volume_mean_diff2'], sliced.mean(1))
+        assert_almost_equal(res['diff2_mean_vol'], d2.mean(3))
+        maxt = sliced.argmax(0)
+        for s in range(dat.shape[2]):
+            assert_almost_equal(res['slice_diff2_max_vol'][:, :, s],
+                                d2[:, :, s, maxt[s]])
+        dvars = np.sqrt(d2.reshape((-1, 46)).mean(0))
+        assert_almost_equal(res['dvars'], np.concatenate(([0], dvars)))
+        # pca against exact svd of the time centred data
+        x = dat.reshape((-1, 47)).T
+        x = x - x.mean(0)
+        u, s, vt = np.linalg.svd(x, full_matrices=False)
+        assert_almost_equal(res['pca_variance'], s[:3]**2 / (x**2).sum(),
+                            decimal=4)
+        for c in range(3):
+            r = np.corrcoef(res['pca_timecourses'][:, c], u[:, c])[0, 1]
+            assert_almost_equal(abs(r), 1, decimal=4)
+            assert_almost_equal(np.abs(res['pca'][..., c].ravel()),
+                                np.abs(vt[c] * s[c]), decimal=2)
+
+    def test_chunking(self):
+        # results (except the random sketch) do not depend on chunk size
+        res1 = qas.qa_stats(self.infile, chunk_size=1, ncomp=2)
+        res2 = qas.qa_stats(self.infile, chunk_size=47, ncomp=2)
+        for key in ['mean', 'std', 'dvars', 'slice_mean_diff2',
+                    'slice_diff2_max_vol']:
+            assert_almost_equal(res1[key], res2[key])
+        assert_almost_equal(res1['pca_variance'], res2['pca_variance'],
+                            decimal=4)
+
+    def test_errors(self):
+        qa = qas.QAStats((6, 7, 5), mask=np.ones((2, 2, 2)))
+        assert_raises(ValueError, qa.update, self.dat[..., :3])
+        qa = qas.QAStats((6, 7, 5))
+        assert_raises(ValueError, qa.update, self.dat[:2, ..., :3])
+        qa.update(self.dat[..., 0])
+        assert_raises(ValueError, qa.finalize)
+
+    def test_save_qa_stats(self):
+        res = qas.qa_stats(self.infile, ncomp=2)
+        outfiles = qas.save_qa_stats(res, np.eye(4), self.outdir, 'func')
+        assert_equal(os.path.split(outfiles['tsnr'])[1],
+                     'QA-TSNR_func.nii.gz')
+        assert_equal(ni.load(outfiles['pca']).shape, (6, 7, 5, 2))
+        assert_almost_equal(np.loadtxt(outfiles['dvars']), res['dvars'],
+                            decimal=5)
+        for outf in outfiles.values():
+            assert_equal(exists(outf), True)
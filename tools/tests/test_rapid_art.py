@@ -0,0 +1,111 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import nibabel as ni
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import rapid_art
+
+
+class TestMake4d(TestCase):
+    def setUp(self):
+        prng = np.random.RandomState(42)
+        self.outdir = mkdtemp()
+        self.dat = (prng.rand(5, 6, 7, 8) * 1000).astype(np.int16)
+        self.infiles = []
+        for i in range(self.dat.shape[3]):
+            f = join(self.outdir, 'vol%03d.nii.gz'%i)
+            ni.Nifti1Image(self.dat[..., i], np.diag([3, 3, 3, 1])).to_filename(f)
+            self.infiles.append(f)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_make_4d_nibabel(self):
+        outf = rapid_art.make_4d_nibabel(self.infiles)
+        assert_equal(outf, join(self.outdir, 'data4d_vol000.nii'))
+        img = ni.load(outf)
+        assert_equal(img.get_data_dtype(), np.int16)
+        assert_equal(img.get_data(), self.dat)
+        assert_almost_equal(img.get_affine(), np.diag([3, 3, 3, 1]))
+        # parallel reads, compressed output in outdir
+        newdir = mkdtemp()
+        outf = rapid_art.make_4d_nibabel(self.infiles, outdir=newdir,
+                                         compress=True, nproc=3)
+        assert_equal(outf, join(newdir, 'data4d_vol000.nii.gz'))
+        assert_equal(ni.load(outf).get_data(), self.dat)
+        os.system('rm -rf %s'%newdir)
+
+    def test_make_4d_nibabel_nan(self):
+        dat = self.dat[..., :3].astype(np.float32)
+        dat[0, 0, 0, 1] = np.nan
+        infiles = []
+        for i in range(3):
+            f = join(self.outdir, 'float%03d.nii'%i)
+            ni.Nifti1Image(dat[..., i], np.eye(4)).to_filename(f)
+            infiles.append(f)
+        outf = rapid_art.make_4d_nibabel(infiles)
+        newdat = ni.load(outf).get_data()
+        assert_equal(newdat.dtype, np.float32)
+        dat[0, 0, 0, 1] = 0
+        assert_equal(newdat, dat)
+        # shape mismatch
+        f = join(self.outdir, 'small.nii')
+        ni.Nifti1Image(dat[:2, :, :, 0], np.eye(4)).to_filename(f)
+        assert_raises(ValueError, rapid_art.make_4d_nibabel, infiles + [f])
+
+    def test_make_4d_nibabel_mixed(self):
+        # an int16 first volume does not truncate later float volumes
+        dat = self.dat[..., :3].astype(np.float32)
+        dat[..., 1:] += 0.25
+        infiles = [self.infiles[0]]
+        for i in range(1, 3):
+            f = join(self.outdir, 'float%03d.nii'%i)
+            ni.Nifti1Image(dat[..., i], np.diag([3, 3, 3, 1])).to_filename(f)
+            infiles.append(f)
+        outf = rapid_art.make_4d_nibabel(infiles, nproc=2)
+        newdat = ni.load(outf).get_data()
+        assert_equal(newdat.dtype, np.float32)
+        assert_equal(newdat, dat)
+
+    def test_run_qa(self):
+        in4d = rapid_art.make_4d_nibabel(self.infiles)
+        qa, outfiles = rapid_art.run_qa(in4d, self.outdir, ncomp=2)
+        assert_almost_equal(qa['mean'], self.dat.mean(3))
+        assert_equal(os.path.exists(outfiles['plot']), True)
+        assert_equal(ni.load(outfiles['pca']).shape, (5, 6, 7, 2))
+        assert_equal(outfiles['tsnr'],
+                     join(self.outdir, 'QA-TSNR_data4d_vol000.nii.gz'))
+        tsnrf = rapid_art.gen_sig2noise_img(in4d, self.outdir, qa)
+        assert_equal(tsnrf, join(self.outdir, 'data4d_vol000_tsnr.nii.gz'))
+        assert_almost_equal(ni.load(tsnrf).get_data(), qa['tsnr'], decimal=4)
+
+    def test_outlier_maps(self):
+        mean = join(self.outdir, 'mean_func.nii.gz')
+        ni.Nifti1Image(self.dat[..., 0], np.eye(4)).to_filename(mean)
+        files = []
+        for i, vox in enumerate([[0, 5, 5], [5, 7], [7, 209]]):
+            files.append(join(self.outdir, 'outliers%d.txt'%i))
+            np.savetxt(files[-1], vox, fmt='%d')
+        outf = rapid_art.outlier_vol_fromfile(mean, files[0])
+        assert_equal(outf, join(self.outdir, 'outliers_func.nii.gz'))
+        dat = ni.load(outf).get_data()
+        assert_equal(dat.sum(), 200)
+        assert_equal(dat.flat[5], 100)
+        outf = rapid_art.cohort_outlier_map(mean, files,
+                                            join(self.outdir, 'cohort.nii.gz'))
+        img = ni.load(outf)
+        assert_equal(img.get_data_dtype(), np.float32)
+        dat = img.get_data()
+        assert_equal(dat.shape, (5, 6, 7, 2))
+        counts = dat[..., 0].ravel()
+        assert_equal(counts[[0, 5, 7, 209]], [1, 2, 2, 1])
+        assert_equal(counts.sum(), 6)
+        assert_almost_equal(dat[..., 1].ravel()[5], 2 / 3.)
+        np.savetxt(files[0], [210], fmt='%d')
+        assert_raises(IndexError, rapid_art.cohort_outlier_map, mean, files,
+                      outf)
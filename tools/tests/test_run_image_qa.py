@@ -0,0 +1,45 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+import numpy as np
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import run_image_qa as riq
+
+
+def test_spike_regressors():
+    spikes = riq.spike_regressors([2, 5], 6)
+    expected = np.zeros((6, 2))
+    expected[2, 0] = 1
+    expected[5, 1] = 1
+    assert_equal(spikes, expected)
+    assert_equal(riq.spike_regressors([], 6).shape, (6, 0))
+    assert_raises(IndexError, riq.spike_regressors, [6], 6)
+    assert_equal(riq.censor_mask([2, 5], 6), [1, 1, 0, 1, 1, 0])
+
+
+def test_regressors():
+    funcdir = mkdtemp()
+    os.mkdir(join(funcdir, 'data_QA'))
+    art_output = 'art.func.nii_outliers.txt'
+    np.savetxt(join(funcdir, 'data_QA', art_output), [5, 2], fmt='%d')
+    mc_params = np.random.RandomState(0).randn(8, 6)
+    exists, outliers = riq.CreateRegressors(funcdir, art_output, 8)
+    assert_equal(exists, True)
+    assert_equal(outliers, [2, 5])
+    spikes = np.loadtxt(join(funcdir, 'data_QA', 'outliers_for_fsl.txt'))
+    assert_equal(spikes, riq.spike_regressors(outliers, 8))
+    combined = riq.CombineRegressors(mc_params, outliers, funcdir,
+                                     'confounds.txt')
+    assert_equal(combined.shape, (8, 8))
+    saved = np.loadtxt(join(funcdir, 'confounds.txt'))
+    assert_almost_equal(saved, combined)
+    # no outliers, motion parameters only
+    combined = riq.CombineRegressors(mc_params, [], funcdir, 'confounds.txt')
+    assert_almost_equal(np.loadtxt(join(funcdir, 'confounds.txt')),
+                        mc_params)
+    outfile = riq.save_censor_mask(outliers, 8, join(funcdir, 'censor.txt'))
+    assert_equal(np.loadtxt(outfile), [1, 1, 0, 1, 1, 0, 1, 1])
+    os.system('rm -rf %s'%funcdir)
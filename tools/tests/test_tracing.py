@@ -0,0 +1,86 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+import json
+from os.path import join, exists
+from tempfile import mkdtemp
+import numpy as np
+from unittest import TestCase
+from numpy.testing import (assert_raises, assert_equal)
+
+from .. import tracing
+
+
+@tracing.traced(subject='subid')
+def work(subid, n=1000):
+    with tracing.span('inner', size=n):
+        return np.ones(n).sum()
+
+
+class FakeRuntime(object):
+    returncode = 1
+    stderr = 'failed'
+
+
+class FakeResult(object):
+    runtime = FakeRuntime()
+
+
+class FakeCommand(object):
+    cmdline = '/usr/bin/fsl_glm -i in.nii.gz'
+    def run(self):
+        return FakeResult()
+
+
+class TestTracing(TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        self.tracefile = join(self.outdir, 'trace.jsonl')
+        tracing.disable()
+
+    def tearDown(self):
+        tracing.disable()
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_disabled(self):
+        assert_equal(tracing.enabled(), False)
+        assert_equal(work('B01-001'), 1000)
+        assert_equal(exists(self.tracefile), False)
+
+    def test_traced(self):
+        tracing.enable(self.tracefile)
+        assert_equal(os.environ['CONNECTIVITY_TRACE'], self.tracefile)
+        work('B01-001')
+        work('B01-002', n=10)
+        tracing.run_command(FakeCommand(), subject='B01-001')
+        assert_raises(ValueError, work, 'B01-003', n=-1)
+        tracing.disable()
+        events = tracing.read_trace(self.tracefile)
+        assert_equal([ev['name'] for ev in events][:3],
+                     ['inner', '%s.work'%__name__, 'inner'])
+        assert_equal([ev['ph'] for ev in events], ['X'] * len(events))
+        # subject of the enclosing call
+        assert_equal(events[0]['args']['subject'], 'B01-001')
+        assert_equal(events[0]['args']['size'], 1000)
+        assert_equal(events[2]['args']['subject'], 'B01-002')
+        cmd = events[4]
+        assert_equal((cmd['name'], cmd['cat']), ('fsl_glm', 'subprocess'))
+        assert_equal(cmd['args']['returncode'], 1)
+        assert_equal(cmd['args']['stderr'], 'failed')
+        assert_equal('ValueError' in events[-1]['args']['error'], True)
+        for key in ('cpu_s', 'child_cpu_s', 'process_peak_rss_mb',
+                    'rss_growth_mb', 'read_bytes', 'write_bytes'):
+            assert_equal(key in events[1]['args'], True)
+        # the growth of one block is bounded by the process high-water mark
+        args = events[1]['args']
+        assert 0 <= args['rss_growth_mb'] <= args['process_peak_rss_mb']
+        summary = tracing.summarize(events, by=('name', 'subject'))
+        assert_equal(summary[('%s.work'%__name__, 'B01-001')]['count'], 1)
+        summary = tracing.summarize(events)
+        assert_equal(summary['inner']['count'], 3)
+        assert_equal(summary['fsl_glm']['errors'], 1)
+        outfile = tracing.chrome_trace(self.tracefile,
+                                       join(self.outdir, 'trace.json'))
+        with open(outfile) as fid:
+            chrome = json.load(fid)
+        assert_equal(len(chrome['traceEvents']), len(events))
@@ -0,0 +1,106 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from os.path import join
+from tempfile import mkdtemp
+from unittest import TestCase
+import numpy as np
+import nibabel as ni
+from numpy.testing import (assert_raises, assert_equal, assert_almost_equal)
+
+from .. import imgio
+from .. import volstack
+
+
+class TestMaskedVolumeStack(TestCase):
+    def setUp(self):
+        self.outdir = mkdtemp()
+        prng = np.random.RandomState(42)
+        self.dat = prng.randn(6, 7, 8, 5).astype(np.float32)
+        self.mask = prng.rand(6, 7, 8) > .5
+        self.affine = np.diag([2, 2, 2, 1])
+        self.infile = join(self.outdir, 'func.nii')
+        ni.Nifti1Image(self.dat, self.affine).to_filename(self.infile)
+
+    def tearDown(self):
+        os.system('rm -rf %s'%self.outdir)
+
+    def test_from_array(self):
+        stack = volstack.MaskedVolumeStack.from_array(self.dat, self.mask)
+        assert_equal(stack.data.dtype, np.float32)
+        assert_equal(stack.shape, self.mask.shape)
+        assert_equal(stack.nvoxels, self.mask.sum())
+        assert_equal(stack.nvolumes, 5)
+        # same voxels as boolean indexing, in image (Fortran) order
+        assert_equal(np.sort(stack.data[:, 0]),
+                     np.sort(self.dat[self.mask][:, 0]))
+        assert_equal(stack.to_volume()[self.mask], self.dat[self.mask])
+        assert_equal(stack.to_volume()[~self.mask], 0)
+        assert_equal(stack.extract(self.dat), stack.data)
+        assert_equal(stack.extract(self.dat[..., 0]), stack.data[:, 0])
+        values = np.arange(stack.nvoxels, dtype=np.int16)
+        vol = stack.to_volume(values, fill=-1)
+        assert_equal(vol.dtype, np.int16)
+        assert_equal(vol.shape, self.mask.shape)
+        assert_equal(vol[~self.mask], -1)
+        assert_raises(ValueError, stack.to_volume, values[1:])
+        assert_raises(ValueError, volstack.MaskedVolumeStack.from_array,
+                      self.dat, self.mask[1:])
+        # 3D
+        stack = volstack.MaskedVolumeStack.from_array(self.dat[..., 0],
+                                                      self.mask)
+        assert_equal(stack.nvolumes, 1)
+
+    def test_zero_copy(self):
+        img = imgio.load(self.infile)
+        stack = volstack.MaskedVolumeStack.from_image(img)
+        assert np.may_share_memory(stack.data, img.get_data())
+        assert_equal(stack.nvoxels, self.mask.size)
+        chunks = list(stack.iter_chunks(100))
+        assert_equal([start for start, _ in chunks], [0, 100, 200, 300])
+        assert np.may_share_memory(chunks[1][1], stack.data)
+        assert_equal(np.concatenate([c for _, c in chunks]), stack.data)
+        assert_equal(stack.to_volume(), self.dat)
+
+    def test_iter_extract(self):
+        stack = volstack.MaskedVolumeStack.from_mask(self.mask)
+        assert_equal(stack.nvolumes, 0)
+        dat = self.dat.astype(np.float64)
+        chunks = list(stack.iter_extract(dat, 50))
+        assert_equal([start for start, _ in chunks],
+                     range(0, stack.nvoxels, 50))
+        assert_equal(chunks[0][1].dtype, np.float64)
+        full = volstack.MaskedVolumeStack.from_array(dat, self.mask)
+        assert_equal(np.concatenate([c for _, c in chunks]), full.data)
+        # 3D, one column
+        chunks = list(stack.iter_extract(dat[..., 0], 50))
+        assert_equal(chunks[0][1].shape, (50, 1))
+        assert_raises(ValueError, list, stack.iter_extract(dat[1:]))
+        # nibabel proxy, read per chunk
+        proxy = ni.load(self.infile).dataobj
+        chunks = list(stack.iter_extract(proxy, 50))
+        assert_equal(np.concatenate([c for _, c in chunks]), full.data)
+
+    def test_save(self):
+        stack = volstack.MaskedVolumeStack.from_image(self.infile, self.mask)
+        assert_equal(stack.affine, self.affine)
+        outfile = stack.save(join(self.outdir, 'mean.nii.gz'),
+                             stack.data.mean(axis=1))
+        out = ni.load(outfile)
+        assert_equal(out.get_affine(), self.affine)
+        assert_almost_equal(out.get_data()[self.mask],
+                            self.dat[self.mask].mean(axis=1), decimal=5)
+        assert_equal(out.get_data()[~self.mask], 0)
+        img = stack.to_image()
+        assert_equal(img.shape, self.dat.shape)
+        assert_equal(img.get_data_dtype(), np.float32)
+
+    def test_npz(self):
+        stack = volstack.MaskedVolumeStack.from_image(self.infile, self.mask)
+        npzfile = stack.save_npz(join(self.outdir, 'stack.npz'))
+        new = volstack.MaskedVolumeStack.load_npz(npzfile)
+        assert_equal(new.mask, self.mask)
+        assert_equal(new.data, stack.data)
+        assert_equal(new.affine, self.affine)
+        assert_equal(new.header.get_data_shape(), self.dat.shape)
+        assert_equal(new.to_volume(), stack.to_volume())
@@ -0,0 +1,330 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Lightweight profiling and tracing
+
+Functions decorated with traced, blocks in a span and commands run with
+run_command each add one event to a trace file: wall time, process and
+child (subprocess) CPU time, the RSS high-water mark of the process (and
+how much the block raised it) and bytes read and written, tagged with
+the subject being processed. Tracing is off unless enabled, from the
+environment (CONNECTIVITY_TRACE=<file>) or with enable(<file>); when off
+a traced function costs one dict lookup.
+
+Events are appended one per line (JSON lines, safe from several
+processes) in the Chrome trace event format ("ph": "X" complete events),
+chrome_trace converts a trace to a file for chrome://tracing or Perfetto
+and summarize totals it per function and subject.
+
+>>> @traced(subject='subid')
+... def process(subid, infile):
+...     run_command(CommandLine('fsl_glm ...'))
+>>> with span('load', subject='B05-201'):
+...     dat = imgio.get_data(infile)
+
+python tracing.py trace.jsonl -chrome trace.json
+"""
+import os, sys
+import json
+import time
+import threading
+import argparse
+from functools import wraps
+from inspect import getcallargs
+try:
+    import resource
+except ImportError:
+    # not on windows, no peak RSS
+    resource = None
+
+# fd of the open trace file, None when tracing is off
+_state = {'fd': None, 'filename': None}
+_local = threading.local()
+
+
+def enable(filename):
+    """ append trace events to filename (also for child processes
+    started after this, which inherit the environment)"""
+    disable()
+    _state['fd'] = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                           0644)
+    _state['filename'] = filename
+    os.environ['CONNECTIVITY_TRACE'] = filename
+
+
+def disable():
+    """ stop tracing"""
+    if _state['fd'] is not None:
+        os.close(_state['fd'])
+    _state['fd'] = None
+    _state['filename'] = None
+    os.environ.pop('CONNECTIVITY_TRACE', None)
+
+
+def enabled():
+    return _state['fd'] is not None
+
+
+def _io_counters():
+    """ (bytes read, bytes written) by this process through read and
+    write calls (linux /proc/self/io), (0, 0) if not available"""
+    try:
+        with open('/proc/self/io') as fid:
+            counters = dict([line.split(':') for line in fid])
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _sample():
+    times = os.times()
+    return {'wall': time.time(), 'cpu': times[0] + times[1],
+            'child_cpu': times[2] + times[3], 'io': _io_counters(),
+            'peak_rss': _peak_rss_mb()}
+
+
+def current_subject():
+    """ subject set by the innermost enclosing span (or traced call)
+    with a subject in this thread"""
+    return getattr(_local, 'subject', None)
+
+
+def write_event(event):
+    """ append one event (dict) to the trace, as a single write"""
+    fd = _state['fd']
+    if fd is None:
+        return
+    os.write(fd, json.dumps(event, default=str) + '\n')
+
+
+class span(object):
+    """
+    context manager adding one complete event for its block
+
+    Parameters
+    ----------
+    name : str
+        event name
+    cat : str
+        category (eg. 'function', 'subprocess', 'io')
+    subject : str or None
+        subject id, default that of the enclosing span
+    args : dict
+        extra fields of the event, set_args adds more inside the block
+    """
+    def __init__(self, name, cat='block', subject=None, **args):
+        self.name = name
+        self.cat = cat
+        self.subject = subject
+        self.args = args
+
+    def set_args(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        if _state['fd'] is None:
+            return self
+        self._outer = current_subject()
+        if self.subject is None:
+            self.subject = self._outer
+        _local.subject = self.subject
+        self._start = _sample()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if _state['fd'] is None or not hasattr(self, '_start'):
+            return False
+        end = _sample()
+        start = self._start
+        _local.subject = self._outer
+        args = {'cpu_s': round(end['cpu'] - start['cpu'], 6),
+                'child_cpu_s': round(end['child_cpu'] - start['child_cpu'],
+                                     6),
+                # ru_maxrss is the high-water mark of the whole process,
+                # the growth is 0 for a block below an earlier peak
+                'process_peak_rss_mb': end['peak_rss'],
+                'rss_growth_mb': None,
+                'read_bytes': end['io'][0] - start['io'][0],
+                'write_bytes': end['io'][1] - start['io'][1],
+                'subject': self.subject}
+        if end['peak_rss'] is not None:
+            args['rss_growth_mb'] = end['peak_rss'] - start['peak_rss']
+        if exc_type is not None:
+            args['error'] = '%s: %s'%(exc_type.__name__, exc)
+        args.update(self.args)
+        write_event({'name': self.name, 'cat': self.cat, 'ph': 'X',
+                     'ts': int(start['wall'] * 1e6),
+                     'dur': int((end['wall'] - start['wall']) * 1e6),
+                     'pid': os.getpid(),
+                     'tid': threading.current_thread().ident,
+                     'args': args})
+        return False
+
+
+def traced(name=None, subject=None, cat='function'):
+    """
+    decorator adding one event per call (see span)
+
+    Parameters
+    ----------
+    name : str or None
+        event name, default <module>.<function>
+    subject : str, function or None
+        name of the argument holding the subject id, or a function of
+        the call arguments ({name : value}) returning it
+    """
+    def decorator(func):
+        evname = name or '%s.%s'%(func.__module__, func.__name__)
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _state['fd'] is None:
+                return func(*args, **kwargs)
+            subj = None
+            if subject is not None:
+                try:
+                    callargs = getcallargs(func, *args, **kwargs)
+                    if callable(subject):
+                        subj = subject(callargs)
+                    else:
+                        subj = callargs.get(subject)
+                except Exception:
+                    # tracing never breaks the call
+                    pass
+            with span(evname, cat, subj):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def command_name(cmdline):
+    """ executable of a command line string"""
+    parts = cmdline.split()
+    if not parts:
+        return ''
+    return os.path.split(parts[0])[1]
+
+
+def run_command(cmd, subject=None):
+    """
+    run a nipype CommandLine (or other interface), adding a subprocess
+    event named after the executable with the command line, return code
+    and the end of stderr on failure
+
+    Returns
+    -------
+    cout : result of cmd.run()
+    """
+    if _state['fd'] is None:
+        return cmd.run()
+    try:
+        cmdline = cmd.cmdline
+    except Exception:
+        cmdline = cmd.__class__.__name__
+    with span(command_name(cmdline), 'subprocess', subject,
+              cmdline=cmdline) as sp:
+        cout = cmd.run()
+        runtime = getattr(cout, 'runtime', None)
+        returncode = getattr(runtime, 'returncode', None)
+        sp.set_args(returncode=returncode)
+        if returncode:
+            sp.set_args(stderr=(getattr(runtime, 'stderr', '') or '')[-2000:])
+    return cout
+
+
+def read_trace(filename):
+    """ events of a trace file"""
+    events = []
+    with open(filename) as fid:
+        for line in fid:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    return events
+
+
+def chrome_trace(filename, outfile):
+    """ write the events of trace filename to outfile in the Chrome
+    trace (json object) format"""
+    with open(outfile, 'w+') as fid:
+        json.dump({'traceEvents': read_trace(filename),
+                   'displayTimeUnit': 'ms'}, fid)
+    return outfile
+
+
+def summarize(events, by=('name',)):
+    """
+    totals of events grouped by name (and subject with
+    by=('name', 'subject'))
+
+    Returns
+    -------
+    summary : dict
+        {group : {'count', 'wall_s', 'cpu_s', 'child_cpu_s',
+        'read_bytes', 'write_bytes', 'process_peak_rss_mb' (max),
+        'rss_growth_mb' (max), 'errors'}}
+    """
+    summary = {}
+    for ev in events:
+        args = ev.get('args', {})
+        group = tuple([ev.get(k, args.get(k)) for k in by])
+        if len(group) == 1:
+            group = group[0]
+        tot = summary.setdefault(group, {
+            'count': 0, 'wall_s': 0., 'cpu_s': 0., 'child_cpu_s': 0.,
+            'read_bytes': 0, 'write_bytes': 0, 'process_peak_rss_mb': 0.,
+            'rss_growth_mb': 0., 'errors': 0})
+        tot['count'] += 1
+        tot['wall_s'] += ev.get('dur', 0) / 1e6
+        for key in ('cpu_s', 'child_cpu_s', 'read_bytes', 'write_bytes'):
+            tot[key] += args.get(key) or 0
+        for key in ('process_peak_rss_mb', 'rss_growth_mb'):
+            tot[key] = max(tot[key], args.get(key) or 0)
+        if 'error' in args or args.get('returncode'):
+            tot['errors'] += 1
+    return summary
+
+
+def print_summary(summary):
+    print '%-50s %6s %10s %10s %10s %10s %10s %8s %8s'%(
+        'name', 'count', 'wall_s', 'cpu_s', 'child_s', 'read_MB',
+        'write_MB', 'peak_MB', 'grow_MB')
+    for group, tot in sorted(summary.items(),
+                             key=lambda item: -item[1]['wall_s']):
+        if isinstance(group, tuple):
+            group = ' '.join([str(g) for g in group])
+        print '%-50s %6d %10.2f %10.2f %10.2f %10.1f %10.1f %8.0f %8.0f'%(
+            group, tot['count'], tot['wall_s'], tot['cpu_s'],
+            tot['child_cpu_s'], tot['read_bytes'] / 2.**20,
+            tot['write_bytes'] / 2.**20, tot['process_peak_rss_mb'],
+            tot['rss_growth_mb'])
+
+
+if os.environ.get('CONNECTIVITY_TRACE'):
+    enable(os.environ['CONNECTIVITY_TRACE'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Summarize a trace file (CONNECTIVITY_TRACE)')
+    parser.add_argument('trace', type=str, help='trace file (JSON lines)')
+    parser.add_argument('-subject', action='store_true', dest='subject',
+                        help='totals per function and subject')
+    parser.add_argument('-chrome', dest='chrome', default=None,
+                        help='also write a Chrome trace (chrome://tracing)')
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+    else:
+        args = parser.parse_args()
+        by = ('name', 'subject') if args.subject else ('name',)
+        print_summary(summarize(read_trace(args.trace), by))
+        if args.chrome is not None:
+            print 'wrote %s'%chrome_trace(args.trace, args.chrome)
@@ -0,0 +1,222 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""
+Masked voxels X volumes matrix of a 3D/4D image
+
+A MaskedVolumeStack holds the in-mask voxels of an image as one
+nvoxels X nvolumes float32 array, with the mask, the flat index of its
+voxels, the affine and the header needed to put values back into a
+volume. Voxels are in image (Fortran) order, the order nifti data is
+stored in, so an unmasked float32 image (memory mapped by imgio.load) is
+used without a copy. Values are scattered back to a full grid only when
+written (to_volume, save), and save_npz / load_npz keep the stack in a
+compact form (packed mask, masked float32 data).
+
+>>> stack = MaskedVolumeStack.from_image(fourd, maskf)
+>>> for start, chunk in stack.iter_chunks(20000):
+...     res[start:start + len(chunk)] = np.corrcoef(chunk, seed)[-1, :-1]
+>>> stack.save(outfile, res)
+"""
+import numpy as np
+import nibabel as ni
+import imgio
+
+
+class MaskedVolumeStack(object):
+    """
+    in-mask voxels of a 3D/4D image as a nvoxels X nvolumes array
+
+    Parameters
+    ----------
+    data : array
+        nvoxels X nvolumes float32 array, rows are the voxels of index
+    mask : array
+        boolean volume (shape of the image grid)
+    affine : array or None
+        4 X 4 voxel to world affine
+    header : nibabel header or None
+        header to copy fields (eg. TR) from on write
+    """
+    def __init__(self, data, mask, affine=None, header=None):
+        self.mask = np.asarray(mask) > 0
+        # flat (Fortran order) indices of the in-mask voxels
+        self.index = np.flatnonzero(self.mask.ravel(order='F'))
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        if not data.shape[0] == len(self.index):
+            raise ValueError('%d rows for %d mask voxels'%(data.shape[0],
+                                                          len(self.index)))
+        self.data = data.astype(np.float32, copy=False)
+        self.affine = affine
+        self.header = header
+
+    @classmethod
+    def from_array(cls, dat, mask=None, affine=None, header=None):
+        """
+        stack of the voxels of 3D or 4D array dat within mask (default
+        all voxels), a view of dat when it is Fortran ordered float32
+        and mask is None
+        """
+        if mask is None:
+            mask = np.ones(dat.shape[:3], dtype=bool)
+        mask = np.asarray(mask) > 0
+        if not mask.shape == dat.shape[:3]:
+            raise ValueError('dimension mismatch, mask: %s, data: %s'%(
+                mask.shape, dat.shape[:3]))
+        nvols = int(np.prod(dat.shape[3:]))
+        flat = np.asarray(dat).reshape((mask.size, nvols), order='F')
+        if not mask.all():
+            flat = flat.take(np.flatnonzero(mask.ravel(order='F')), axis=0)
+        return cls(flat, mask, affine, header)
+
+    @classmethod
+    def from_image(cls, img, mask=None):
+        """
+        stack of a 3D/4D image (filename or nibabel image, filenames are
+        memory mapped with imgio.load) within mask (filename, array or
+        None for all voxels)
+        """
+        if isinstance(img, basestring):
+            img = imgio.load(img)
+        if isinstance(mask, basestring):
+            mask = imgio.get_data(mask)
+        return cls.from_array(img.get_data(), mask, img.get_affine(),
+                              img.get_header())
+
+    @classmethod
+    def from_mask(cls, mask, affine=None, header=None):
+        """
+        stack of the voxels of mask without data (0 volumes), to read
+        other arrays on the grid with iter_extract and scatter results
+        back with to_volume
+        """
+        mask = np.asarray(mask) > 0
+        return cls(np.empty((int(mask.sum()), 0), dtype=np.float32), mask,
+                   affine, header)
+
+    @property
+    def shape(self):
+        """ shape of the image grid"""
+        return self.mask.shape
+
+    @property
+    def nvoxels(self):
+        return self.data.shape[0]
+
+    @property
+    def nvolumes(self):
+        return self.data.shape[1]
+
+    def extract(self, dat):
+        """ voxels of another 3D/4D array on the same grid, in the order
+        of the stack (nvoxels or nvoxels X n array, dtype of dat)"""
+        dat = np.asarray(dat)
+        if not dat.shape[:3] == self.shape:
+            raise ValueError('dimension mismatch, mask: %s, data: %s'%(
+                self.shape, dat.shape[:3]))
+        flat = dat.reshape((self.mask.size,) + dat.shape[3:], order='F')
+        return flat.take(self.index, axis=0)
+
+    def iter_extract(self, dat, chunk_size=20000):
+        """
+        (start, chunk) for chunk_size voxels of another array on the
+        same grid (shape of the mask + any trailing axes), each chunk
+        read from dat when reached, so the in-mask voxels are never all
+        copied at once (nvoxels X n array, dtype of dat)
+
+        dat may be an array, a memory map or a nibabel array proxy
+        (img.dataobj), of which only the slab of the last mask axis
+        holding the voxels of a chunk is read
+        """
+        if not hasattr(dat, 'shape'):
+            dat = np.asarray(dat)
+        ndim = self.mask.ndim
+        if not tuple(dat.shape[:ndim]) == self.shape:
+            raise ValueError('dimension mismatch, mask: %s, data: %s'%(
+                self.shape, tuple(dat.shape[:ndim])))
+        proxy = not isinstance(dat, np.ndarray)
+        for start in range(0, self.nvoxels, chunk_size):
+            idx = np.unravel_index(self.index[start:start + chunk_size],
+                                   self.shape, order='F')
+            if proxy:
+                # Fortran order, the last axis index never decreases
+                lo, hi = idx[-1][0], idx[-1][-1] + 1
+                slab = np.asarray(dat[(slice(None),) * (ndim - 1) +
+                                      (slice(lo, hi),)])
+                chunk = slab[idx[:-1] + (idx[-1] - lo,)]
+            else:
+                chunk = dat[idx]
+            yield start, chunk.reshape((chunk.shape[0], -1))
+
+    def iter_chunks(self, chunk_size=20000):
+        """ (start, chunk) for views of chunk_size voxels of data"""
+        for start in range(0, self.nvoxels, chunk_size):
+            yield start, self.data[start:start + chunk_size]
+
+    def to_volume(self, values=None, fill=0):
+        """
+        scatter values (nvoxels or nvoxels X n array, default data) to
+        the image grid, fill outside the mask
+
+        Returns
+        -------
+        vol : array
+            shape or shape + (n,) array, dtype of values
+        """
+        if values is None:
+            values = self.data
+        values = np.asarray(values)
+        if not values.shape[0] == self.nvoxels:
+            raise ValueError('%d values for %d mask voxels'%(values.shape[0],
+                                                            self.nvoxels))
+        out = np.empty((self.mask.size,) + values.shape[1:],
+                       dtype=values.dtype)
+        out.fill(fill)
+        out[self.index] = values
+        return out.reshape(self.shape + values.shape[1:], order='F')
+
+    def to_image(self, values=None, dtype=np.float32):
+        """ nifti image of to_volume(values), header fields copied from
+        the header of the stack"""
+        vol = self.to_volume(values)
+        header = None
+        if self.header is not None:
+            header = self.header.copy()
+        img = ni.Nifti1Image(vol, self.affine, header)
+        img.set_data_dtype(dtype)
+        return img
+
+    def save(self, filename, values=None, dtype=np.float32):
+        """ write to_volume(values) with imgio.save (see there for dtype
+        and the gzip settings)"""
+        return imgio.save(self.to_volume(values), self.affine, filename,
+                          header=self.header, dtype=dtype)
+
+    def save_npz(self, filename):
+        """ write the stack (bit packed mask, masked data, affine, nifti
+        header) to an uncompressed .npz"""
+        arrays = {'data': self.data, 'shape': np.array(self.shape),
+                  'mask': np.packbits(self.mask.ravel(order='F'))}
+        if self.affine is not None:
+            arrays['affine'] = self.affine
+        if isinstance(self.header, ni.Nifti1Header):
+            arrays['header'] = np.frombuffer(self.header.binaryblock,
+                                             dtype=np.uint8)
+        np.savez(filename, **arrays)
+        return filename
+
+    @classmethod
+    def load_npz(cls, filename):
+        """ stack written by save_npz"""
+        arrays = np.load(filename)
+        shape = tuple(arrays['shape'])
+        nvox = int(np.prod(shape))
+        mask = np.unpackbits(arrays['mask'])[:nvox].astype(bool)
+        mask = mask.reshape(shape, order='F')
+        affine, header = None, None
+        if 'affine' in arrays.files:
+            affine = arrays['affine']
+        if 'header' in arrays.files:
+            header = ni.Nifti1Header(arrays['header'].tostring())
+        return cls(arrays['data'], mask, affine, header)